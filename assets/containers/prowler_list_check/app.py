@@ -1,17 +1,53 @@
 import os
 import re
 import boto3
+import json
 import logging
+from botocore.exceptions import ClientError
 from typing import List
 from time import sleep
+from check_scheduler import DurationEstimates, pack
+from token_bucket import AdaptiveTokenBucket, backoff
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# SNS accepts at most 10 messages per PublishBatch call
+PUBLISH_BATCH_SIZE = 10
+MAXIMUM_ATTEMPTS = 8
+DEFAULT_PUBLISH_RATE = 50.0
+DEFAULT_PUBLISH_BURST = 20
+# Expected run time of one scan invocation, leaving room under the 15 minute Lambda limit
+DEFAULT_BUDGET_SECONDS = 600
+
+THROTTLING_CODES = ('Throttling', 'ThrottlingException', 'ThrottledException', 'TooManyRequestsException',
+                    'RequestLimitExceeded', 'InternalError', 'ServiceUnavailable')
+
+
+class PublishError(Exception):
+    def __init__(self, failed: list):
+        super().__init__(f'Failed to publish {len(failed)} message(s): {failed}')
+        self.failed = failed
+
 
 class ProwlerListGroups:
-    def __init__(self, topic_arn):
-        self.topic = boto3.resource('sns').Topic(topic_arn)
+    def __init__(self, topic_arn, publish_rate: float = DEFAULT_PUBLISH_RATE,
+                 publish_burst: int = DEFAULT_PUBLISH_BURST, sns_client=None, sleep=sleep,
+                 state_bucket: str = None, budget_seconds: float = DEFAULT_BUDGET_SECONDS, lanes: int = 1,
+                 s3_client=None, targets: int = 1):
+        self.__topic_arn = topic_arn
+        self.__sns_client = sns_client or boto3.client('sns')
+        self.__sleep = sleep
+        # Paces the messages so the scans they start do not all call the same APIs in the same second
+        self.__bucket = AdaptiveTokenBucket(publish_rate, publish_burst, sleep=sleep)
+        # Without recorded durations every group is published on its own
+        self.__estimates = None
+        if state_bucket is not None:
+            self.__estimates = DurationEstimates(s3_client or boto3.client('s3'), state_bucket)
+        self.__budget_seconds = budget_seconds
+        self.__lanes = lanes
+        # Accounts times regions the scanner runs every check in
+        self.__targets = targets
 
     @staticmethod
     def __list_groups():
@@ -33,15 +69,67 @@ class ProwlerListGroups:
 
         return ret
 
+    def __publish_batch(self, entries: list) -> list:
+        """Publishes the entries, retrying throttled ones, and returns the entries that could not be published"""
+        for attempt in range(MAXIMUM_ATTEMPTS):
+            self.__bucket.acquire(len(entries))
+            try:
+                response = self.__sns_client.publish_batch(TopicArn=self.__topic_arn,
+                                                           PublishBatchRequestEntries=entries)
+            except ClientError as e:
+                if e.response['Error']['Code'] not in THROTTLING_CODES:
+                    raise
+                failed_ids = {entry['Id'] for entry in entries}
+                retryable_ids = failed_ids
+            else:
+                failed = response.get('Failed', [])
+                failed_ids = {f['Id'] for f in failed}
+                retryable_ids = {f['Id'] for f in failed
+                                 if not f.get('SenderFault') and f['Code'] in THROTTLING_CODES}
+                for f in failed:
+                    if f['Id'] not in retryable_ids:
+                        logger.error(f'Failed to publish {f}')
+
+            if len(retryable_ids) == 0:
+                self.__bucket.succeeded()
+                return [entry for entry in entries if entry['Id'] in failed_ids]
+
+            self.__bucket.throttled()
+            logger.info(f'{len(retryable_ids)} messages throttled, publishing at {self.__bucket.rate:.1f}/s')
+            entries = [entry for entry in entries if entry['Id'] in failed_ids]
+            self.__sleep(backoff(attempt))
+        return entries
+
+    def publish(self, messages: List[str]):
+        failed = []
+        for start in range(0, len(messages), PUBLISH_BATCH_SIZE):
+            entries = [{'Id': str(start + i), 'Message': m}
+                       for i, m in enumerate(messages[start:start + PUBLISH_BATCH_SIZE])]
+            failed += self.__publish_batch(entries)
+        if len(failed) > 0:
+            raise PublishError([entry['Message'] for entry in failed])
+
+    def messages(self, groups: List[str]) -> List[str]:
+        """Packs the groups into one message per scan invocation, a JSON list of the groups it runs"""
+        if self.__estimates is None:
+            return groups
+        bins = pack(self.__estimates.estimates(groups), self.__budget_seconds, self.__lanes, self.__targets)
+        logger.info(f'Packed {len(groups)} groups into {len(bins)} invocations')
+        return [json.dumps(b) for b in bins]
+
     def handler(self, event, context):
         groups = ProwlerListGroups.__list_groups()
         processed = ProwlerListGroups.process_groups(groups)
         logger.info(f'groups found {groups}')
-        for p in processed:
-            sleep(0.1) # Adds Slight Delay to help with Throttling API Calls during fanout
-            self.topic.publish(Message=p)
+        self.publish(self.messages(processed))
 
 
 def handler(event, context):
-    ProwlerListGroups(topic_arn=os.environ.get('topic_arn')).handler(event, context)
+    ProwlerListGroups(topic_arn=os.environ.get('topic_arn'),
+                      publish_rate=float(os.environ.get('publish_rate', DEFAULT_PUBLISH_RATE)),
+                      publish_burst=int(os.environ.get('publish_burst', DEFAULT_PUBLISH_BURST)),
+                      state_bucket=os.environ.get('state_bucket'),
+                      budget_seconds=float(os.environ.get('budget_seconds', DEFAULT_BUDGET_SECONDS)),
+                      lanes=int(os.environ.get('lanes', 1)),
+                      targets=int(os.environ.get('targets', 1))).handler(event, context)
     return 'Done'
@@ -0,0 +1,74 @@
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote
+
+logger = logging.getLogger()
+
+DEFAULT_PREFIX = 'durations'
+# Assumed for checks that never ran, and what old measurements decay towards
+DEFAULT_SECONDS = 60.0
+# A measurement loses half its weight every week, so a check that changed cost is re-learned
+DEFAULT_HALF_LIFE_SECONDS = 7 * 24 * 3600
+
+
+class DurationEstimates:
+    """Reads the durations the scanner recorded for every check from the state bucket"""
+
+    def __init__(self, s3_client, bucket_name: str, prefix: str = DEFAULT_PREFIX,
+                 default_seconds: float = DEFAULT_SECONDS, half_life_seconds: float = DEFAULT_HALF_LIFE_SECONDS,
+                 clock=time.time):
+        self.__s3_client = s3_client
+        self.__bucket_name = bucket_name
+        self.__prefix = prefix
+        self.__default_seconds = default_seconds
+        self.__half_life_seconds = half_life_seconds
+        self.__clock = clock
+
+    def __read(self, key: str) -> dict:
+        return json.loads(self.__s3_client.get_object(Bucket=self.__bucket_name, Key=key)['Body'].read())
+
+    def history(self) -> dict:
+        keys = []
+        paginator = self.__s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.__bucket_name, Prefix=self.__prefix + '/'):
+            keys += [o['Key'] for o in page.get('Contents', []) if o['Key'].endswith('.json')]
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            entries = list(executor.map(self.__read, keys))
+        return {unquote(k[len(self.__prefix) + 1:-len('.json')]): e for k, e in zip(keys, entries)}
+
+    def estimate(self, entry) -> float:
+        if entry is None:
+            return self.__default_seconds
+        age = max(0.0, self.__clock() - entry['updated'])
+        weight = 0.5 ** (age / self.__half_life_seconds)
+        return weight * entry['seconds'] + (1 - weight) * self.__default_seconds
+
+    def estimates(self, checks: list) -> dict:
+        history = self.history()
+        return {c: self.estimate(history.get(c)) for c in checks}
+
+
+def pack(durations: dict, budget: float, lanes: int = 1, targets: int = 1) -> list:
+    """Packs checks into as few invocations as possible, each expected to finish within `budget` seconds.
+
+    Longest processing time first: checks are placed from the most to the least expensive, each into the least loaded
+    invocation that still has room, opening a new one when none has.  An invocation runs `lanes` checks at a time,
+    so it has room for `budget * lanes` seconds of checks.  Every check runs once per target, an account and region
+    to scan, so it takes `seconds * targets` of that room.  A check estimated above the budget, or whose runs over
+    all targets do not fit in one invocation, runs on its own; the scanner reschedules the runs it has to skip.
+    """
+    capacity = budget * lanes
+    bins = []
+    for check, seconds in sorted(durations.items(), key=lambda item: (-item[1], item[0])):
+        work = seconds * targets
+        fitting = [b for b in bins if b['seconds'] + work <= capacity] if seconds < budget else []
+        if len(fitting) == 0:
+            # An invocation holding a check over the budget is closed, nothing should wait on it
+            bins.append({'checks': [check], 'seconds': work if seconds < budget else capacity})
+        else:
+            target = min(fitting, key=lambda b: b['seconds'])
+            target['checks'].append(check)
+            target['seconds'] += work
+    return [b['checks'] for b in bins]
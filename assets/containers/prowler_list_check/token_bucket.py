@@ -0,0 +1,55 @@
+import random
+import time
+
+MINIMUM_RATE = 1.0
+
+
+class AdaptiveTokenBucket:
+    """Token bucket that limits calls to `rate` per second with bursts of up to `burst`.
+
+    Every throttling response halves the rate, down to `MINIMUM_RATE`.  Every successful call then adds a tenth of
+    the configured rate back, until the configured rate is reached again (additive increase, multiplicative
+    decrease).
+    """
+
+    def __init__(self, rate: float, burst: int, clock=time.monotonic, sleep=time.sleep):
+        if rate <= 0 or burst < 1:
+            raise ValueError('rate must be positive and burst at least 1')
+        self.__maximum_rate = rate
+        self.__rate = rate
+        self.__burst = burst
+        self.__tokens = float(burst)
+        self.__clock = clock
+        self.__sleep = sleep
+        self.__updated = clock()
+
+    @property
+    def rate(self) -> float:
+        return self.__rate
+
+    def __refill(self):
+        now = self.__clock()
+        self.__tokens = min(self.__burst, self.__tokens + (now - self.__updated) * self.__rate)
+        self.__updated = now
+
+    def acquire(self, tokens: int = 1):
+        """Blocks until `tokens` are available and takes them"""
+        tokens = min(tokens, self.__burst)
+        self.__refill()
+        while self.__tokens < tokens:
+            self.__sleep((tokens - self.__tokens) / self.__rate)
+            self.__refill()
+        self.__tokens -= tokens
+
+    def throttled(self):
+        self.__refill()
+        self.__rate = max(MINIMUM_RATE, self.__rate / 2)
+
+    def succeeded(self):
+        self.__refill()
+        self.__rate = min(self.__maximum_rate, self.__rate + self.__maximum_rate / 10)
+
+
+def backoff(attempt: int, base: float = 0.1, cap: float = 5.0) -> float:
+    """Seconds to wait before retry `attempt`, exponential with full jitter so retries of parallel callers spread"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
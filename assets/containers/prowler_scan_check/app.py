@@ -1,35 +1,239 @@
 import os
 import boto3
+import time
 from typing import List
 import json
 import sys
 import logging
+import threading
+from duration_history import DurationHistory
+from prowler_runner import ProwlerRunner, FindingImporter, CheckResult, DEFAULT_PROWLER_PATH, DEFAULT_MAX_CONCURRENCY
+from result_cache import ResultCache, DEFAULT_TTL_SECONDS
+from scan_orchestrator import (ScanOrchestrator, load_check_services, DEFAULT_ACCOUNT_CONCURRENCY,
+                               DEFAULT_SERVICE_CONCURRENCY)
 
 logger = logging.getLogger()
 logger.setLevel(logging.DEBUG)
 
+DEFAULT_CHECK_TIMEOUT = 600
+# Left at the end of the invocation to import the last findings and return
+DEADLINE_MARGIN_SECONDS = 30
+# Jobs skipped at the deadline are published back to the fanout topic this many per message, well under SNS's 256 KB
+RESCHEDULE_BATCH_SIZE = 500
+
 
 class ProwlerScanGroup:
-    def __init__(self, topic_arn):
-        self.__topic = boto3.resource('sns').Topic(topic_arn)
+    def __init__(self, topic_arn, prowler_path: str = DEFAULT_PROWLER_PATH,
+                 max_concurrency: int = DEFAULT_MAX_CONCURRENCY, check_timeout: float = DEFAULT_CHECK_TIMEOUT,
+                 securityhub_client=None, state_bucket: str = None, s3_client=None, incremental: bool = False,
+                 cache_ttls: dict = None, default_cache_ttl: float = DEFAULT_TTL_SECONDS, targets: List[dict] = None,
+                 account_concurrency: int = DEFAULT_ACCOUNT_CONCURRENCY,
+                 service_concurrency: int = DEFAULT_SERVICE_CONCURRENCY, target_securityhub_client=None,
+                 sns_client=None):
+        self.__topic_arn = topic_arn
+        self.__sns_client = sns_client or boto3.client('sns')
         self.__region = os.environ['AWS_REGION']
+        self.__prowler_path = prowler_path
+        self.__max_concurrency = max_concurrency
+        self.__check_timeout = check_timeout
+        self.__securityhub_client = securityhub_client or boto3.client('securityhub')
+        # Findings of a target are imported in its account and region, BatchImportFindings rejects any others
+        self.__target_securityhub_client = target_securityhub_client or ProwlerScanGroup.__assumed_securityhub_client
+        # Durations recorded here let the list function pack checks into invocations
+        self.__history = None
+        self.__cache = None
+        if state_bucket is not None:
+            s3_client = s3_client or boto3.client('s3')
+            self.__history = DurationHistory(s3_client, state_bucket)
+            # Incremental scans skip checks that ran within their TTL and only import changed findings
+            if incremental:
+                self.__cache = ResultCache(s3_client, state_bucket, ttls=cache_ttls, default_ttl=default_cache_ttl)
+        elif incremental:
+            raise ValueError('incremental scanning needs a state_bucket for its result cache')
+        # Without targets only the function's own account and region are scanned
+        self.__targets = targets or None
+        self.__orchestrator_options = {'max_concurrency': max_concurrency, 'account_concurrency': account_concurrency,
+                                       'service_concurrency': service_concurrency}
+        if self.__targets is not None:
+            # The service caps apply to the services prowler says each check calls
+            self.__orchestrator_options['services'] = load_check_services(
+                os.path.join(os.path.dirname(prowler_path), 'checks'))
         logger.debug(f'topic_arn={topic_arn}')
         logger.debug(f'region={self.__region}')
 
-    def __get_check(self, check_id:str) -> str:
-        logger.debug('Executing ' + f"/prowler/prowler -r {self.__region} -c '{check_id}' -M 'json-asff' -S")
-        stream = os.popen(f"/prowler/prowler -r {self.__region} -f {self.__region} -c '{check_id}' -M 'json-asff' -S")
-        raw_out = stream.read()
-        return raw_out
+    @staticmethod
+    def __deadline(context):
+        if context is None or not hasattr(context, 'get_remaining_time_in_millis'):
+            return None
+        return time.monotonic() + context.get_remaining_time_in_millis() / 1000 - DEADLINE_MARGIN_SECONDS
+
+    @staticmethod
+    def targets(accounts: List[str], regions: List[str], role_name: str = None) -> List[dict]:
+        """Every account in every region, scanned by assuming `role_name` in the account"""
+        return [{'account': a, 'region': r, 'role_name': role_name} for a in accounts for r in regions]
+
+    @staticmethod
+    def __assumed_securityhub_client(target: dict):
+        """A Security Hub client in the target's region, with the credentials of its role when it has one"""
+        if target.get('role_name') is None:
+            return boto3.client('securityhub', region_name=target['region'])
+        partition = boto3.session.Session().get_partition_for_region(target['region'])
+        credentials = boto3.client('sts').assume_role(
+            RoleArn=f'arn:{partition}:iam::{target["account"]}:role/{target["role_name"]}',
+            RoleSessionName='ProwlerScanGroup')['Credentials']
+        return boto3.session.Session(aws_access_key_id=credentials['AccessKeyId'],
+                                     aws_secret_access_key=credentials['SecretAccessKey'],
+                                     aws_session_token=credentials['SessionToken'],
+                                     region_name=target['region']).client('securityhub')
+
+    @staticmethod
+    def __key(target: dict, check: str) -> str:
+        return check if target is None else f'{target["account"]}/{target["region"]}/{check}'
+
+    @staticmethod
+    def checks(message: str) -> List[str]:
+        """A message names one check, or is a JSON list of the checks packed into this invocation"""
+        if message.startswith('['):
+            return json.loads(message)
+        return [message]
+
+    def __pairs(self, records: list) -> list:
+        """The (target, check) pairs to run.  Checks run against every target, a message rescheduling skipped jobs is
+        a JSON object listing each job as its target with the check it runs."""
+        pairs = []
+        for r in records:
+            message = r['Sns']['Message']
+            if message.startswith('{'):
+                pairs += [({k: v for k, v in job.items() if k != 'check'}, job['check'])
+                          for job in json.loads(message)['jobs']]
+            else:
+                pairs += [(t, c) for c in ProwlerScanGroup.checks(message) for t in self.__targets or [None]]
+        return pairs
+
+    def __reschedule(self, skipped: list) -> int:
+        """Publishes the jobs skipped at the deadline back to the fanout topic, so they run in another invocation"""
+        if self.__targets is None:
+            messages = [json.dumps([r.check for _, r in skipped])]
+        else:
+            jobs = [dict(job.target, check=job.check) for job, _ in skipped]
+            messages = [json.dumps({'jobs': jobs[start:start + RESCHEDULE_BATCH_SIZE]})
+                        for start in range(0, len(jobs), RESCHEDULE_BATCH_SIZE)]
+        try:
+            for message in messages:
+                self.__sns_client.publish(TopicArn=self.__topic_arn, Message=message)
+        except Exception:
+            # They run again at the next scheduled scan
+            logger.exception(f'Failed to reschedule {len(skipped)} skipped jobs')
+            return 0
+        return len(skipped)
+
+    def __record_durations(self, results: list):
+        for r in results:
+            if r.skipped:
+                continue
+            try:
+                # A timed out check ran at least this long, recording it keeps it out of crowded invocations
+                self.__history.record(r.check, r.seconds)
+            except Exception:
+                logger.exception(f'Failed to record the duration of {r.check}')
+
+    def __run_job(self, target: dict, check: str, on_finding, deadline: float) -> CheckResult:
+        key = ProwlerScanGroup.__key(target, check)
+        runner = ProwlerRunner(target['region'], lambda _, finding: on_finding(key, finding, target),
+                               prowler_path=self.__prowler_path, account=target['account'],
+                               role_name=target.get('role_name'))
+        timeout = self.__check_timeout
+        if deadline is not None:
+            timeout = min(timeout, deadline - time.monotonic())
+        return runner.run_check(check, timeout)
+
+    def __orchestrate(self, pairs: list, on_finding, deadline: float) -> list:
+        jobs = ScanOrchestrator(lambda target, check: self.__run_job(target, check, on_finding, deadline),
+                                **self.__orchestrator_options).run_jobs(pairs, deadline=deadline)
+        results = []
+        for job in jobs:
+            result = job.result or CheckResult(job.check)
+            result.skipped = result.skipped or job.skipped
+            results.append((job, result))
+        return results
 
     def handle(self, event, context):
         logger.debug(event)
-        records = event['Records']
-        for r in records:
-            group = r['Sns']['Message']
-            logger.debug(self.__get_check(group))
+        pairs = self.__pairs(event['Records'])
+
+        cached = []
+        if self.__cache is not None:
+            due = [self.__cache.is_due(self.__key(t, c)) for t, c in pairs]
+            cached = [self.__key(t, c) for (t, c), d in zip(pairs, due) if not d]
+            pairs = [p for p, d in zip(pairs, due) if d]
+
+        # One importer for the function's own account and region, and one per target that produced findings
+        importers = {None: FindingImporter(self.__securityhub_client)}
+        importers_lock = threading.Lock()
+        unchanged = 0
+
+        def importer_of(target: dict) -> FindingImporter:
+            key = None if target is None else (target['account'], target['region'])
+            with importers_lock:
+                if key not in importers:
+                    importers[key] = FindingImporter(self.__target_securityhub_client(target))
+                return importers[key]
+
+        def on_finding(check: str, finding: dict, target: dict = None):
+            nonlocal unchanged
+            if self.__cache is None or self.__cache.changed(check, finding):
+                importer_of(target).add(finding)
+            else:
+                unchanged += 1
+
+        try:
+            if self.__targets is None:
+                runner = ProwlerRunner(self.__region, on_finding, prowler_path=self.__prowler_path,
+                                       max_concurrency=self.__max_concurrency)
+                results = [(None, r) for r in runner.run([c for _, c in pairs], self.__check_timeout,
+                                                         deadline=self.__deadline(context))]
+            else:
+                results = self.__orchestrate(pairs, on_finding, self.__deadline(context))
+        finally:
+            for importer in list(importers.values()):
+                importer.flush()
+        skipped = [(job, r) for job, r in results if r.skipped]
+        rescheduled = self.__reschedule(skipped) if len(skipped) > 0 else 0
+        # Checks are packed by how long they take in one region, runs across targets would skew that
+        if self.__history is not None and self.__targets is None:
+            self.__record_durations([r for _, r in results])
+        if self.__cache is not None:
+            # Only a complete result replaces the cached one, a partial one would forget the findings it missed
+            for job, r in results:
+                if r.completed:
+                    self.__cache.save(self.__key(job and job.target, r.check), r.started)
+
+        summary = {
+            'checks': [dict(r.to_dict(), **(job.to_dict() if job else {})) for job, r in results],
+            'cached': cached,
+            'rescheduled': rescheduled,
+            'imported': sum(i.imported for i in importers.values()),
+            'unchanged': unchanged,
+            'failed': sum(i.failed for i in importers.values())
+        }
+        logger.info(json.dumps(summary))
+        return summary
 
 
 def handler(event, context):
-    ProwlerScanGroup(topic_arn=os.environ['topic_arn']).handle(event, context)
+    ProwlerScanGroup(topic_arn=os.environ['topic_arn'],
+                     prowler_path=os.environ.get('prowler_path', DEFAULT_PROWLER_PATH),
+                     max_concurrency=int(os.environ.get('max_concurrency', DEFAULT_MAX_CONCURRENCY)),
+                     check_timeout=float(os.environ.get('check_timeout', DEFAULT_CHECK_TIMEOUT)),
+                     state_bucket=os.environ.get('state_bucket'),
+                     incremental=os.environ.get('incremental', 'false') == 'true',
+                     cache_ttls=json.loads(os.environ.get('cache_ttls', '{}')),
+                     default_cache_ttl=float(os.environ.get('default_cache_ttl', DEFAULT_TTL_SECONDS)),
+                     targets=ProwlerScanGroup.targets(json.loads(os.environ.get('accounts', '[]')),
+                                                      json.loads(os.environ.get('regions', '[]'))
+                                                      or [os.environ['AWS_REGION']],
+                                                      os.environ.get('role_name')),
+                     account_concurrency=int(os.environ.get('account_concurrency', DEFAULT_ACCOUNT_CONCURRENCY)),
+                     service_concurrency=int(os.environ.get('service_concurrency', DEFAULT_SERVICE_CONCURRENCY))
+                     ).handle(event, context)
     return 'Done: python'
@@ -0,0 +1,51 @@
+import json
+import logging
+import time
+from urllib.parse import quote
+
+logger = logging.getLogger()
+
+DEFAULT_PREFIX = 'durations'
+# Weight of the newest run in the moving average
+SMOOTHING = 0.3
+
+
+def history_key(prefix: str, check: str) -> str:
+    return f'{prefix}/{quote(check, safe="")}.json'
+
+
+class DurationHistory:
+    """Keeps an exponential moving average of how long every check runs, one object per check in the state bucket.
+
+    One object per check means scans running at the same time never overwrite each other's measurements.
+    """
+
+    def __init__(self, s3_client, bucket_name: str, prefix: str = DEFAULT_PREFIX, clock=time.time):
+        self.__s3_client = s3_client
+        self.__bucket_name = bucket_name
+        self.__prefix = prefix
+        self.__clock = clock
+
+    def get(self, check: str):
+        from botocore.exceptions import ClientError
+
+        try:
+            body = self.__s3_client.get_object(Bucket=self.__bucket_name, Key=history_key(self.__prefix, check))['Body']
+            return json.loads(body.read())
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None
+            raise
+
+    def record(self, check: str, seconds: float) -> dict:
+        previous = self.get(check)
+        if previous is not None:
+            seconds = SMOOTHING * seconds + (1 - SMOOTHING) * previous['seconds']
+        entry = {
+            'seconds': round(seconds, 3),
+            'samples': (previous or {}).get('samples', 0) + 1,
+            'updated': int(self.__clock())
+        }
+        self.__s3_client.put_object(Bucket=self.__bucket_name, Key=history_key(self.__prefix, check),
+                                    Body=json.dumps(entry).encode('utf-8'))
+        return entry
@@ -0,0 +1,168 @@
+import json
+import logging
+import os
+import re
+import signal
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger()
+
+# BatchImportFindings accepts at most 100 findings per call
+IMPORT_BATCH_SIZE = 100
+DEFAULT_PROWLER_PATH = '/prowler/prowler'
+DEFAULT_MAX_CONCURRENCY = 4
+# Errors the AWS CLI prints when an account's API rate limit is exceeded
+THROTTLING = re.compile(r'Throttling|ThrottlingException|TooManyRequestsException|RequestLimitExceeded|Rate exceeded')
+
+
+class FindingImporter:
+    """Collects findings from every running check and imports them into Security Hub 100 at a time"""
+
+    def __init__(self, securityhub_client, batch_size: int = IMPORT_BATCH_SIZE):
+        self.__securityhub_client = securityhub_client
+        self.__batch_size = batch_size
+        self.__pending = []
+        self.__lock = threading.Lock()
+        self.imported = 0
+        self.failed = 0
+
+    def add(self, finding: dict):
+        with self.__lock:
+            self.__pending.append(finding)
+            if len(self.__pending) < self.__batch_size:
+                return
+            batch = self.__pending
+            self.__pending = []
+        self.__import(batch)
+
+    def flush(self):
+        with self.__lock:
+            batch = self.__pending
+            self.__pending = []
+        if len(batch) > 0:
+            self.__import(batch)
+
+    def __import(self, batch: list):
+        response = self.__securityhub_client.batch_import_findings(Findings=batch)
+        with self.__lock:
+            self.imported += response.get('SuccessCount', 0)
+            self.failed += response.get('FailedCount', 0)
+        for f in response.get('FailedFindings', []):
+            logger.error(f'Security Hub rejected finding {f}')
+
+
+class CheckResult:
+    def __init__(self, check: str):
+        self.check = check
+        self.findings = 0
+        self.returncode = None
+        self.timed_out = False
+        self.throttled = False
+        self.skipped = False
+        self.started = None
+        self.seconds = 0.0
+
+    @property
+    def completed(self) -> bool:
+        # A throttled check may have missed findings, as much as one that timed out
+        return not (self.skipped or self.timed_out or self.throttled) and self.returncode is not None
+
+    def to_dict(self) -> dict:
+        return {'check': self.check, 'findings': self.findings, 'returncode': self.returncode,
+                'timed_out': self.timed_out, 'throttled': self.throttled, 'skipped': self.skipped,
+                'seconds': round(self.seconds, 3)}
+
+
+class ProwlerRunner:
+    """Runs Prowler checks as subprocesses, up to `max_concurrency` at a time.
+
+    Each check's json-asff output is read line by line while the check runs and every finding is handed to
+    `on_finding(check, finding)`, so the output is never held in memory as a whole.  A check still running after `timeout` seconds
+    is killed; the findings it printed until then are kept.  Given an `account` and `role_name`, Prowler assumes that
+    role to scan the account.
+    """
+
+    def __init__(self, region: str, on_finding, prowler_path: str = DEFAULT_PROWLER_PATH,
+                 max_concurrency: int = DEFAULT_MAX_CONCURRENCY, account: str = None, role_name: str = None):
+        self.__region = region
+        self.__on_finding = on_finding
+        self.__prowler_path = prowler_path
+        self.__max_concurrency = max_concurrency
+        self.__account = account
+        self.__role_name = role_name
+
+    def argv(self, check: str) -> list:
+        argv = [self.__prowler_path, '-r', self.__region, '-f', self.__region, '-c', check, '-M', 'json-asff']
+        if self.__account is not None and self.__role_name is not None:
+            argv += ['-A', self.__account, '-R', self.__role_name]
+        return argv
+
+    def run_check(self, check: str, timeout: float) -> CheckResult:
+        result = CheckResult(check)
+        result.started = time.time()
+        start = time.monotonic()
+        logger.debug(f'Executing {self.argv(check)}')
+        process = subprocess.Popen(self.argv(check), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   stdin=subprocess.DEVNULL, text=True, bufsize=1, start_new_session=True)
+
+        def read_errors():
+            for error in process.stderr:
+                if THROTTLING.search(error):
+                    result.throttled = True
+
+        errors = threading.Thread(target=read_errors, daemon=True)
+        errors.start()
+
+        def kill():
+            result.timed_out = True
+            # Prowler is a shell script, the AWS CLI calls it starts would keep stdout open if only it was killed
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+        try:
+            for line in process.stdout:
+                line = line.strip()
+                if not line.startswith('{'):
+                    if THROTTLING.search(line):
+                        result.throttled = True
+                    continue
+                try:
+                    finding = json.loads(line)
+                except ValueError:
+                    logger.warning(f'{check} printed a line that is not a finding: {line[:200]}')
+                    continue
+                self.__on_finding(check, finding)
+                result.findings += 1
+        finally:
+            timer.cancel()
+            process.stdout.close()
+            result.returncode = process.wait()
+            errors.join()
+            process.stderr.close()
+            result.seconds = time.monotonic() - start
+
+        if result.timed_out:
+            logger.warning(f'{check} timed out after {timeout} seconds with {result.findings} findings')
+        return result
+
+    def __run_before(self, check: str, timeout: float, deadline: float) -> CheckResult:
+        if deadline is not None:
+            timeout = min(timeout, deadline - time.monotonic())
+            if timeout <= 0:
+                # Queued behind slower checks until no time was left, the next scan picks it up
+                result = CheckResult(check)
+                result.skipped = True
+                return result
+        return self.run_check(check, timeout)
+
+    def run(self, checks: list, timeout: float, deadline: float = None) -> list:
+        """Runs every check with at most `timeout` seconds each, and none past `deadline` (time.monotonic)"""
+        with ThreadPoolExecutor(max_workers=self.__max_concurrency) as executor:
+            return list(executor.map(lambda check: self.__run_before(check, timeout, deadline), checks))
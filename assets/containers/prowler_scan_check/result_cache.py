@@ -0,0 +1,98 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from urllib.parse import quote
+
+logger = logging.getLogger()
+
+DEFAULT_PREFIX = 'results'
+DEFAULT_TTL_SECONDS = 6 * 3600
+# Security Hub archives findings that are not updated for 90 days, unchanged findings are still re-imported weekly
+DEFAULT_REFRESH_SECONDS = 7 * 24 * 3600
+# Scans start a little earlier or later than the schedule, a check is due slightly before its TTL ends
+TTL_SLACK = 0.1
+
+# Change on every run without the result changing
+VOLATILE_FIELDS = ('CreatedAt', 'UpdatedAt', 'FirstObservedAt', 'LastObservedAt', 'ProcessedAt')
+
+
+def fingerprint(finding: dict) -> str:
+    stable = {k: v for k, v in finding.items() if k not in VOLATILE_FIELDS}
+    return hashlib.sha256(json.dumps(stable, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """Remembers when every check last ran and a fingerprint of each finding it produced, one object per check.
+
+    A check is only due again once its TTL has passed; the TTL is the one of the longest prefix in `ttls` matching
+    the check's name, so classes of checks such as `extra7` can be given their own.  Checks of a scan target are
+    cached as `account/region/check`, their TTL is still that of `check`.  Findings whose fingerprint is unchanged since the
+    last run are not imported again, until `refresh_seconds` after they were last imported.
+    """
+
+    def __init__(self, s3_client, bucket_name: str, ttls: dict = None, default_ttl: float = DEFAULT_TTL_SECONDS,
+                 refresh_seconds: float = DEFAULT_REFRESH_SECONDS, prefix: str = DEFAULT_PREFIX, clock=time.time):
+        self.__s3_client = s3_client
+        self.__bucket_name = bucket_name
+        self.__ttls = ttls or {}
+        self.__default_ttl = default_ttl
+        self.__refresh_seconds = refresh_seconds
+        self.__prefix = prefix
+        self.__clock = clock
+        self.__entries = {}
+        self.__seen = {}
+        self.__lock = threading.Lock()
+
+    def __key(self, check: str) -> str:
+        return f'{self.__prefix}/{quote(check, safe="")}.json'
+
+    def ttl(self, check: str) -> float:
+        name = check.rsplit('/', 1)[-1]
+        matching = [prefix for prefix in self.__ttls if name.startswith(prefix)]
+        return self.__ttls[max(matching, key=len)] if matching else self.__default_ttl
+
+    def __load(self, check: str) -> dict:
+        from botocore.exceptions import ClientError
+
+        if check not in self.__entries:
+            try:
+                body = self.__s3_client.get_object(Bucket=self.__bucket_name, Key=self.__key(check))['Body']
+                self.__entries[check] = json.loads(body.read())
+            except ClientError as e:
+                if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                    raise
+                self.__entries[check] = {'last_run': 0, 'hash': None, 'findings': {}}
+        return self.__entries[check]
+
+    def is_due(self, check: str) -> bool:
+        elapsed = self.__clock() - self.__load(check)['last_run']
+        return elapsed >= self.ttl(check) * (1 - TTL_SLACK)
+
+    def changed(self, check: str, finding: dict) -> bool:
+        """Records the finding as produced by this run of `check`, returning whether it has to be imported"""
+        now = self.__clock()
+        finding_id = finding.get('Id')
+        current = fingerprint(finding)
+        previous = self.__load(check)['findings'].get(finding_id)
+        with self.__lock:
+            seen = self.__seen.setdefault(check, {})
+            if previous is not None and previous[0] == current and now - previous[1] < self.__refresh_seconds:
+                seen[finding_id] = previous
+                return False
+            seen[finding_id] = [current, now]
+            return True
+
+    def save(self, check: str, started: float):
+        """Stores the result of a completed run of `check` that started at `started`"""
+        with self.__lock:
+            findings = self.__seen.pop(check, {})
+        result_hash = hashlib.sha256(json.dumps(sorted((k or '', v[0]) for k, v in findings.items()))
+                                     .encode('utf-8')).hexdigest()
+        if result_hash == self.__load(check)['hash']:
+            logger.info(f'{check} result is unchanged')
+        entry = {'last_run': started, 'hash': result_hash, 'findings': findings}
+        self.__s3_client.put_object(Bucket=self.__bucket_name, Key=self.__key(check),
+                                    Body=json.dumps(entry).encode('utf-8'))
+        self.__entries[check] = entry
@@ -0,0 +1,236 @@
+import logging
+import os
+import random
+import re
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+logger = logging.getLogger()
+
+DEFAULT_MAX_CONCURRENCY = 8
+DEFAULT_ACCOUNT_CONCURRENCY = 4
+DEFAULT_SERVICE_CONCURRENCY = 2
+DEFAULT_MAX_ATTEMPTS = 4
+
+# Prowler numbers the CIS checks by section, each section calls mostly one service.  Only used for checks whose
+# metadata names no service
+CHECK_SERVICES = {
+    'check1': 'iam',
+    'check2': 'logging',
+    'check3': 'cloudwatch',
+    'check4': 'ec2'
+}
+
+# Every prowler check file declares the service it calls, e.g. CHECK_SERVICENAME_extra71="ec2"
+SERVICE_NAME = re.compile(r'^CHECK_SERVICENAME_(\w+)=["\']?([\w-]+)', re.MULTILINE)
+
+
+def load_check_services(checks_dir: str) -> dict:
+    """Reads the service of every check from the check files prowler ships in `checks_dir`, falling back to
+    CHECK_SERVICES for the checks that declare none"""
+    services = dict(CHECK_SERVICES)
+    if not os.path.isdir(checks_dir):
+        return services
+    for name in os.listdir(checks_dir):
+        try:
+            with open(os.path.join(checks_dir, name), errors='replace') as f:
+                services.update(SERVICE_NAME.findall(f.read()))
+        except OSError:
+            logger.warning(f'Could not read the prowler check {name}')
+    return services
+
+
+def service_of(check: str, services: dict = None) -> str:
+    """Returns the service a check mostly calls, from the longest matching check prefix, `other` when unknown"""
+    services = services or CHECK_SERVICES
+    matching = [prefix for prefix in services if check.startswith(prefix)]
+    return services[max(matching, key=len)] if matching else 'other'
+
+
+def backoff(attempt: int, base: float = 1.0, cap: float = 60.0) -> float:
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class Job:
+    def __init__(self, target: dict, check: str, service: str):
+        self.target = target
+        self.check = check
+        self.service = service
+        self.attempts = 0
+        self.throttles = 0
+        self.result = None
+        self.skipped = False
+
+    @property
+    def account(self) -> str:
+        return self.target.get('account', '')
+
+    def to_dict(self) -> dict:
+        return {'account': self.account, 'region': self.target.get('region'), 'check': self.check,
+                'attempts': self.attempts, 'throttles': self.throttles, 'skipped': self.skipped}
+
+
+class AccountQueue:
+    """Jobs of one account, with the concurrency the account currently allows.
+
+    API rate limits are per account, so throttling in one account only slows that account: its concurrency is halved
+    and it waits out a backoff before starting anything again.  Every job that finishes without throttling adds one
+    back, up to the configured cap.
+    """
+
+    def __init__(self, concurrency: int, service_concurrency: int):
+        self.jobs = deque()
+        self.maximum = concurrency
+        self.concurrency = concurrency
+        self.service_concurrency = service_concurrency
+        self.running = 0
+        self.running_by_service = {}
+        self.not_before = 0.0
+        self.consecutive_throttles = 0
+
+    def next_job(self, now: float):
+        if now < self.not_before or self.running >= self.concurrency:
+            return None
+        for job in self.jobs:
+            if self.running_by_service.get(job.service, 0) < self.service_concurrency:
+                self.jobs.remove(job)
+                return job
+        return None
+
+    def started(self, job: Job):
+        self.running += 1
+        self.running_by_service[job.service] = self.running_by_service.get(job.service, 0) + 1
+
+    def finished(self, job: Job):
+        self.running -= 1
+        self.running_by_service[job.service] -= 1
+
+    def throttled(self, now: float, backoff_seconds: float):
+        self.consecutive_throttles += 1
+        self.concurrency = max(1, self.concurrency // 2)
+        self.not_before = max(self.not_before, now + backoff_seconds)
+
+    def succeeded(self):
+        self.consecutive_throttles = 0
+        self.concurrency = min(self.maximum, self.concurrency + 1)
+
+
+class ScanOrchestrator:
+    """Runs every check against every target, a target being an account and region to scan.
+
+    `run_job(target, check)` runs one check and returns a result with a `throttled` attribute.  At most
+    `max_concurrency` jobs run at once, at most `account_concurrency` in one account and at most
+    `service_concurrency` of the checks calling one service in one account.  Accounts are served round robin and each
+    account's jobs are interleaved by service, so load spreads over accounts and APIs.  A throttled job is retried
+    after its account's backoff, up to `max_attempts` times.
+
+    The caps are per orchestrator, that is per scanner invocation.  Invocations running at the same time each apply
+    them, the scanner's reserved concurrency bounds how many do.
+    """
+
+    def __init__(self, run_job, max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+                 account_concurrency: int = DEFAULT_ACCOUNT_CONCURRENCY,
+                 service_concurrency: int = DEFAULT_SERVICE_CONCURRENCY, max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+                 services: dict = None, backoff_base: float = 1.0, clock=time.monotonic):
+        self.__run_job = run_job
+        self.__max_concurrency = max_concurrency
+        self.__account_concurrency = account_concurrency
+        self.__service_concurrency = service_concurrency
+        self.__max_attempts = max_attempts
+        self.__services = services
+        self.__backoff_base = backoff_base
+        self.__clock = clock
+
+    def __queues(self, pairs: list) -> dict:
+        checks_by_target = {}
+        for target, check in pairs:
+            key = (target.get('account', ''), target.get('region'))
+            checks_by_target.setdefault(key, (target, []))[1].append(check)
+
+        queues = {}
+        for target, checks in checks_by_target.values():
+            queue = queues.setdefault(target.get('account', ''),
+                                      AccountQueue(self.__account_concurrency, self.__service_concurrency))
+            by_service = {}
+            for check in checks:
+                service = service_of(check, self.__services)
+                by_service.setdefault(service, deque()).append(Job(target, check, service))
+            # Round robin over services, so consecutive jobs of an account call different APIs
+            while len(by_service) > 0:
+                for service in list(by_service):
+                    queue.jobs.append(by_service[service].popleft())
+                    if len(by_service[service]) == 0:
+                        del by_service[service]
+        return queues
+
+    def __next_job(self, queues: dict, order: deque, now: float):
+        for _ in range(len(order)):
+            account = order[0]
+            order.rotate(-1)
+            job = queues[account].next_job(now)
+            if job is not None:
+                return job
+        return None
+
+    def run(self, targets: list, checks: list, deadline: float = None) -> list:
+        return self.run_jobs([(target, check) for target in targets for check in checks], deadline)
+
+    def run_jobs(self, pairs: list, deadline: float = None) -> list:
+        """Runs only the given (target, check) pairs, such as the jobs an earlier run skipped at its deadline"""
+        queues = self.__queues(pairs)
+        order = deque(queues)
+        jobs = [job for queue in queues.values() for job in queue.jobs]
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=self.__max_concurrency) as executor:
+            while len(running) > 0 or any(len(q.jobs) > 0 for q in queues.values()):
+                now = self.__clock()
+                if deadline is not None and now >= deadline:
+                    break
+                while len(running) < self.__max_concurrency:
+                    job = self.__next_job(queues, order, now)
+                    if job is None:
+                        break
+                    job.attempts += 1
+                    queues[job.account].started(job)
+                    running[executor.submit(self.__run_job, job.target, job.check)] = job
+
+                waiting = [q.not_before - now for q in queues.values() if len(q.jobs) > 0 and q.not_before > now]
+                timeout = min(waiting) if len(waiting) > 0 else None
+                if deadline is not None:
+                    timeout = min(timeout if timeout is not None else deadline - now, deadline - now)
+                if len(running) == 0:
+                    time.sleep(max(0.0, timeout or 0.0))
+                    continue
+
+                done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    self.__finished(queues[running[future].account], running.pop(future), future)
+
+            # Past the deadline, the jobs still running finish and nothing else starts
+            for future in list(running):
+                self.__finished(queues[running[future].account], running.pop(future), future)
+            for queue in queues.values():
+                for job in queue.jobs:
+                    job.skipped = True
+        return jobs
+
+    def __finished(self, queue: AccountQueue, job: Job, future):
+        queue.finished(job)
+        try:
+            job.result = future.result()
+        except Exception:
+            logger.exception(f'{job.check} failed in {job.target}')
+            return
+
+        if getattr(job.result, 'throttled', False):
+            job.throttles += 1
+            seconds = backoff(queue.consecutive_throttles, base=self.__backoff_base)
+            queue.throttled(self.__clock(), seconds)
+            logger.warning(f'{job.check} was throttled in {job.account}, backing off {seconds:.1f}s '
+                           f'at concurrency {queue.concurrency}')
+            if job.attempts < self.__max_attempts:
+                queue.jobs.appendleft(job)
+        else:
+            queue.succeeded()
@@ -0,0 +1,31 @@
+import random
+import threading
+
+_clients = {}
+# Record workers ask for their first client concurrently, and building clients on the default session is not
+# thread-safe, so clients are only ever built under this lock
+_lock = threading.Lock()
+
+
+def client(service_name: str, max_pool_connections: int = 10):
+    """Creates boto3 clients on first use and shares them for the life of the container.
+
+    boto3 is imported here rather than at module level, importing it and building a client dominates cold start.
+    """
+    key = (service_name, max_pool_connections)
+    created = _clients.get(key)
+    if created is not None:
+        return created
+    with _lock:
+        if key not in _clients:
+            import boto3
+            from botocore.config import Config
+
+            _clients[key] = boto3.client(service_name, config=Config(max_pool_connections=max_pool_connections,
+                                                                     retries={'mode': 'standard'}))
+        return _clients[key]
+
+
+def backoff(attempt: int, base: float = 0.1, cap: float = 5.0) -> float:
+    """Full jitter exponential backoff, for retries of work AWS accepted only partly or rejected on a conflict"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
@@ -0,0 +1,227 @@
+"""Reprocesses historical raw objects with the same transform the Lambda runs.
+
+    python backfill.py --bucket-name <bucket> --prefix raw/firehose2021/05/ --processes 8
+    python backfill.py --bucket-name <bucket> --dry-run
+
+Keys are split into batches and transformed across a process pool.  Every finished batch is appended to the manifest,
+so running the same command again after an interruption skips the objects that were already transformed.  The result
+is printed to standard output as JSON, logs and metrics go to standard error.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from aws_clients import client
+from cmdb_enrichment import DEFAULT_TTL_SECONDS as DEFAULT_CMDB_TTL_SECONDS
+from current_state import DEFAULT_BUCKETS
+from finding_flattener import FindingFlattener
+from firehose_decoder import iter_envelopes
+from index import TransformFindings, raw_stream
+from write_suppression import DynamoDBFingerprintStore, DEFAULT_CACHE_SIZE
+
+logger = logging.getLogger()
+
+DEFAULT_BATCH_SIZE = 10
+DEFAULT_MANIFEST = 'backfill-manifest.jsonl'
+DEFAULT_SAMPLE_SIZE = 5
+
+# One TransformFindings per worker process, built by the pool initializer
+_transform_findings = None
+
+
+def _initialize_worker(bucket_name: str, transform_options: dict):
+    global _transform_findings
+    options = dict(transform_options)
+    # Clients do not cross process boundaries, every worker builds its own fingerprint store from the table name
+    fingerprint_table = options.pop('fingerprint_table', None)
+    if fingerprint_table is not None:
+        options['fingerprint_store'] = DynamoDBFingerprintStore(client('dynamodb'), fingerprint_table)
+    _transform_findings = TransformFindings(bucket_name, metrics_stream=sys.stderr, **options)
+
+
+def _transform_batch(keys: list) -> tuple:
+    failures = _transform_findings.transform(keys)
+    return keys, {key: repr(e) for key, e in failures.items()}
+
+
+class BackfillManifest:
+    """Append-only JSON lines record of the raw objects that have been transformed"""
+
+    def __init__(self, path: str):
+        self.__path = path
+
+    def completed(self) -> set:
+        if not os.path.exists(self.__path):
+            return set()
+        completed = set()
+        with open(self.__path) as manifest:
+            for line in manifest:
+                # A run killed mid-write leaves a partial last line, its batch is simply transformed again
+                try:
+                    completed.update(json.loads(line)['keys'])
+                except (ValueError, KeyError):
+                    continue
+        return completed
+
+    def record(self, keys: list):
+        with open(self.__path, 'a+b') as manifest:
+            line = json.dumps({'keys': keys, 'at': int(time.time())}).encode('utf-8') + b'\n'
+            if manifest.tell() > 0:
+                manifest.seek(-1, os.SEEK_END)
+                if manifest.read(1) != b'\n':
+                    line = b'\n' + line
+            manifest.write(line)
+            manifest.flush()
+            os.fsync(manifest.fileno())
+
+
+class Backfill:
+    def __init__(self, bucket_name: str, prefix: str = 'raw/firehose', manifest_path: str = DEFAULT_MANIFEST,
+                 processes: int = None, batch_size: int = DEFAULT_BATCH_SIZE, **transform_options):
+        self.__bucket_name = bucket_name
+        self.__prefix = prefix
+        self.__manifest = BackfillManifest(manifest_path)
+        self.__processes = processes or os.cpu_count() or 1
+        self.__batch_size = batch_size
+        self.__transform_options = transform_options
+
+    def pending_objects(self) -> list:
+        """Lists the objects under the prefix that the manifest does not record as transformed"""
+        completed = self.__manifest.completed()
+        pending = []
+        paginator = client('s3').get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.__bucket_name, Prefix=self.__prefix):
+            pending += [o for o in page.get('Contents', []) if o['Key'] not in completed]
+        return pending
+
+    def __batches(self, objects: list) -> list:
+        keys = [o['Key'] for o in objects]
+        return [keys[start:start + self.__batch_size] for start in range(0, len(keys), self.__batch_size)]
+
+    def estimate(self, sample_size: int = DEFAULT_SAMPLE_SIZE) -> dict:
+        """Decodes and flattens a sample of the pending objects without writing anything, and extrapolates how long
+        the whole backfill takes on the configured number of processes"""
+        objects = self.pending_objects()
+        sample = objects[::max(1, len(objects) // sample_size)][:sample_size]
+        flattener = FindingFlattener()
+        s3_client = client('s3')
+
+        start = time.perf_counter()
+        findings = 0
+        for o in sample:
+            body = s3_client.get_object(Bucket=self.__bucket_name, Key=o['Key'])['Body']
+            for item in iter_envelopes(raw_stream(body, o['Key'])):
+                for f in item['detail']['findings']:
+                    flattener.flatten(f)
+                    findings += 1
+        seconds = time.perf_counter() - start
+
+        sample_bytes = sum(o['Size'] for o in sample)
+        total_bytes = sum(o['Size'] for o in objects)
+        bytes_per_second = sample_bytes / seconds if seconds > 0 else 0
+        return {
+            'pending_objects': len(objects),
+            'pending_bytes': total_bytes,
+            'sample_objects': len(sample),
+            'sample_findings': findings,
+            'bytes_per_second': round(bytes_per_second),
+            'processes': self.__processes,
+            # Writing the output is not sampled, treat the estimate as a lower bound
+            'estimated_seconds': round(total_bytes / bytes_per_second / self.__processes, 1) if bytes_per_second else 0
+        }
+
+    def run(self) -> dict:
+        batches = self.__batches(self.pending_objects())
+        transformed = 0
+        failures = {}
+
+        def finished(keys: list, failed: dict):
+            nonlocal transformed
+            # Partitions and current state are shared by the whole batch, when they fail none of it is recorded as
+            # done so that running again registers and merges them
+            shared = [k for k in failed if k not in keys]
+            done = [k for k in keys if k not in failed] if len(shared) == 0 else []
+            if len(done) > 0:
+                self.__manifest.record(done)
+            transformed += len(done)
+            failures.update(failed)
+            logger.info(f'Transformed {transformed} objects, {len(failures)} failed')
+
+        if self.__processes == 1:
+            _initialize_worker(self.__bucket_name, self.__transform_options)
+            for batch in batches:
+                finished(*_transform_batch(batch))
+        else:
+            from multiprocessing import Pool
+
+            with Pool(self.__processes, _initialize_worker, (self.__bucket_name, self.__transform_options)) as pool:
+                for keys, failed in pool.imap_unordered(_transform_batch, batches):
+                    finished(keys, failed)
+
+        return {'transformed': transformed, 'failed': failures}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Transforms historical raw Security Hub findings')
+    parser.add_argument('--bucket-name', required=True)
+    parser.add_argument('--prefix', default='raw/firehose')
+    parser.add_argument('--destination-prefix', default='Findings')
+    parser.add_argument('--output-format', default='json')
+    parser.add_argument('--parquet-compression', default='snappy')
+    parser.add_argument('--output-compression', default='none')
+    parser.add_argument('--partition-layout', default='legacy')
+    parser.add_argument('--typed-output', action='store_true')
+    parser.add_argument('--keep-arrays', action='store_true')
+    parser.add_argument('--column-types', type=json.loads,
+                        help='JSON object of the column types the table declares, as the stack passes them')
+    parser.add_argument('--normalized-output', action='store_true')
+    parser.add_argument('--database-name')
+    parser.add_argument('--table-name')
+    parser.add_argument('--current-state-prefix')
+    parser.add_argument('--current-state-buckets', type=int, default=DEFAULT_BUCKETS)
+    parser.add_argument('--fingerprint-table', help='DynamoDB table of the fingerprints that suppress unchanged writes')
+    parser.add_argument('--fingerprint-cache-size', type=int, default=DEFAULT_CACHE_SIZE)
+    parser.add_argument('--heartbeat-prefix')
+    parser.add_argument('--heartbeat-table', help='Glue table the heartbeat partitions are registered in')
+    parser.add_argument('--cmdb-key')
+    parser.add_argument('--cmdb-bucket')
+    parser.add_argument('--cmdb-ttl-seconds', type=float, default=DEFAULT_CMDB_TTL_SECONDS)
+    parser.add_argument('--processes', type=int)
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--manifest', default=DEFAULT_MANIFEST)
+    parser.add_argument('--dry-run', action='store_true')
+    parser.add_argument('--sample-size', type=int, default=DEFAULT_SAMPLE_SIZE)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    backfill = Backfill(args.bucket_name, prefix=args.prefix, manifest_path=args.manifest,
+                        processes=args.processes, batch_size=args.batch_size,
+                        destination_prefix=args.destination_prefix,
+                        output_format=args.output_format,
+                        parquet_compression=args.parquet_compression,
+                        output_compression=args.output_compression,
+                        partition_layout=args.partition_layout,
+                        typed_output=args.typed_output,
+                        keep_arrays=args.keep_arrays,
+                        declared_types=args.column_types,
+                        normalized_output=args.normalized_output,
+                        database_name=args.database_name,
+                        table_name=args.table_name,
+                        current_state_prefix=args.current_state_prefix,
+                        current_state_buckets=args.current_state_buckets,
+                        fingerprint_table=args.fingerprint_table,
+                        fingerprint_cache_size=args.fingerprint_cache_size,
+                        heartbeat_prefix=args.heartbeat_prefix,
+                        heartbeat_table=args.heartbeat_table,
+                        cmdb_key=args.cmdb_key,
+                        cmdb_bucket=args.cmdb_bucket,
+                        cmdb_ttl_seconds=args.cmdb_ttl_seconds)
+    result = backfill.estimate(args.sample_size) if args.dry_run else backfill.run()
+    print(json.dumps(result, indent=2))
+    return 1 if len(result.get('failed', {})) > 0 else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
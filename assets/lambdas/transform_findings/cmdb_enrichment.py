@@ -0,0 +1,109 @@
+import csv
+import io
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger()
+
+DEFAULT_TTL_SECONDS = 300
+
+# Columns a snapshot row is read from, and the flattened columns each finding gets
+ACCOUNT_ID = 'account_id'
+RESOURCE_ARN = 'resource_arn'
+ATTRIBUTES = {'owner': 'Cmdb_Owner', 'business_unit': 'Cmdb_BusinessUnit', 'environment': 'Cmdb_Environment'}
+COLUMNS = list(ATTRIBUTES.values())
+
+
+def read_rows(object_key: str, data: bytes) -> list:
+    """Reads the rows of a CSV, JSON (an array or one object per line) or Parquet snapshot, by its extension"""
+    if object_key.endswith('.csv'):
+        return list(csv.DictReader(io.StringIO(data.decode('utf-8-sig'))))
+    if object_key.endswith('.parquet'):
+        import pyarrow.parquet
+
+        return pyarrow.parquet.read_table(io.BytesIO(data)).to_pylist()
+    if object_key.endswith('.json') or object_key.endswith('.jsonl'):
+        text = data.decode('utf-8').strip()
+        if text.startswith('['):
+            return json.loads(text)
+        return [json.loads(line) for line in text.splitlines() if len(line.strip()) > 0]
+    raise ValueError(f'{object_key} is not a .csv, .json, .jsonl or .parquet CMDB snapshot')
+
+
+class CmdbIndex:
+    """Owner, business unit and environment by resource ARN, falling back to those of the account.
+
+    Every distinct combination of attributes is held once and shared by the resources and accounts that have it,
+    snapshots repeat a few owners and environments across many resources.
+    """
+
+    def __init__(self, rows: list):
+        self.__by_arn = {}
+        self.__by_account = {}
+        interned = {}
+        for row in rows:
+            attributes = tuple((row.get(a) or None) for a in ATTRIBUTES)
+            attributes = interned.setdefault(attributes, attributes)
+            if row.get(RESOURCE_ARN):
+                self.__by_arn[row[RESOURCE_ARN]] = attributes
+            elif row.get(ACCOUNT_ID):
+                self.__by_account[str(row[ACCOUNT_ID])] = attributes
+        self.__unknown = (None,) * len(ATTRIBUTES)
+
+    def __len__(self) -> int:
+        return len(self.__by_arn) + len(self.__by_account)
+
+    def lookup(self, finding: dict) -> dict:
+        """The CMDB columns of a finding, from its first known resource, or its account.  None when unknown"""
+        attributes = None
+        for resource in finding.get('Resources') or []:
+            attributes = self.__by_arn.get(resource.get('Id'))
+            if attributes is not None:
+                break
+        if attributes is None:
+            attributes = self.__by_account.get(finding.get('AwsAccountId'), self.__unknown)
+        return dict(zip(COLUMNS, attributes))
+
+
+class CmdbSnapshot:
+    """The CMDB snapshot in S3, loaded once per container and reloaded when its ETag changes.
+
+    The ETag is checked at most every `ttl_seconds`.  When a reload fails the index already loaded is kept, the
+    findings are enriched from a slightly stale snapshot rather than not transformed at all.
+    """
+
+    def __init__(self, s3_client, bucket_name: str, object_key: str, ttl_seconds: float = DEFAULT_TTL_SECONDS,
+                 clock=time.monotonic):
+        self.__s3_client = s3_client
+        self.__bucket_name = bucket_name
+        self.__object_key = object_key
+        self.__ttl_seconds = ttl_seconds
+        self.__clock = clock
+        self.__lock = threading.Lock()
+        self.__index = None
+        self.__etag = None
+        self.__checked = None
+
+    def __refresh(self):
+        etag = self.__s3_client.head_object(Bucket=self.__bucket_name, Key=self.__object_key)['ETag']
+        if etag != self.__etag:
+            response = self.__s3_client.get_object(Bucket=self.__bucket_name, Key=self.__object_key,
+                                                   IfMatch=etag)
+            self.__index = CmdbIndex(read_rows(self.__object_key, response['Body'].read()))
+            self.__etag = etag
+            logger.info(f'Loaded {len(self.__index)} CMDB entries from {self.__object_key} ({etag})')
+
+    def index(self) -> CmdbIndex:
+        with self.__lock:
+            now = self.__clock()
+            if self.__checked is None or now - self.__checked >= self.__ttl_seconds:
+                try:
+                    self.__refresh()
+                except Exception:
+                    if self.__index is None:
+                        raise
+                    logger.exception(f'Failed to reload {self.__object_key}, keeping the snapshot {self.__etag}')
+                self.__checked = now
+            return self.__index
@@ -0,0 +1,98 @@
+import json
+import re
+from datetime import datetime, timedelta, timezone
+
+BOOLEAN = 'boolean'
+BIGINT = 'bigint'
+DOUBLE = 'double'
+TIMESTAMP = 'timestamp'
+STRING = 'string'
+ARRAY = 'array<string>'
+
+# ASFF timestamps are ISO 8601 with a Z or numeric offset and any number of fractional digits
+ISO_TIMESTAMP = re.compile(r'^(\d{4}-\d{2}-\d{2})T(\d{2}:\d{2}:\d{2})(?:\.(\d+))?(Z|[+-]\d{2}:?\d{2})$')
+
+
+def parse_timestamp(value: str):
+    """Returns the UTC datetime of an ISO 8601 timestamp, or None when `value` is not one"""
+    match = ISO_TIMESTAMP.match(value)
+    if match is None:
+        return None
+    date, time, fraction, offset = match.groups()
+    try:
+        parsed = datetime.strptime(f'{date}T{time}', '%Y-%m-%dT%H:%M:%S')
+    except ValueError:
+        return None
+    parsed = parsed.replace(microsecond=int((fraction or '0')[:6].ljust(6, '0')), tzinfo=timezone.utc)
+    if offset != 'Z':
+        sign = -1 if offset[0] == '-' else 1
+        hours, minutes = int(offset[1:3]), int(offset[-2:])
+        parsed -= sign * timedelta(hours=hours, minutes=minutes)
+    return parsed
+
+
+def format_timestamp(value: datetime) -> str:
+    """Formats as UTC with millisecond precision, which Athena parses and which sorts as text"""
+    value = value.astimezone(timezone.utc) if value.tzinfo is not None else value
+    return value.strftime('%Y-%m-%dT%H:%M:%S.') + f'{value.microsecond // 1000:03d}Z'
+
+
+def kind(value) -> str:
+    if isinstance(value, bool):
+        return BOOLEAN
+    if isinstance(value, int):
+        return BIGINT
+    if isinstance(value, float):
+        return DOUBLE
+    if isinstance(value, str) and ISO_TIMESTAMP.match(value) is not None:
+        return TIMESTAMP
+    return STRING
+
+
+def widen(current: str, new: str) -> str:
+    """Returns the narrowest type that holds values of both types, numbers widen to double and anything else that
+    disagrees to string"""
+    if current == new:
+        return current
+    if {current, new} == {BIGINT, DOUBLE}:
+        return DOUBLE
+    return STRING
+
+
+def coerce(value, column_type: str):
+    """Converts a value inferred as a narrower type to `column_type`"""
+    if value is None:
+        return None
+    if column_type == DOUBLE and not isinstance(value, bool) and isinstance(value, int):
+        return float(value)
+    if column_type == STRING and isinstance(value, list):
+        return json.dumps(value)
+    if column_type == STRING and not isinstance(value, str):
+        return str(value)
+    return value
+
+
+def conform(value, column_type: str):
+    """Converts a value to the type its column is declared with, None when it holds no value of that type"""
+    if value is None:
+        return None
+    if column_type == TIMESTAMP:
+        parsed = parse_timestamp(value) if isinstance(value, str) else None
+        return format_timestamp(parsed) if parsed is not None else None
+    if column_type in (BIGINT, DOUBLE):
+        if isinstance(value, bool):
+            return None
+        if column_type == BIGINT and isinstance(value, int):
+            return value
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            return None
+        if column_type == DOUBLE:
+            return number
+        return int(number) if number.is_integer() else None
+    if column_type == BOOLEAN:
+        return value if isinstance(value, bool) else {'true': True, 'false': False}.get(str(value).lower())
+    if column_type == ARRAY:
+        return [str(value)]
+    return coerce(value, STRING)
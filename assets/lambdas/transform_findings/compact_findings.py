@@ -0,0 +1,350 @@
+import gzip
+import io
+import json
+import logging
+from datetime import datetime, timedelta, timezone
+from os import environ
+from aws_clients import client
+from s3_object_writer import S3ObjectWriter, GZIP, ZSTD, NONE
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+DEFAULT_TARGET_SIZE = 128 * 1024 * 1024
+DEFAULT_QUIET_MINUTES = 120
+DELETE_BATCH_SIZE = 1000
+# Written to the source partition before merging and marked committed once the merged objects are served, so a run
+# that crashed half way is rolled back or forward by the next one.  Athena skips objects starting with an underscore
+MANIFEST = '_compaction.json'
+# Written under the source prefix after every run, the next one only lists the hours closed since
+WATERMARK = '_compaction_watermark.json'
+# Account, product and region, the directories above the time of every partition in either layout
+PARTITION_KEY_DEPTH = 3
+
+COMPRESSIONS = {
+    '.gz': GZIP,
+    '.zst': ZSTD
+}
+
+
+def split_extension(key: str):
+    """Returns the file extension of an output object and the compression its stream was written with"""
+    name = key.rsplit('/', 1)[-1]
+    for suffix, compression in COMPRESSIONS.items():
+        if name.endswith(suffix):
+            return name[:-len(suffix)].rsplit('.', 1)[-1] + suffix, compression
+    return name.rsplit('.', 1)[-1], NONE
+
+
+class CompactFindings:
+    """Merges the many small objects of each closed partition under `source_prefix` into a few large ones.
+
+    A partition is closed once nothing has been written to it for `quiet_minutes`.  Its objects are packed into
+    bins of up to `target_size` bytes and every bin is rewritten as one object.
+
+    When the partition is registered in the Glue table, the objects it currently points at are merged with the ones
+    written to `source_prefix` since, into a new generation under `compacted_prefix`.  The partition is repointed at
+    it with one UpdatePartition call, so queries see either the old objects or the merged ones, never both.  Only then
+    are the merged objects deleted.  Partitions Glue does not know about, such as when running locally, are merged in
+    place; that is not atomic, a query running between the write and the delete can see both copies.
+
+    Either way a manifest records the generation and the objects it replaces before anything is written.  When a run
+    dies before the merged objects are served, the next one deletes them and merges again; when it dies after, the
+    next one finishes deleting the objects they replace.  Merged rows are never read twice.
+
+    Only the first run lists every object under `source_prefix`.  Later ones list the hours, or in the legacy layout
+    the days, that closed since the watermark the previous run left, going back one quiet period to catch stragglers.
+    After a backfill wrote to older partitions, invoke it with `{"full_scan": true}`.
+    """
+
+    def __init__(self, bucket_name: str, source_prefix: str = 'Findings', compacted_prefix: str = 'Compacted',
+                 target_size: int = DEFAULT_TARGET_SIZE, quiet_minutes: int = DEFAULT_QUIET_MINUTES,
+                 database_name: str = None, table_name: str = None):
+        self.__bucket_name = bucket_name
+        self.__source_prefix = source_prefix.rstrip('/')
+        self.__compacted_prefix = compacted_prefix.rstrip('/')
+        self.__target_size = target_size
+        self.__quiet_period = timedelta(minutes=quiet_minutes)
+        self.__database_name = database_name
+        self.__table_name = table_name
+
+    @property
+    def __s3_client(self):
+        return client('s3')
+
+    @property
+    def __glue_client(self):
+        return client('glue')
+
+    def __list_all_partitions(self) -> dict:
+        partitions = {}
+        paginator = self.__s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.__bucket_name, Prefix=self.__source_prefix + '/'):
+            for o in page.get('Contents', []):
+                partition, _, name = o['Key'].rpartition('/')
+                if not name.startswith('_'):
+                    partitions.setdefault(partition, []).append(o)
+        return partitions
+
+    def __walk(self, prefix: str, depth: int) -> list:
+        """The directories `depth` levels below `prefix`"""
+        prefixes = [prefix]
+        paginator = self.__s3_client.get_paginator('list_objects_v2')
+        for _ in range(depth):
+            prefixes = [c['Prefix'].rstrip('/') for p in prefixes
+                        for page in paginator.paginate(Bucket=self.__bucket_name, Prefix=p + '/', Delimiter='/')
+                        for c in page.get('CommonPrefixes', [])]
+        return prefixes
+
+    @staticmethod
+    def __time_prefixes(root: str, since: datetime, until: datetime) -> list:
+        """The partitions below an account, product and region written between `since` and `until`"""
+        if root.rsplit('/', 1)[-1].startswith('region='):
+            hours = []
+            while since < until:
+                hours.append(f'{root}/year={since:%Y}/month={since:%m}/day={since:%d}/hour={since:%H}')
+                since += timedelta(hours=1)
+            return hours
+        # The legacy layout only has month and day, a day is listed until its last hour closed
+        days = []
+        day = since.date()
+        while day <= until.date():
+            days.append(f'{root}/{day:%m}/{day:%d}')
+            day += timedelta(days=1)
+        return days
+
+    def __list_partitions(self, since: datetime, until: datetime) -> dict:
+        partitions = {}
+        for root in self.__walk(self.__source_prefix, PARTITION_KEY_DEPTH):
+            for prefix in CompactFindings.__time_prefixes(root, since, until):
+                objects = self.__list_keys(prefix)
+                if len(objects) > 0:
+                    partitions[prefix] = objects
+        return partitions
+
+    def __read_watermark(self):
+        s3 = self.__s3_client
+        try:
+            body = s3.get_object(Bucket=self.__bucket_name, Key=f'{self.__source_prefix}/{WATERMARK}')['Body'].read()
+        except s3.exceptions.NoSuchKey:
+            return None
+        return datetime.fromisoformat(json.loads(body)['until'])
+
+    def __write_watermark(self, until: datetime):
+        self.__s3_client.put_object(Bucket=self.__bucket_name, Key=f'{self.__source_prefix}/{WATERMARK}',
+                                    Body=json.dumps({'until': until.isoformat()}).encode('utf-8'))
+
+    def __is_closed(self, objects: list) -> bool:
+        newest = max(o['LastModified'] for o in objects)
+        return datetime.now(timezone.utc) - newest >= self.__quiet_period
+
+    def __bins(self, objects: list) -> list:
+        bins = []
+        size = 0
+        for o in sorted(objects, key=lambda o: o['Key']):
+            if len(bins) == 0 or size + o['Size'] > self.__target_size:
+                bins.append([])
+                size = 0
+            bins[-1].append(o)
+            size += o['Size']
+        return bins
+
+    def __open(self, key: str, compression: str):
+        body = self.__s3_client.get_object(Bucket=self.__bucket_name, Key=key)['Body']
+        if compression == GZIP:
+            return gzip.GzipFile(fileobj=body)
+        if compression == ZSTD:
+            import zstandard
+            return zstandard.ZstdDecompressor().stream_reader(body)
+        return body
+
+    def __merge_json(self, objects: list, destination: str, compression: str):
+        with S3ObjectWriter(self.__s3_client, self.__bucket_name, destination, compression=compression) as writer:
+            for o in objects:
+                stream = self.__open(o['Key'], compression)
+                last = b'\n'
+                for chunk in iter(lambda: stream.read(1024 * 1024), b''):
+                    writer.write(chunk)
+                    last = chunk[-1:]
+                if last != b'\n':
+                    writer.write(b'\n')
+
+    @staticmethod
+    def __concat(tables: list):
+        import pyarrow
+
+        # Typed output widens a column from integer to double, or to string when values disagree, between objects
+        try:
+            return pyarrow.concat_tables(tables, promote_options='permissive')
+        except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+            types = {}
+            for t in tables:
+                for field in t.schema:
+                    if not pyarrow.types.is_null(field.type):
+                        types.setdefault(field.name, set()).add(field.type)
+            conflicts = {name for name, found in types.items() if len(found) > 1}
+            tables = [t.cast(pyarrow.schema([f.with_type(pyarrow.string()) if f.name in conflicts else f
+                                             for f in t.schema])) for t in tables]
+            return pyarrow.concat_tables(tables, promote_options='permissive')
+
+    def __merge_parquet(self, objects: list, destination: str):
+        import pyarrow
+        import pyarrow.parquet
+
+        files = [pyarrow.parquet.ParquetFile(io.BytesIO(self.__open(o['Key'], NONE).read())) for o in objects]
+        table = self.__concat([f.read() for f in files])
+        compression = files[0].metadata.row_group(0).column(0).compression
+        with S3ObjectWriter(self.__s3_client, self.__bucket_name, destination) as writer:
+            pyarrow.parquet.write_table(table, writer, compression=compression.lower(), use_dictionary=True)
+
+    def __partition_values(self, partition: str, table: dict) -> list:
+        location = table['StorageDescriptor']['Location'].split(f's3://{self.__bucket_name}/', 1)[-1].strip('/')
+        relative = partition[len(location):].strip('/') if partition.startswith(location) else partition
+        return [segment.split('=', 1)[-1] for segment in relative.split('/')]
+
+    def __registered_partition(self, partition: str):
+        if self.__database_name is None or self.__table_name is None:
+            return None
+        glue = self.__glue_client
+        try:
+            table = glue.get_table(DatabaseName=self.__database_name, Name=self.__table_name)['Table']
+            values = self.__partition_values(partition, table)
+            return glue.get_partition(DatabaseName=self.__database_name,
+                                      TableName=self.__table_name,
+                                      PartitionValues=values)['Partition']
+        except glue.exceptions.EntityNotFoundException:
+            return None
+
+    def __swap_location(self, registered: dict, location: str):
+        storage_descriptor = dict(registered['StorageDescriptor'], Location=location)
+        self.__glue_client.update_partition(DatabaseName=self.__database_name,
+                                            TableName=self.__table_name,
+                                            PartitionValueList=registered['Values'],
+                                            PartitionInput={
+                                                'Values': registered['Values'],
+                                                'StorageDescriptor': storage_descriptor,
+                                                'Parameters': registered.get('Parameters', {})
+                                            })
+
+    def __delete(self, keys: list):
+        for start in range(0, len(keys), DELETE_BATCH_SIZE):
+            self.__s3_client.delete_objects(Bucket=self.__bucket_name, Delete={
+                'Objects': [{'Key': k} for k in keys[start:start + DELETE_BATCH_SIZE]],
+                'Quiet': True
+            })
+
+    def __read_manifest(self, partition: str):
+        s3 = self.__s3_client
+        try:
+            body = s3.get_object(Bucket=self.__bucket_name, Key=f'{partition}/{MANIFEST}')['Body'].read()
+        except s3.exceptions.NoSuchKey:
+            return None
+        return json.loads(body)
+
+    def __write_manifest(self, partition: str, manifest: dict):
+        self.__s3_client.put_object(Bucket=self.__bucket_name, Key=f'{partition}/{MANIFEST}',
+                                    Body=json.dumps(manifest).encode('utf-8'))
+
+    def __list_keys(self, prefix: str) -> list:
+        paginator = self.__s3_client.get_paginator('list_objects_v2')
+        return [o for page in paginator.paginate(Bucket=self.__bucket_name, Prefix=prefix + '/')
+                for o in page.get('Contents', []) if not o['Key'].rsplit('/', 1)[-1].startswith('_')]
+
+    def __recover(self, partition: str, location: str, objects: list) -> list:
+        """Finishes or undoes the compaction a previous run left behind, returning the objects still in place"""
+        manifest = self.__read_manifest(partition)
+        if manifest is None:
+            return objects
+        # A generation is served once it is marked committed, or once the partition points at it
+        if manifest['committed'] or (manifest['location'] != partition and manifest['location'] == location):
+            done = set(manifest['replaced'])
+            logger.info(f'Deleting the objects generation {manifest["generation"]} of {partition} replaced')
+        else:
+            generation = manifest['generation']
+            done = {o['Key'] for o in (objects if manifest['location'] == partition
+                                       else self.__list_keys(manifest['location']))
+                    if o['Key'].rsplit('/', 1)[-1].startswith(f'compacted-{generation}-')}
+            logger.info(f'Deleting the uncommitted generation {generation} of {partition}')
+        self.__delete(sorted(done))
+        return [o for o in objects if o['Key'] not in done]
+
+    def compact_partition(self, partition: str, objects: list) -> list:
+        generation = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%fZ')
+        registered = self.__registered_partition(partition)
+        location = partition
+        if registered is not None:
+            location = registered['StorageDescriptor']['Location'].split(f's3://{self.__bucket_name}/', 1)[-1]
+            location = location.strip('/')
+        objects = self.__recover(partition, location, objects)
+        if all(o['Key'].rsplit('/', 1)[-1].startswith('compacted-') for o in objects):
+            return []
+        if location != partition:
+            # Rows compacted by earlier runs are merged with the late arrivals, the new generation replaces them all
+            objects = objects + self.__list_keys(location)
+        elif len(objects) < 2:
+            return []
+        if registered is not None:
+            destination = f'{self.__compacted_prefix}/{partition[len(self.__source_prefix) + 1:]}/{generation}'
+        else:
+            destination = partition
+        manifest = {'generation': generation, 'location': destination, 'replaced': [o['Key'] for o in objects],
+                    'committed': False}
+        self.__write_manifest(partition, manifest)
+
+        written = []
+        for extension in sorted({split_extension(o['Key'])[0] for o in objects}):
+            matching = [o for o in objects if split_extension(o['Key'])[0] == extension]
+            compression = split_extension(matching[0]['Key'])[1]
+            for index, merged in enumerate(self.__bins(matching)):
+                key = f'{destination}/compacted-{generation}-{index:04d}.{extension}'
+                if extension.startswith('parquet'):
+                    self.__merge_parquet(merged, key)
+                else:
+                    self.__merge_json(merged, key, compression)
+                written.append(key)
+
+        if registered is not None:
+            self.__swap_location(registered, f's3://{self.__bucket_name}/{destination}/')
+        self.__write_manifest(partition, dict(manifest, committed=True))
+        self.__delete([k for k in manifest['replaced'] if k not in written])
+        logger.info(f'Compacted {len(objects)} objects in {partition} into {len(written)}')
+        return written
+
+    def handle(self, event, context):
+        # Hours that ended a quiet period ago are closed
+        until = (datetime.now(timezone.utc) - self.__quiet_period).replace(minute=0, second=0, microsecond=0)
+        watermark = None if (event or {}).get('full_scan') else self.__read_watermark()
+        if watermark is None:
+            partitions = self.__list_all_partitions()
+        else:
+            since = (watermark - self.__quiet_period).replace(minute=0, second=0, microsecond=0)
+            partitions = self.__list_partitions(since, until)
+
+        compacted = {}
+        for partition, objects in partitions.items():
+            pending = [o for o in objects if not o['Key'].rsplit('/', 1)[-1].startswith('compacted-')]
+            if len(pending) == 0 or not self.__is_closed(objects):
+                continue
+            written = self.compact_partition(partition, objects)
+            if len(written) > 0:
+                compacted[partition] = written
+        self.__write_watermark(until)
+        return {'compacted_partitions': len(compacted)}
+
+
+def handler(event, context):
+    options = {
+        'bucket_name': environ['bucket_name'],
+        'target_size': int(environ.get('target_size', DEFAULT_TARGET_SIZE)),
+        'quiet_minutes': int(environ.get('quiet_minutes', DEFAULT_QUIET_MINUTES)),
+        'database_name': environ.get('database_name')
+    }
+    compacted_prefix = environ.get('compacted_prefix', 'Compacted')
+    result = CompactFindings(source_prefix=environ['destination_prefix'], compacted_prefix=compacted_prefix,
+                             table_name=environ.get('table_name'), **options).handle(event, context)
+    # The child tables of normalized output, by the prefix they are written under
+    for prefix, table_name in json.loads(environ.get('child_tables', '{}')).items():
+        child = CompactFindings(source_prefix=prefix, compacted_prefix=f'{compacted_prefix}/{prefix}',
+                                table_name=table_name, **options).handle(event, context)
+        result['compacted_partitions'] += child['compacted_partitions']
+    return result
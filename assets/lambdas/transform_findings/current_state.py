@@ -0,0 +1,115 @@
+import io
+import logging
+import time
+import zlib
+from datetime import datetime, timezone
+from aws_clients import backoff
+from column_types import parse_timestamp
+from s3_object_writer import compress, decompress, EXTENSIONS, NONE
+
+logger = logging.getLogger()
+
+# Per account, product and region.  A bucket is rewritten whole by every batch that changes one of its findings,
+# about ten thousand findings per bucket keeps that cheap
+DEFAULT_BUCKETS = 4
+MAXIMUM_ATTEMPTS = 8
+
+# Returned when another writer replaced or created the object since it was read
+CONFLICT_CODES = ('PreconditionFailed', 'ConditionalRequestConflict')
+
+
+def id_bucket(finding_id: str, buckets: int) -> int:
+    return zlib.crc32(finding_id.encode('utf-8')) % buckets
+
+
+def updated_at(row: dict) -> tuple:
+    """Orders rows by the instant they were updated at, whatever precision and offset the timestamp is written with.
+    Values that are not timestamps sort before any that are, as text"""
+    value = row.get('UpdatedAt')
+    if isinstance(value, datetime):
+        return 1, value if value.tzinfo is not None else value.replace(tzinfo=timezone.utc), ''
+    parsed = parse_timestamp(value) if isinstance(value, str) else None
+    if parsed is None:
+        return 0, datetime.min.replace(tzinfo=timezone.utc), str(value if value is not None else '')
+    return 1, parsed, ''
+
+
+def keep_newest(latest: dict, rows: list) -> dict:
+    """Keeps the latest version of every finding in `latest`, ordered by UpdatedAt, later rows win ties"""
+    for row in rows:
+        current = latest.get(row['Id'])
+        if current is None or updated_at(row) >= updated_at(current):
+            latest[row['Id']] = row
+    return latest
+
+
+def newest(rows: list) -> dict:
+    return keep_newest({}, rows)
+
+
+class CurrentStateSnapshot:
+    """Maintains the latest version of every finding under `prefix`, partitioned like the output by account, product
+    and region, and within a partition one object per hash bucket of the finding Id.
+
+    Each batch only rewrites the buckets of the partitions it has findings of, so invocations transforming other
+    accounts never touch the same objects.  A bucket is read, merged and written back with a conditional PUT on the
+    ETag it was read with; when a concurrent invocation got there first the merge is retried against the new object
+    after a jittered backoff.
+    """
+
+    def __init__(self, s3_client, bucket_name: str, output_format, prefix: str = 'Current',
+                 buckets: int = DEFAULT_BUCKETS, compression: str = NONE, sleep=time.sleep):
+        self.__s3_client = s3_client
+        self.__bucket_name = bucket_name
+        self.__output_format = output_format
+        self.__prefix = prefix
+        self.__buckets = buckets
+        self.__compression = compression
+        self.__sleep = sleep
+
+    def key(self, output_key: str, bucket: int) -> str:
+        account_id, product_name, region = output_key.split('/')
+        return (f'{self.__prefix}/account={account_id}/product={product_name}/region={region}/'
+                f'id_bucket={bucket:04d}/current.{self.__output_format.extension}{EXTENSIONS[self.__compression]}')
+
+    def __read(self, key: str):
+        from botocore.exceptions import ClientError
+
+        try:
+            response = self.__s3_client.get_object(Bucket=self.__bucket_name, Key=key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return [], None
+            raise
+        data = decompress(response['Body'].read(), self.__compression)
+        return self.__output_format.read(data), response['ETag']
+
+    def merge_bucket(self, output_key: str, bucket: int, rows: list):
+        from botocore.exceptions import ClientError
+
+        key = self.key(output_key, bucket)
+        for attempt in range(MAXIMUM_ATTEMPTS):
+            existing, etag = self.__read(key)
+            merged = newest(existing + rows)
+
+            body = io.BytesIO()
+            self.__output_format.write(list(merged.values()), body)
+            condition = {'IfMatch': etag} if etag is not None else {'IfNoneMatch': '*'}
+            try:
+                self.__s3_client.put_object(Bucket=self.__bucket_name, Key=key,
+                                            Body=compress(body.getvalue(), self.__compression), **condition)
+                return
+            except ClientError as e:
+                if e.response['Error']['Code'] not in CONFLICT_CODES:
+                    raise
+                logger.info(f'{key} changed while merging, retrying (attempt {attempt + 1})')
+                self.__sleep(backoff(attempt))
+        raise RuntimeError(f'Could not merge {key} after {MAXIMUM_ATTEMPTS} attempts')
+
+    def partition(self, latest: dict) -> dict:
+        """Groups the newest rows of every output key by the (output key, bucket) they are merged into"""
+        buckets = {}
+        for output_key, rows in latest.items():
+            for finding_id, row in rows.items():
+                buckets.setdefault((output_key, id_bucket(finding_id, self.__buckets)), []).append(row)
+        return buckets
@@ -0,0 +1,115 @@
+import re
+import threading
+from column_types import kind, widen, conform, parse_timestamp, format_timestamp, ARRAY, STRING, TIMESTAMP
+
+NON_WORD = re.compile(r'\W')
+
+# The same few hundred ASFF paths repeat in every finding, the limit only guards against unbounded ProductFields keys
+MAXIMUM_CACHED_COLUMNS = 100000
+
+
+class FindingFlattener:
+    """Flattens a finding into Athena consumable columns in a single pass.
+
+    Produces the same columns and values as `flatten_json.flatten` followed by `TransformFindings.fix_dictionary`:
+    nested keys are joined with `_`, list elements are addressed by index, non word characters in keys become `_`
+    and every value is converted with `str`.
+
+    With `typed` set numbers and booleans are kept, timestamps are normalized to UTC with millisecond precision and
+    empty values become null.  The type of every column is inferred from the first value seen and cached, so it stays
+    the same across batches; a later value that disagrees widens the column, integers to double and anything else to
+    string, and `column_types` reports the widened type.  With `keep_arrays` also set, lists of scalars such as
+    `Types` are kept as one array of strings instead of a column per element.
+
+    Columns in `declared_types`, the types the Glue table declares, are never inferred: their values are converted to
+    the declared type, or null when they hold none, so every object agrees with the table whatever values it holds.
+    """
+
+    def __init__(self, typed: bool = False, keep_arrays: bool = False, declared_types: dict = None):
+        if keep_arrays and not typed:
+            raise ValueError('keep_arrays requires typed output')
+        self.__columns = {}
+        self.__typed = typed
+        self.__keep_arrays = keep_arrays
+        self.__declared_types = dict(declared_types or {})
+        self.__types = dict(self.__declared_types)
+        self.__types_lock = threading.Lock()
+
+    @property
+    def typed(self) -> bool:
+        return self.__typed
+
+    @property
+    def column_types(self) -> dict:
+        """Inferred type of every column seen so far"""
+        with self.__types_lock:
+            return dict(self.__types)
+
+    def __column(self, parent, key):
+        try:
+            return self.__columns[(parent, key)]
+        except KeyError:
+            raw = f'{parent}_{key}' if parent else key
+            column = NON_WORD.sub('_', raw) if isinstance(raw, str) else str(raw)
+            if len(self.__columns) >= MAXIMUM_CACHED_COLUMNS:
+                self.__columns.clear()
+            self.__columns[(parent, key)] = column
+            return column
+
+    def __flatten(self, value, column: str, output: dict):
+        if not value:
+            output[column] = str(value)
+        elif isinstance(value, dict):
+            for key in value:
+                self.__flatten(value[key], self.__column(column, key), output)
+        elif isinstance(value, (list, set, tuple)):
+            for index, item in enumerate(value):
+                self.__flatten(item, self.__column(column, index), output)
+        else:
+            output[column] = str(value)
+
+    def __infer(self, column: str, value_kind: str):
+        with self.__types_lock:
+            current = self.__types.get(column)
+            if current is None:
+                # Unlike column names a wrong type cannot be recomputed, so the cache is only bounded, never cleared
+                if len(self.__types) < MAXIMUM_CACHED_COLUMNS:
+                    self.__types[column] = value_kind
+                return value_kind
+            if current != value_kind and column not in self.__declared_types:
+                current = self.__types[column] = widen(current, value_kind)
+            return current
+
+    def __flatten_typed(self, value, column: str, output: dict):
+        if value is None or (isinstance(value, (dict, list, set, tuple)) and len(value) == 0):
+            output[column] = None
+        elif isinstance(value, dict):
+            for key in value:
+                self.__flatten_typed(value[key], self.__column(column, key), output)
+        elif isinstance(value, (list, set, tuple)):
+            if self.__keep_arrays and not any(isinstance(i, (dict, list, set, tuple)) for i in value):
+                self.__infer(column, ARRAY)
+                output[column] = [None if i is None else str(i) for i in value]
+            else:
+                for index, item in enumerate(value):
+                    self.__flatten_typed(item, self.__column(column, index), output)
+        elif column in self.__declared_types:
+            output[column] = conform(value, self.__declared_types[column])
+        else:
+            value_kind = kind(value)
+            if value_kind == TIMESTAMP:
+                parsed = parse_timestamp(value)
+                if parsed is None:
+                    value_kind = STRING
+                elif self.__infer(column, value_kind) == TIMESTAMP:
+                    output[column] = format_timestamp(parsed)
+                    return
+            self.__infer(column, value_kind)
+            output[column] = value
+
+    def flatten(self, finding: dict) -> dict:
+        output = {}
+        flatten = self.__flatten_typed if self.__typed else self.__flatten
+        for key in finding:
+            flatten(finding[key], self.__column(None, key), output)
+        return output
@@ -0,0 +1,66 @@
+import json
+from column_types import BIGINT
+
+FINDINGS = 'findings'
+FINDING_RESOURCES = 'finding_resources'
+FINDING_TYPES = 'finding_types'
+FINDING_RELATED_FINDINGS = 'finding_related_findings'
+CHILD_TABLES = (FINDING_RESOURCES, FINDING_TYPES, FINDING_RELATED_FINDINGS)
+
+# Columns every child row is keyed by.  A finding is re-imported under the same Id, its UpdatedAt tells the versions
+# apart
+KEY_COLUMNS = ('FindingId', 'FindingUpdatedAt', 'Position')
+# Column types of typed child rows, every other child column is a string
+CHILD_COLUMN_TYPES = {'Position': BIGINT}
+
+
+def to_json(value):
+    """Nested values are kept as one JSON column, whatever keys they have"""
+    if isinstance(value, (dict, list, set, tuple)):
+        return json.dumps(value, sort_keys=True, default=str)
+    return value
+
+
+def _without_lists(value):
+    if isinstance(value, dict):
+        return {k: _without_lists(v) for k, v in value.items()}
+    if isinstance(value, (list, set, tuple)):
+        return to_json(list(value)) if len(value) > 0 else None
+    return value
+
+
+class FindingNormalizer:
+    """Splits a finding into a narrow `findings` row and rows of child tables keyed by the finding's Id.
+
+    Resources, Types and RelatedFindings become rows of `finding_resources`, `finding_types` and
+    `finding_related_findings`, a resource's Details, Tags and other nested values a JSON column each.  Any other list
+    in the finding is kept as a JSON column of the findings row, so no list is ever expanded into a column per
+    element and the number of columns stays bounded whatever products and resource types appear.  The rest of the
+    finding is flattened as usual.
+    """
+
+    def __init__(self, flattener):
+        self.__flattener = flattener
+
+    @staticmethod
+    def __key(finding: dict, position: int) -> dict:
+        return {'FindingId': finding.get('Id'), 'FindingUpdatedAt': finding.get('UpdatedAt'), 'Position': position}
+
+    @staticmethod
+    def __children(finding: dict) -> dict:
+        children = {
+            FINDING_RESOURCES: [dict(FindingNormalizer.__key(finding, i), **{k: to_json(v) for k, v in r.items()})
+                                for i, r in enumerate(finding.get('Resources') or [])],
+            FINDING_TYPES: [dict(FindingNormalizer.__key(finding, i), Type=t)
+                            for i, t in enumerate(finding.get('Types') or [])],
+            FINDING_RELATED_FINDINGS: [dict(FindingNormalizer.__key(finding, i), ProductArn=r.get('ProductArn'),
+                                            Id=r.get('Id'))
+                                       for i, r in enumerate(finding.get('RelatedFindings') or [])]
+        }
+        return {table: rows for table, rows in children.items() if len(rows) > 0}
+
+    def normalize(self, finding: dict) -> tuple:
+        """Returns the flattened findings row and the rows of every child table with any"""
+        narrow = {k: _without_lists(v) for k, v in finding.items()
+                  if k not in ('Resources', 'Types', 'RelatedFindings')}
+        return self.__flattener.flatten(narrow), FindingNormalizer.__children(finding)
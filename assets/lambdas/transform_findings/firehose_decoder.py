@@ -0,0 +1,41 @@
+import codecs
+import json
+import re
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+WHITESPACE = re.compile(r'\s*')
+
+
+def iter_envelopes(body, chunk_size: int = DEFAULT_CHUNK_SIZE):
+    """Yields the EventBridge envelopes of a Firehose object one at a time.
+
+    Firehose writes records back to back (`}{`), or newline delimited once the delivery stream appends a delimiter;
+    objects written before that are still decoded.  The body is read
+    `chunk_size` bytes at a time, so at most one chunk plus one partially read envelope is held in memory.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    position = 0
+    exhausted = False
+
+    while True:
+        position = WHITESPACE.match(buffer, position).end()
+        if position < len(buffer):
+            try:
+                envelope, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # The envelope is most likely cut off at the end of the chunk, so read more before giving up
+                if exhausted:
+                    raise
+            else:
+                yield envelope
+                continue
+        elif exhausted:
+            return
+
+        chunk = body.read(chunk_size)
+        exhausted = not chunk
+        buffer = buffer[position:] + utf8.decode(chunk, final=exhausted)
+        position = 0
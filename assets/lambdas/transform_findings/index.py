@@ -1,22 +1,205 @@
-import boto3
+import gzip
 import json
 import logging
+import random
 import re
+import time
+from aws_clients import client
+from cmdb_enrichment import CmdbSnapshot, DEFAULT_TTL_SECONDS as DEFAULT_CMDB_TTL_SECONDS
+from current_state import CurrentStateSnapshot, keep_newest, DEFAULT_BUCKETS
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from os import environ
-from flatten_json import flatten
+from urllib.parse import unquote_plus
+from firehose_decoder import iter_envelopes, DEFAULT_CHUNK_SIZE
+from finding_flattener import FindingFlattener, NON_WORD
+from finding_normalizer import (FindingNormalizer, CHILD_COLUMN_TYPES, FINDING_RESOURCES, FINDING_TYPES,
+                                FINDING_RELATED_FINDINGS)
+from invocation_metrics import InvocationMetrics, MeteredStream
+from output_formats import create_output_format, JsonLinesFormat, JSON
+from partition_registrar import PartitionRegistrar
+from s3_object_writer import S3ObjectWriter, EXTENSIONS, DEFAULT_MULTIPART_THRESHOLD, NONE
+from write_suppression import WriteSuppressor, DynamoDBFingerprintStore, DEFAULT_CACHE_SIZE
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+DEFAULT_MAX_WORKERS = 8
+# Findings are checked against the fingerprint store this many at a time
+SUPPRESSION_BATCH_SIZE = 500
+# Columns of the heartbeat written for an unchanged re-import, enough to tell when it was last seen
+HEARTBEAT_COLUMNS = ('Id', 'AwsAccountId', 'ProductArn', 'UpdatedAt', 'LastObservedAt')
+# Prefixes the child tables of normalized output are written under, partitioned like the findings
+CHILD_PREFIXES = {
+    FINDING_RESOURCES: 'FindingResources',
+    FINDING_TYPES: 'FindingTypes',
+    FINDING_RELATED_FINDINGS: 'FindingRelatedFindings'
+}
+
+# Findings/<account>/<product>/<region>/<partition of the raw object>/
+LEGACY = 'legacy'
+# Findings/account=/product=/region=/year=/month=/day=/hour=/, which Athena prunes through partition projection
+HIVE = 'hive'
+
+RAW_OBJECT_HOUR = re.compile(r'(\d{4})/(\d{2})/(\d{2})/(\d{2})/[^/]+$')
+
+
+def raw_object_hour(object_key: str) -> tuple:
+    """Returns the year, month, day and hour Firehose wrote a raw object in, taken from its yyyy/MM/dd/HH prefix"""
+    match = RAW_OBJECT_HOUR.search(object_key)
+    if match is None:
+        raise ValueError(f'{object_key} does not end in a yyyy/MM/dd/HH/ prefix')
+    return match.groups()
+
+
+def raw_stream(body, object_key: str):
+    """Returns a stream of the envelopes in a raw object's body, Firehose GZIP compresses objects it names .gz"""
+    return gzip.GzipFile(fileobj=body) if object_key.endswith('.gz') else body
+
+
+def output_key(item: dict) -> str:
+    """Returns the account/product/region key an EventBridge envelope is written under"""
+    account_id = item['detail']['findings'][0]['AwsAccountId']
+    sp = item['resources'][0].split('/')
+    if 'product/aws/securityhub' in item['resources'][0]:
+        product_node = sp[3]
+        product = product_node.split(':')
+        product_name = product[2]
+        region = product[3]
+    else:
+        product_name = sp[2]
+        region = sp[0].split(':')[3]
+
+    return account_id + '/' + product_name + '/' + region
+
+
+def object_keys(event: dict) -> tuple:
+    """Returns the object keys of an S3 event, or of the S3 events carried by an SQS event.
+
+    Keys are mapped to the ids of the messages that carried them, empty for a direct S3 event.  The ids of messages
+    whose body is not an S3 event are returned separately.
+    """
+    keys = {}
+    unreadable = []
+    for record in event.get('Records', []):
+        if record.get('eventSource') != 'aws:sqs':
+            keys.setdefault(unquote_plus(record['s3']['object']['key']), [])
+            continue
+        try:
+            body = json.loads(record['body'])
+            # S3 sends a test event when a notification is first configured, it names no object
+            if body.get('Event') == 's3:TestEvent':
+                continue
+            for s3_record in body['Records']:
+                keys.setdefault(unquote_plus(s3_record['s3']['object']['key']), []).append(record['messageId'])
+        except (ValueError, KeyError, TypeError, AttributeError):
+            logger.exception(f'Message {record["messageId"]} is not an S3 event')
+            unreadable.append(record['messageId'])
+    return keys, unreadable
+
+
+class TransformError(Exception):
+    """Raised after every record has been attempted, when at least one of them could not be transformed"""
+
+    def __init__(self, failures: dict):
+        super().__init__(f'Failed to transform {len(failures)} object(s): {", ".join(failures)}')
+        self.failures = failures
+
+
+class TransformedObject:
+    """What transforming one raw object has written so far.  Every output key has one open writer, each batch of
+    flattened rows is written to it and dropped, so memory does not grow with the size of the object."""
+
+    def __init__(self):
+        # The S3 stream and row writer of every output key
+        self.writers = {}
+        self.partitions = set()
+        # Heartbeats go to the partitions of unchanged findings, which need not have any output
+        self.heartbeat_partitions = set()
+        # The newest version of every finding by output key, only kept when the current state is
+        self.latest = {}
+        # Fingerprints of the changed findings, committed once their output is written
+        self.pending = {}
+
 
 class TransformFindings:
-    def __init__(self, bucket_name, destination_prefix='AWSLogs'):
-        self.__s3_resource = boto3.resource('s3')
-        self.__s3_client = boto3.client('s3')
+    def __init__(self, bucket_name, destination_prefix='AWSLogs', chunk_size=DEFAULT_CHUNK_SIZE,
+                 output_format=JSON, parquet_compression='snappy', output_compression=NONE,
+                 multipart_threshold=DEFAULT_MULTIPART_THRESHOLD, max_workers=DEFAULT_MAX_WORKERS,
+                 log_sample_rate=0.0, current_state_prefix=None, current_state_buckets=DEFAULT_BUCKETS,
+                 partition_layout=LEGACY, database_name=None, table_name=None, typed_output=False,
+                 keep_arrays=False, fingerprint_store=None, fingerprint_cache_size=DEFAULT_CACHE_SIZE,
+                 heartbeat_prefix=None, cmdb_key=None, cmdb_bucket=None, cmdb_ttl_seconds=DEFAULT_CMDB_TTL_SECONDS,
+                 normalized_output=False, declared_types=None, metrics_stream=None, heartbeat_table=None):
+        # Record workers each hold a GET open while key workers PUT their output, so size the pool for both
+        self.__max_pool_connections = max(10, max_workers * 3)
+        self.__record_executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.__key_executor = ThreadPoolExecutor(max_workers=max_workers)
+        # Only ever runs part uploads, which wait on nothing, so writers closing on the key executor can wait on them
+        self.__upload_executor = ThreadPoolExecutor(max_workers=max_workers)
 
         self.__bucket_name = bucket_name
-        self.__bucket = self.__s3_resource.Bucket(self.__bucket_name)
         self.__destination_prefix = destination_prefix
+        if partition_layout not in (LEGACY, HIVE):
+            raise ValueError(f'Unsupported partition layout {partition_layout}, expected one of {(LEGACY, HIVE)}')
+        self.__partition_layout = partition_layout
+        self.__chunk_size = chunk_size
+        if normalized_output and keep_arrays:
+            raise ValueError('normalized output writes lists as child tables or JSON, keep_arrays does not apply')
+        # Columns the table declares a type for keep it in every object, the rest are inferred
+        self.__flattener = FindingFlattener(typed=typed_output, keep_arrays=keep_arrays, declared_types=declared_types)
+        # A narrow findings table and child tables, instead of a column per element of every list
+        self.__normalizer = FindingNormalizer(self.__flattener) if normalized_output else None
+        self.__output_format = create_output_format(output_format, parquet_compression,
+                                                    self.__column_types if typed_output else None)
+        if output_compression != NONE and not self.__output_format.compressible:
+            raise ValueError(f'{output_format} output is compressed internally, output_compression must be {NONE}')
+        self.__output_compression = output_compression
+        self.__output_extension = self.__output_format.extension + EXTENSIONS[output_compression]
+        self.__child_format = create_output_format(output_format, parquet_compression,
+                                                   (lambda: CHILD_COLUMN_TYPES) if typed_output else None)
+        self.__multipart_threshold = multipart_threshold
+        # Logging every finding doubles CloudWatch ingestion, so payloads are only logged for a sample of findings
+        self.__log_sample_rate = log_sample_rate
+        # EMF metric lines go to standard output unless given a stream, the backfill keeps its own output clean
+        self.__metrics_stream = metrics_stream
+        self.__current_state = None
+        if current_state_prefix is not None:
+            self.__current_state = CurrentStateSnapshot(self.__s3_client, bucket_name, self.__output_format,
+                                                        prefix=current_state_prefix,
+                                                        buckets=current_state_buckets,
+                                                        compression=output_compression)
+        # New partitions are registered as they are written, so the table does not wait for a crawler run
+        self.__partition_registrars = []
+        if database_name is not None and table_name is not None:
+            self.__partition_registrars.append(PartitionRegistrar(client('glue'), self.__s3_client, bucket_name,
+                                                                  database_name, table_name, destination_prefix))
+            if normalized_output:
+                # Child rows are written to the partitions of their findings, so the child tables get the same ones
+                self.__partition_registrars += [PartitionRegistrar(client('glue'), self.__s3_client, bucket_name,
+                                                                   database_name, table, prefix)
+                                                for table, prefix in CHILD_PREFIXES.items()]
+        self.__heartbeat_registrar = None
+        if database_name is not None and heartbeat_table is not None and heartbeat_prefix is not None:
+            self.__heartbeat_registrar = PartitionRegistrar(client('glue'), self.__s3_client, bucket_name,
+                                                            database_name, heartbeat_table, heartbeat_prefix)
+        # Re-imports that only changed timestamps are not written again, or only as a heartbeat
+        self.__suppressor = None
+        if fingerprint_store is not None:
+            self.__suppressor = WriteSuppressor(fingerprint_store, cache_size=fingerprint_cache_size)
+        self.__heartbeat_prefix = heartbeat_prefix
+        self.__heartbeat_format = JsonLinesFormat()
+        # Owner, business unit and environment are joined in as findings are written, not by every query
+        self.__cmdb = None
+        if cmdb_key is not None:
+            self.__cmdb = CmdbSnapshot(self.__s3_client, cmdb_bucket or bucket_name, cmdb_key,
+                                       ttl_seconds=cmdb_ttl_seconds)
+
+    @property
+    def __s3_client(self):
+        return client('s3', self.__max_pool_connections)
+
+    def __column_types(self) -> dict:
+        return self.__flattener.column_types
 
     def fix_dictionary(self, finding: dict):
         keys = finding.keys()
@@ -29,64 +212,269 @@ class TransformFindings:
             if isinstance(value, dict):
                 value = self.fix_dictionary(value)
             if isinstance(key, str):
-                new_key = re.sub('\W', '_', key)
+                new_key = NON_WORD.sub('_', key)
 
             ret[new_key] = value_as_string
         return ret
 
-    def __process_record(self, object_key):
-        output = {}
-        response = self.__s3_client.get_object(Bucket=self.__bucket_name, Key=object_key)
-        raw_findings = '[' + response['Body'].read().decode('utf-8').replace('}{', '},\n{') + ']'
-        raw_list = json.loads(raw_findings)
-        for item in raw_list:
-            account_id = item['detail']['findings'][0]['AwsAccountId']
-            sp = item['resources'][0].split('/')
-            if 'product/aws/securityhub' in item['resources'][0]:
-                product_node = sp[3]
-                product = product_node.split(':')
-                product_name = product[2]
-                region = product[3]
-            else:
-                product_name = sp[2]
-                region = sp[0].split(':')[3]
+    def __log_sample(self, message: str):
+        if self.__log_sample_rate > 0 and random.random() < self.__log_sample_rate:
+            logger.info(message)
 
-            key = account_id + '/' + product_name + '/' + region
-            findings = item['detail']['findings']
-            for f in findings:
-                logger.info(f'raw_finding={f}')
-                flatten_finding = flatten(f)
-                fixed = self.fix_dictionary(flatten_finding)
-                logger.info(f'fixed_finding={fixed}')
+    def __read_envelopes(self, object_key: str, metrics: InvocationMetrics):
+        with metrics.timed('Get'):
+            response = self.__s3_client.get_object(Bucket=self.__bucket_name, Key=object_key)
+        body = MeteredStream(response['Body'], metrics)
+        # BytesIn counts the bytes read from S3, compressed or not
+        envelopes = iter_envelopes(raw_stream(body, object_key), self.__chunk_size)
+        while True:
+            start = time.perf_counter()
+            read_before = body.seconds
+            item = next(envelopes, None)
+            # Reading the body happens inside the decoder, it is already counted in the Get phase
+            metrics.add_duration('Decode', time.perf_counter() - start - (body.seconds - read_before))
+            if item is None:
+                return
+            metrics.increment('Envelopes')
+            yield item
+
+    def __flatten(self, batch: list, object_key: str, transformed: TransformedObject, cmdb,
+                  metrics: InvocationMetrics):
+        suppressed = [False] * len(batch)
+        if self.__suppressor is not None:
+            suppressed, fingerprints = self.__suppressor.suppressed([f for _, f in batch])
+            transformed.pending.update(fingerprints)
+            metrics.increment('Suppressed', sum(suppressed))
+
+        output = {}
+        children = {table: {} for table in CHILD_PREFIXES}
+        heartbeats = {}
+        with metrics.timed('Flatten'):
+            for (key, f), unchanged in zip(batch, suppressed):
+                if unchanged:
+                    if self.__heartbeat_prefix is not None:
+                        heartbeats.setdefault(key, []).append({c: f.get(c) for c in HEARTBEAT_COLUMNS})
+                    continue
+                self.__log_sample(f'raw_finding={f}')
+                if self.__normalizer is not None:
+                    fixed, rows_by_table = self.__normalizer.normalize(f)
+                    for table, rows in rows_by_table.items():
+                        children[table].setdefault(key, []).extend(rows)
+                else:
+                    fixed = self.__flattener.flatten(f)
+                if cmdb is not None:
+                    fixed.update(cmdb.lookup(f))
+                self.__log_sample(f'fixed_finding={fixed}')
 
                 if key not in output:
                     output[key] = [fixed]
                 else:
                     output[key].append(fixed)
 
-        return output
+        for s3_path in self.__write(output, object_key, self.__destination_prefix, self.__output_format, transformed,
+                                    metrics):
+            transformed.partitions.add(s3_path[len(self.__destination_prefix) + 1:].rpartition('/')[0])
+        if self.__current_state is not None:
+            for key, rows in output.items():
+                keep_newest(transformed.latest.setdefault(key, {}), rows)
+        for table, rows_by_key in children.items():
+            self.__write(rows_by_key, object_key, CHILD_PREFIXES[table], self.__child_format, transformed, metrics)
+        # Heartbeats are always JSON lines, compressed like the output when it is compressible
+        for s3_path in self.__write(heartbeats, object_key, self.__heartbeat_prefix, self.__heartbeat_format,
+                                    transformed, metrics):
+            transformed.heartbeat_partitions.add(s3_path[len(self.__heartbeat_prefix) + 1:].rpartition('/')[0])
+
+    def __process_record(self, object_key, transformed: TransformedObject, metrics: InvocationMetrics):
+        batch = []
+        cmdb = self.__cmdb.index() if self.__cmdb is not None else None
+        for item in self.__read_envelopes(object_key, metrics):
+            key = output_key(item)
+            findings = item['detail']['findings']
+            batch.extend((key, f) for f in findings)
+            metrics.increment('Findings', len(findings))
+            if len(batch) >= SUPPRESSION_BATCH_SIZE:
+                self.__flatten(batch, object_key, transformed, cmdb, metrics)
+                batch = []
+        self.__flatten(batch, object_key, transformed, cmdb, metrics)
+
+    def __write(self, rows_by_key: dict, object_key: str, prefix: str, output_format, transformed: TransformedObject,
+                metrics: InvocationMetrics) -> list:
+        """Writes a batch of rows to the open writer of each of their output keys, returning the keys' paths"""
+        extension = output_format.extension + EXTENSIONS[self.__output_compression]
+        paths = []
+        for key, rows in rows_by_key.items():
+            s3_path = self.__output_path(key, object_key, prefix, extension)
+            with metrics.timed('Put'):
+                if s3_path not in transformed.writers:
+                    stream = S3ObjectWriter(self.__s3_client, self.__bucket_name, s3_path,
+                                            compression=self.__output_compression,
+                                            multipart_threshold=self.__multipart_threshold,
+                                            executor=self.__upload_executor)
+                    transformed.writers[s3_path] = (stream, output_format.open(stream))
+                # Parts are uploaded in the background while the rest of the object is decoded
+                transformed.writers[s3_path][1].write(rows)
+            paths.append(s3_path)
+        return paths
+
+    def __close_writer(self, stream: S3ObjectWriter, writer, metrics: InvocationMetrics):
+        with metrics.timed('Put'):
+            writer.close()
+            stream.close()
+        metrics.increment('OutputKeys')
+        metrics.increment('BytesOut', stream.bytes_out)
+
+    def __output_path(self, key: str, object_key: str, prefix: str = None, extension: str = None) -> str:
+        object_name = object_key.split('/')[-1]
+        if object_name.endswith('.gz'):
+            object_name = object_name[:-len('.gz')]
+        if self.__partition_layout == HIVE:
+            account_id, product_name, region = key.split('/')
+            year, month, day, hour = raw_object_hour(object_key)
+            partition = (f'account={account_id}/product={product_name}/region={region}/'
+                         f'year={year}/month={month}/day={day}/hour={hour}')
+        else:
+            # The raw object's path below raw/firehose<yyyy>/, its MM/dd.  Dynamic partitioning writes
+            # account=/region= and the whole yyyy/MM/dd/HH below the prefix, the partition keeps the same MM/dd
+            segments = object_key.split('/')[2:-2]
+            if any('=' in segment for segment in segments):
+                segments = list(raw_object_hour(object_key)[1:3])
+            partition = key + '/' + '/'.join(segments)
+        return f'{prefix or self.__destination_prefix}/{partition}/{object_name}.{extension or self.__output_extension}'
+
+    def __transform_object(self, object_key: str, metrics: InvocationMetrics):
+        transformed = TransformedObject()
+        try:
+            self.__process_record(object_key, transformed, metrics)
+            futures = [self.__key_executor.submit(self.__close_writer, stream, writer, metrics)
+                       for stream, writer in transformed.writers.values()]
+            for future in futures:
+                future.result()
+        except Exception:
+            # Nothing of a failed object is served, the retry writes every key again
+            for stream, _ in transformed.writers.values():
+                if not stream.closed:
+                    stream.abort()
+            raise
+        if self.__suppressor is not None:
+            # Only findings that were written are suppressed from now on
+            self.__suppressor.commit(transformed.pending)
+        metrics.increment('Objects')
+        return transformed.latest, transformed.partitions, transformed.heartbeat_partitions
+
+    def __register_partitions(self, partitions: set, heartbeat_partitions: set, metrics: InvocationMetrics) -> dict:
+        try:
+            for registrar in self.__partition_registrars:
+                metrics.increment('NewPartitions', len(registrar.register(partitions)))
+            if self.__heartbeat_registrar is not None:
+                metrics.increment('NewPartitions', len(self.__heartbeat_registrar.register(heartbeat_partitions)))
+        except Exception as e:
+            logger.exception(f'Failed to register {len(partitions)} partitions')
+            return {'partitions': e}
+        return {}
 
-    def __persist_record(self, output: dict, partition: str, object_name):
-        for key in output:
-            s3_path = f'{self.__destination_prefix}/{key}/{partition}/{object_name}.json'
-            body = ''
-            for version in output[key]:
-                body += json.dumps(version) + '\n'
-            self.__bucket.put_object(Key=s3_path, Body=body)
+    def __update_current_state(self, latest: dict, metrics: InvocationMetrics) -> dict:
+        buckets = self.__current_state.partition(latest)
+        futures = {self.__key_executor.submit(self.__current_state.merge_bucket, key, bucket, rows):
+                   self.__current_state.key(key, bucket) for (key, bucket), rows in buckets.items()}
+
+        failures = {}
+        for future in as_completed(futures):
+            try:
+                future.result()
+                metrics.increment('CurrentStateKeys')
+            except Exception as e:
+                logger.exception(f'Failed to merge {futures[future]}')
+                failures[futures[future]] = e
+        return failures
 
     def handle(self, event, context):
-        records = event['Records']
-        for r in records:
-            object_key = r['s3']['object']['key']
-            output = self.__process_record(object_key)
+        keys, unreadable = object_keys(event)
+        failures = self.transform(keys, context)
+
+        if any(r.get('eventSource') == 'aws:sqs' for r in event.get('Records', [])):
+            return {'batchItemFailures': [{'itemIdentifier': m}
+                                          for m in self.__failed_messages(event, keys, unreadable, failures)]}
+        if len(failures) > 0:
+            raise TransformError(failures)
+
+    def transform(self, keys, context=None) -> dict:
+        """Transforms raw objects, returning the exception of every object, or shared output, that failed"""
+        metrics = InvocationMetrics(function_name=getattr(context, 'function_name', None), stream=self.__metrics_stream)
+        futures = {self.__record_executor.submit(self.__transform_object, key, metrics): key for key in keys}
 
-            partition = '/'.join(object_key.split('/')[2:-2])
-            object_name = object_key.split('/')[-1]
+        failures = {}
+        latest = {}
+        partitions = set()
+        heartbeat_partitions = set()
+        for future in as_completed(futures):
+            try:
+                newest, written, heartbeats_written = future.result()
+            except Exception as e:
+                logger.exception(f'Failed to transform {futures[future]}')
+                failures[futures[future]] = e
+            else:
+                partitions.update(written)
+                heartbeat_partitions.update(heartbeats_written)
+                for key, rows in newest.items():
+                    keep_newest(latest.setdefault(key, {}), list(rows.values()))
+
+        metrics.increment('FailedObjects', len(failures))
+        if len(self.__partition_registrars) > 0 and len(partitions) + len(heartbeat_partitions) > 0:
+            failures.update(self.__register_partitions(partitions, heartbeat_partitions, metrics))
+        if self.__current_state is not None and len(latest) > 0:
+            failures.update(self.__update_current_state(latest, metrics))
+        metrics.emit()
+        return failures
 
-            self.__persist_record(output, partition, object_name)
+    @staticmethod
+    def __failed_messages(event: dict, keys: dict, unreadable: list, failures: dict) -> list:
+        # Partitions and current state are shared by the whole batch, when they fail every message is retried
+        if any(f not in keys for f in failures):
+            return [r['messageId'] for r in event['Records']]
+        failed = set(unreadable)
+        for f in failures:
+            failed.update(keys[f])
+        return [r['messageId'] for r in event['Records'] if r['messageId'] in failed]
+
+
+def create_from_environment() -> TransformFindings:
+    fingerprint_store = None
+    if 'fingerprint_table' in environ:
+        fingerprint_store = DynamoDBFingerprintStore(client('dynamodb'), environ['fingerprint_table'])
+    return TransformFindings(bucket_name=environ['bucket_name'],
+                             destination_prefix=environ['destination_prefix'],
+                             chunk_size=int(environ.get('chunk_size', DEFAULT_CHUNK_SIZE)),
+                             output_format=environ.get('output_format', JSON),
+                             parquet_compression=environ.get('parquet_compression', 'snappy'),
+                             output_compression=environ.get('output_compression', NONE),
+                             multipart_threshold=int(environ.get('multipart_threshold', DEFAULT_MULTIPART_THRESHOLD)),
+                             max_workers=int(environ.get('max_workers', DEFAULT_MAX_WORKERS)),
+                             log_sample_rate=float(environ.get('log_sample_rate', 0.0)),
+                             current_state_prefix=environ.get('current_state_prefix'),
+                             current_state_buckets=int(environ.get('current_state_buckets', DEFAULT_BUCKETS)),
+                             partition_layout=environ.get('partition_layout', LEGACY),
+                             database_name=environ.get('database_name'),
+                             table_name=environ.get('table_name'),
+                             typed_output=environ.get('typed_output', 'false') == 'true',
+                             keep_arrays=environ.get('keep_arrays', 'false') == 'true',
+                             fingerprint_store=fingerprint_store,
+                             fingerprint_cache_size=int(environ.get('fingerprint_cache_size', DEFAULT_CACHE_SIZE)),
+                             heartbeat_prefix=environ.get('heartbeat_prefix'),
+                             heartbeat_table=environ.get('heartbeat_table'),
+                             cmdb_key=environ.get('cmdb_key'),
+                             cmdb_bucket=environ.get('cmdb_bucket'),
+                             cmdb_ttl_seconds=float(environ.get('cmdb_ttl_seconds', DEFAULT_CMDB_TTL_SECONDS)),
+                             normalized_output=environ.get('normalized_output', 'false') == 'true',
+                             declared_types=json.loads(environ['column_types']) if 'column_types' in environ else None)
+
+
+# Reused across warm invocations, so clients, thread pools and the column cache are only built once per container
+_transform_findings = None
 
 
 def handler(event, context):
+    global _transform_findings
     logger.info(event)
-    return TransformFindings(bucket_name=environ['bucket_name'],
-                             destination_prefix=environ['destination_prefix']).handle(event, context)
+    if _transform_findings is None:
+        _transform_findings = create_from_environment()
+    return _transform_findings.handle(event, context)
@@ -0,0 +1,98 @@
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+NAMESPACE = 'SecurityHubAnalyticPipeline'
+
+COUNTS = ['Objects', 'FailedObjects', 'Envelopes', 'Findings', 'OutputKeys', 'CurrentStateKeys', 'NewPartitions',
+          'Suppressed']
+BYTES = ['BytesIn', 'BytesOut']
+PHASES = ['Get', 'Decode', 'Flatten', 'Put']
+
+
+class InvocationMetrics:
+    """Collects counters and per phase durations for one invocation and emits them once as an embedded metric format
+    (EMF) log line, which CloudWatch turns into metrics without any PutMetricData calls.
+
+    Durations are summed across worker threads, so they add up to the time spent in each phase, not wall clock time.
+    """
+
+    def __init__(self, function_name: str = None, namespace: str = NAMESPACE, stream=None):
+        self.__lock = threading.Lock()
+        self.__function_name = function_name
+        # Standard output unless set, where the Lambda runtime ships it to CloudWatch
+        self.__stream = stream
+        self.__namespace = namespace
+        self.__values = {name: 0 for name in COUNTS + BYTES}
+        self.__durations = {phase: 0.0 for phase in PHASES}
+
+    def increment(self, name: str, value: int = 1):
+        with self.__lock:
+            self.__values[name] += value
+
+    def add_duration(self, phase: str, seconds: float):
+        with self.__lock:
+            self.__durations[phase] += seconds
+
+    @contextmanager
+    def timed(self, phase: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_duration(phase, time.perf_counter() - start)
+
+    def __getitem__(self, name: str):
+        with self.__lock:
+            if name in self.__values:
+                return self.__values[name]
+            return self.__durations[name]
+
+    def to_emf(self) -> dict:
+        with self.__lock:
+            values = dict(self.__values)
+            values.update({f'{phase}Milliseconds': round(seconds * 1000, 3)
+                           for phase, seconds in self.__durations.items()})
+
+        definitions = [{'Name': name, 'Unit': 'Count'} for name in COUNTS]
+        definitions += [{'Name': name, 'Unit': 'Bytes'} for name in BYTES]
+        definitions += [{'Name': f'{phase}Milliseconds', 'Unit': 'Milliseconds'} for phase in PHASES]
+
+        dimensions = []
+        if self.__function_name is not None:
+            dimensions.append('FunctionName')
+            values['FunctionName'] = self.__function_name
+
+        values['_aws'] = {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': self.__namespace,
+                'Dimensions': [dimensions],
+                'Metrics': definitions
+            }]
+        }
+        return values
+
+    def emit(self):
+        # Printed rather than logged, the Lambda log formatter would prefix the line and CloudWatch would not parse it
+        print(json.dumps(self.to_emf()), file=self.__stream or sys.stdout, flush=True)
+
+
+class MeteredStream:
+    """Wraps a streaming body, adding read time to the Get phase and bytes read to BytesIn"""
+
+    def __init__(self, body, metrics: InvocationMetrics):
+        self.__body = body
+        self.__metrics = metrics
+        self.seconds = 0.0
+
+    def read(self, size: int = -1) -> bytes:
+        start = time.perf_counter()
+        data = self.__body.read(size)
+        elapsed = time.perf_counter() - start
+        self.seconds += elapsed
+        self.__metrics.add_duration('Get', elapsed)
+        self.__metrics.increment('BytesIn', len(data))
+        return data
@@ -0,0 +1,189 @@
+import io
+import json
+import tempfile
+from column_types import coerce, parse_timestamp, format_timestamp, ARRAY, BIGINT, BOOLEAN, DOUBLE, STRING, TIMESTAMP
+
+JSON = 'json'
+PARQUET = 'parquet'
+
+PARQUET_COMPRESSIONS = ('snappy', 'zstd')
+
+
+class JsonLinesFormat:
+    """One JSON document per line, the format the crawler has always read"""
+    extension = 'json'
+    compressible = True
+
+    def write(self, rows: list, stream):
+        for row in rows:
+            stream.write(json.dumps(row).encode('utf-8') + b'\n')
+
+    def open(self, stream):
+        return JsonLinesWriter(self, stream)
+
+    def read(self, data: bytes) -> list:
+        return [json.loads(line) for line in data.decode('utf-8').splitlines() if len(line.strip()) > 0]
+
+
+class ParquetFormat:
+    """Compressed Parquet, dictionary encoded so the Title, Description, GeneratorId and Remediation text that repeat
+    in nearly every row are stored once per row group.  pyarrow falls back to plain encoding for a column whose
+    dictionary grows too large, so every column is dictionary encoded."""
+    extension = 'parquet'
+    compressible = False
+
+    def __init__(self, compression: str = 'snappy', column_types=None):
+        if compression not in PARQUET_COMPRESSIONS:
+            raise ValueError(f'Unsupported Parquet compression {compression}, expected one of {PARQUET_COMPRESSIONS}')
+        self.__compression = compression
+        # Returns the inferred type of every column when the rows are typed, every column is a string otherwise
+        self.__column_types = column_types
+
+    @staticmethod
+    def __arrow_array(values: list, column_type: str):
+        import pyarrow
+
+        if column_type == TIMESTAMP:
+            return pyarrow.array([None if v is None else parse_timestamp(v) for v in values],
+                                 pyarrow.timestamp('ms', tz='UTC'))
+        arrow_types = {
+            BOOLEAN: pyarrow.bool_(),
+            BIGINT: pyarrow.int64(),
+            DOUBLE: pyarrow.float64(),
+            ARRAY: pyarrow.list_(pyarrow.string())
+        }
+        return pyarrow.array([coerce(v, column_type) for v in values], arrow_types.get(column_type, pyarrow.string()))
+
+    def to_table(self, rows: list):
+        import pyarrow
+
+        columns = {}
+        for row in rows:
+            for column in row:
+                columns.setdefault(column, None)
+
+        column_types = self.__column_types() if self.__column_types is not None else {}
+        return pyarrow.table({column: self.__arrow_array([row.get(column) for row in rows],
+                                                         column_types.get(column, STRING))
+                              for column in columns})
+
+    def write(self, rows: list, stream):
+        import pyarrow.parquet
+
+        pyarrow.parquet.write_table(self.to_table(rows), stream,
+                                    compression=self.__compression,
+                                    use_dictionary=True)
+
+    def open(self, stream):
+        return ParquetWriter(self, self.__compression, stream)
+
+    def read(self, data: bytes) -> list:
+        import pyarrow.parquet
+        import pyarrow.types
+
+        table = pyarrow.parquet.read_table(io.BytesIO(data))
+        timestamps = [f.name for f in table.schema if pyarrow.types.is_timestamp(f.type)]
+        rows = table.to_pylist()
+        # Back to the text the flattener produced, so rows read here compare and merge like freshly flattened ones
+        for row in rows:
+            for column in timestamps:
+                if row[column] is not None:
+                    row[column] = format_timestamp(row[column])
+        return rows
+
+
+class JsonLinesWriter:
+    """Writes batches of rows to `stream` as they come, nothing is held back"""
+
+    def __init__(self, output_format: JsonLinesFormat, stream):
+        self.__format = output_format
+        self.__stream = stream
+
+    def write(self, rows: list):
+        self.__format.write(rows, self.__stream)
+
+    def close(self):
+        pass
+
+
+class ParquetWriter:
+    """Writes batches of rows to `stream` as one Parquet object, one row group per batch.
+
+    Parquet needs the schema of the whole object before its first row group, and typed columns can still widen from
+    integer to double, or to string, in a later batch.  Every batch is spilled to a temporary file instead of being
+    held in memory, and the object is only written on close, each spilled batch cast to the widened schema.
+    """
+
+    def __init__(self, output_format: ParquetFormat, compression: str, stream):
+        self.__format = output_format
+        self.__compression = compression
+        self.__stream = stream
+        self.__spilled = []
+
+    def write(self, rows: list):
+        import pyarrow.parquet
+
+        table = self.__format.to_table(rows)
+        spill = tempfile.TemporaryFile()
+        pyarrow.parquet.write_table(table, spill, compression=self.__compression, use_dictionary=True)
+        self.__spilled.append((spill, table.schema))
+
+    @staticmethod
+    def __widen(schemas: list):
+        import pyarrow
+        import pyarrow.types
+
+        types = {}
+        for schema in schemas:
+            for field in schema:
+                found = types.setdefault(field.name, [])
+                if not pyarrow.types.is_null(field.type) and field.type not in found:
+                    found.append(field.type)
+        fields = []
+        for name, found in types.items():
+            if len(found) == 0:
+                fields.append(pyarrow.field(name, pyarrow.null()))
+            elif len(found) == 1:
+                fields.append(pyarrow.field(name, found[0]))
+            elif all(pyarrow.types.is_integer(t) or pyarrow.types.is_floating(t) for t in found):
+                fields.append(pyarrow.field(name, pyarrow.float64()))
+            else:
+                fields.append(pyarrow.field(name, pyarrow.string()))
+        return pyarrow.schema(fields)
+
+    @staticmethod
+    def __conform(table, schema):
+        import pyarrow
+
+        columns = []
+        for field in schema:
+            if field.name not in table.column_names:
+                columns.append(pyarrow.nulls(table.num_rows, field.type))
+            else:
+                columns.append(table[field.name].cast(field.type))
+        return pyarrow.table(columns, schema=schema)
+
+    def close(self):
+        import pyarrow.parquet
+
+        try:
+            if len(self.__spilled) == 0:
+                return
+            schema = ParquetWriter.__widen([s for _, s in self.__spilled])
+            with pyarrow.parquet.ParquetWriter(self.__stream, schema, compression=self.__compression,
+                                               use_dictionary=True) as writer:
+                for spill, _ in self.__spilled:
+                    spill.seek(0)
+                    writer.write_table(ParquetWriter.__conform(pyarrow.parquet.read_table(spill), schema))
+        finally:
+            for spill, _ in self.__spilled:
+                spill.close()
+            self.__spilled = []
+
+
+def create_output_format(name: str = JSON, parquet_compression: str = 'snappy', column_types=None):
+    if name == JSON:
+        return JsonLinesFormat()
+    if name == PARQUET:
+        return ParquetFormat(parquet_compression, column_types)
+    raise ValueError(f'Unsupported output format {name}, expected one of {(JSON, PARQUET)}')
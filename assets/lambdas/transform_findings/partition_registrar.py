@@ -0,0 +1,86 @@
+import logging
+import threading
+
+logger = logging.getLogger()
+
+BATCH_SIZE = 100
+
+
+def partition_values(location: str) -> list:
+    """Returns the partition values of a Hive style location such as account=1/region=us-east-1"""
+    return [segment.split('=', 1)[-1] for segment in location.strip('/').split('/')]
+
+
+class PartitionRegistrar:
+    """Registers new partitions of a Glue table with BatchCreatePartition as they are written.
+
+    Partitions registered by this container are remembered in memory.  Every registered partition also gets an empty
+    marker object under `marker_prefix`, so a new container checks one object instead of calling Glue again.
+    Partitions that already exist in Glue are treated as registered.
+    """
+
+    def __init__(self, glue_client, s3_client, bucket_name: str, database_name: str, table_name: str,
+                 table_prefix: str, marker_prefix: str = 'Markers/partitions'):
+        self.__glue_client = glue_client
+        self.__s3_client = s3_client
+        self.__bucket_name = bucket_name
+        self.__database_name = database_name
+        self.__table_name = table_name
+        self.__table_prefix = table_prefix.strip('/')
+        self.__marker_prefix = marker_prefix.strip('/')
+        self.__registered = set()
+        self.__storage_descriptor = None
+        self.__lock = threading.Lock()
+
+    def __marker_key(self, partition: str) -> str:
+        return f'{self.__marker_prefix}/{self.__table_name}/{partition}'
+
+    def __has_marker(self, partition: str) -> bool:
+        from botocore.exceptions import ClientError
+
+        try:
+            self.__s3_client.head_object(Bucket=self.__bucket_name, Key=self.__marker_key(partition))
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+    def __table_storage_descriptor(self) -> dict:
+        if self.__storage_descriptor is None:
+            table = self.__glue_client.get_table(DatabaseName=self.__database_name, Name=self.__table_name)['Table']
+            self.__storage_descriptor = table['StorageDescriptor']
+        return self.__storage_descriptor
+
+    def __create_partitions(self, partitions: list):
+        storage_descriptor = self.__table_storage_descriptor()
+        for start in range(0, len(partitions), BATCH_SIZE):
+            batch = partitions[start:start + BATCH_SIZE]
+            response = self.__glue_client.batch_create_partition(
+                DatabaseName=self.__database_name,
+                TableName=self.__table_name,
+                PartitionInputList=[{
+                    'Values': partition_values(p),
+                    'StorageDescriptor': dict(storage_descriptor,
+                                              Location=f's3://{self.__bucket_name}/{self.__table_prefix}/{p}/')
+                } for p in batch])
+            errors = [e for e in response.get('Errors', [])
+                      if e['ErrorDetail']['ErrorCode'] != 'AlreadyExistsException']
+            if len(errors) > 0:
+                raise RuntimeError(f'Failed to register partitions of {self.__table_name}: {errors}')
+
+    def register(self, partitions) -> list:
+        """Registers the given partitions, paths relative to the table prefix, returning the ones that were new"""
+        with self.__lock:
+            pending = sorted(set(partitions) - self.__registered)
+        pending = [p for p in pending if not self.__has_marker(p)]
+
+        if len(pending) > 0:
+            self.__create_partitions(pending)
+            for p in pending:
+                self.__s3_client.put_object(Bucket=self.__bucket_name, Key=self.__marker_key(p), Body=b'')
+            logger.info(f'Registered {len(pending)} partitions of {self.__table_name}')
+
+        with self.__lock:
+            self.__registered.update(partitions)
+        return pending
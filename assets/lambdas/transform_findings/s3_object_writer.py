@@ -0,0 +1,187 @@
+import zlib
+
+NONE = 'none'
+GZIP = 'gzip'
+ZSTD = 'zstd'
+
+EXTENSIONS = {
+    NONE: '',
+    GZIP: '.gz',
+    ZSTD: '.zst'
+}
+
+# S3 rejects multipart uploads whose parts, other than the last, are smaller than 5 MiB
+MINIMUM_PART_SIZE = 5 * 1024 * 1024
+DEFAULT_MULTIPART_THRESHOLD = 8 * 1024 * 1024
+
+
+class _Uncompressed:
+    @staticmethod
+    def compress(data: bytes) -> bytes:
+        return data
+
+    @staticmethod
+    def flush() -> bytes:
+        return b''
+
+
+def _create_compressor(compression: str):
+    if compression == NONE:
+        return _Uncompressed()
+    if compression == GZIP:
+        return zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    if compression == ZSTD:
+        import zstandard
+        return zstandard.ZstdCompressor().compressobj()
+    raise ValueError(f'Unsupported compression {compression}, expected one of {tuple(EXTENSIONS)}')
+
+
+def compress(data: bytes, compression: str) -> bytes:
+    compressor = _create_compressor(compression)
+    return compressor.compress(data) + compressor.flush()
+
+
+def decompress(data: bytes, compression: str) -> bytes:
+    if compression == GZIP:
+        return zlib.decompress(data, zlib.MAX_WBITS | 16)
+    if compression == ZSTD:
+        import zstandard
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return data
+
+
+class S3ObjectWriter:
+    """Write-only file object that compresses as it goes and uploads to S3.
+
+    Small objects are uploaded with one PutObject when the writer is closed.  Once the compressed buffer passes
+    `multipart_threshold` the writer switches to a multipart upload and sends the buffer as a part, so at most one
+    part is held in memory regardless of the size of the object.
+
+    Given an `executor`, parts are uploaded on it while the caller keeps writing.  Only one part is in flight at a
+    time, so at most two are held in memory.  The executor must not run tasks that wait on the writer.
+    """
+
+    def __init__(self, s3_client, bucket_name: str, key: str, compression: str = NONE,
+                 multipart_threshold: int = DEFAULT_MULTIPART_THRESHOLD, executor=None):
+        if multipart_threshold < MINIMUM_PART_SIZE:
+            raise ValueError(f'multipart_threshold must be at least {MINIMUM_PART_SIZE} bytes')
+
+        self.__s3_client = s3_client
+        self.__bucket_name = bucket_name
+        self.__key = key
+        self.__compressor = _create_compressor(compression)
+        self.__multipart_threshold = multipart_threshold
+        self.__executor = executor
+
+        self.__buffer = bytearray()
+        self.__upload_id = None
+        self.__parts = []
+        self.__uploading = None
+        self.__bytes_in = 0
+        self.__bytes_out = 0
+        self.closed = False
+
+    @property
+    def key(self) -> str:
+        return self.__key
+
+    @property
+    def bytes_in(self) -> int:
+        return self.__bytes_in
+
+    @property
+    def bytes_out(self) -> int:
+        return self.__bytes_out
+
+    def writable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.__bytes_in
+
+    def flush(self):
+        pass
+
+    def write(self, data) -> int:
+        if self.closed:
+            raise ValueError('write to closed S3ObjectWriter')
+
+        self.__bytes_in += len(data)
+        self.__buffer += self.__compressor.compress(bytes(data))
+        if len(self.__buffer) >= self.__multipart_threshold:
+            self.__upload_part()
+        return len(data)
+
+    def __upload_part(self):
+        if self.__upload_id is None:
+            self.__upload_id = self.__s3_client.create_multipart_upload(Bucket=self.__bucket_name,
+                                                                        Key=self.__key)['UploadId']
+
+        self.__wait()
+        part_number = len(self.__parts) + 1
+        body = bytes(self.__buffer)
+        self.__bytes_out += len(body)
+        self.__buffer.clear()
+        if self.__executor is None:
+            self.__parts.append(self.__send(part_number, body))
+        else:
+            self.__uploading = self.__executor.submit(self.__send, part_number, body)
+
+    def __send(self, part_number: int, body: bytes) -> dict:
+        response = self.__s3_client.upload_part(Bucket=self.__bucket_name,
+                                                Key=self.__key,
+                                                UploadId=self.__upload_id,
+                                                PartNumber=part_number,
+                                                Body=body)
+        return {'ETag': response['ETag'], 'PartNumber': part_number}
+
+    def __wait(self):
+        if self.__uploading is not None:
+            uploading, self.__uploading = self.__uploading, None
+            self.__parts.append(uploading.result())
+
+    def close(self):
+        if self.closed:
+            return
+
+        try:
+            self.__buffer += self.__compressor.flush()
+            if self.__upload_id is None:
+                self.__s3_client.put_object(Bucket=self.__bucket_name, Key=self.__key, Body=bytes(self.__buffer))
+                self.__bytes_out += len(self.__buffer)
+            else:
+                if len(self.__buffer) > 0:
+                    self.__upload_part()
+                self.__wait()
+                self.__s3_client.complete_multipart_upload(Bucket=self.__bucket_name,
+                                                           Key=self.__key,
+                                                           UploadId=self.__upload_id,
+                                                           MultipartUpload={'Parts': self.__parts})
+        except Exception:
+            self.abort()
+            raise
+        self.closed = True
+
+    def abort(self):
+        if self.__uploading is not None:
+            # The part in flight has to finish, or it could land after the upload is aborted
+            try:
+                self.__wait()
+            except Exception:
+                pass
+        if self.__upload_id is not None:
+            self.__s3_client.abort_multipart_upload(Bucket=self.__bucket_name,
+                                                    Key=self.__key,
+                                                    UploadId=self.__upload_id)
+            self.__upload_id = None
+        self.__buffer.clear()
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
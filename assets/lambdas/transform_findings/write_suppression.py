@@ -0,0 +1,143 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from aws_clients import backoff
+
+# Security Hub re-emits findings with only these changed, they do not make a finding worth storing again
+VOLATILE_FIELDS = ('CreatedAt', 'UpdatedAt', 'FirstObservedAt', 'LastObservedAt', 'ProcessedAt')
+
+DEFAULT_CACHE_SIZE = 100000
+# BatchGetItem reads at most 100 keys, BatchWriteItem writes at most 25 items
+GET_BATCH_SIZE = 100
+WRITE_BATCH_SIZE = 25
+# Security Hub archives findings that are not updated for 90 days, their fingerprints expire with them
+FINGERPRINT_TTL_SECONDS = 90 * 24 * 3600
+# Unprocessed keys and items are what DynamoDB returns when throttling, they are retried with backoff this often
+MAXIMUM_ATTEMPTS = 8
+
+
+def fingerprint(finding: dict) -> str:
+    stable = {k: v for k, v in finding.items() if k not in VOLATILE_FIELDS}
+    # 128 bits are plenty to tell apart the versions of one finding, and keep the store compact
+    return hashlib.sha256(json.dumps(stable, sort_keys=True).encode('utf-8')).hexdigest()[:32]
+
+
+class MemoryFingerprintStore:
+    """Last seen fingerprint per finding Id, kept in memory.  Stands in for DynamoDB in tests and local runs"""
+
+    def __init__(self):
+        self.__fingerprints = {}
+        self.__lock = threading.Lock()
+
+    def get_many(self, finding_ids: list) -> dict:
+        with self.__lock:
+            return {i: self.__fingerprints[i] for i in finding_ids if i in self.__fingerprints}
+
+    def put_many(self, fingerprints: dict):
+        with self.__lock:
+            self.__fingerprints.update(fingerprints)
+
+
+class DynamoDBFingerprintStore:
+    """Last seen fingerprint per finding Id, in a DynamoDB table keyed by `Id` that expires items on `ExpiresAt`"""
+
+    def __init__(self, dynamodb_client, table_name: str, clock=time.time, sleep=time.sleep):
+        self.__dynamodb_client = dynamodb_client
+        self.__table_name = table_name
+        self.__clock = clock
+        self.__sleep = sleep
+
+    def __retry_unprocessed(self, call, request: dict, unprocessed: str):
+        """Calls `call` until DynamoDB processed the whole request, backing off before sending what it left over"""
+        for attempt in range(MAXIMUM_ATTEMPTS):
+            if attempt > 0:
+                self.__sleep(backoff(attempt - 1))
+            response = call(RequestItems=request)
+            yield response
+            request = response.get(unprocessed) or {}
+            if len(request) == 0:
+                return
+        raise RuntimeError(f'{unprocessed} left in {self.__table_name} after {MAXIMUM_ATTEMPTS} attempts')
+
+    def get_many(self, finding_ids: list) -> dict:
+        unique = list(dict.fromkeys(finding_ids))
+        found = {}
+        for start in range(0, len(unique), GET_BATCH_SIZE):
+            request = {self.__table_name: {
+                'Keys': [{'Id': {'S': i}} for i in unique[start:start + GET_BATCH_SIZE]],
+                'ProjectionExpression': '#id, #fingerprint',
+                'ExpressionAttributeNames': {'#id': 'Id', '#fingerprint': 'Fingerprint'}
+            }}
+            for response in self.__retry_unprocessed(self.__dynamodb_client.batch_get_item, request, 'UnprocessedKeys'):
+                for item in response['Responses'].get(self.__table_name, []):
+                    found[item['Id']['S']] = item['Fingerprint']['S']
+        return found
+
+    def put_many(self, fingerprints: dict):
+        expires_at = str(int(self.__clock() + FINGERPRINT_TTL_SECONDS))
+        items = [{'PutRequest': {'Item': {'Id': {'S': i}, 'Fingerprint': {'S': f}, 'ExpiresAt': {'N': expires_at}}}}
+                 for i, f in fingerprints.items()]
+        for start in range(0, len(items), WRITE_BATCH_SIZE):
+            request = {self.__table_name: items[start:start + WRITE_BATCH_SIZE]}
+            for _ in self.__retry_unprocessed(self.__dynamodb_client.batch_write_item, request, 'UnprocessedItems'):
+                pass
+
+
+class WriteSuppressor:
+    """Tells findings that changed since they were last stored from re-imports that only changed timestamps.
+
+    Fingerprints are looked up in an LRU cache held by the container first and in the store for the rest.  They
+    are only stored once the findings they belong to are written, see `commit`, so findings of an object that fails
+    are not suppressed when it is retried.
+    """
+
+    def __init__(self, store, cache_size: int = DEFAULT_CACHE_SIZE):
+        self.__store = store
+        self.__cache_size = cache_size
+        self.__cache = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def __cached(self, finding_ids: list) -> dict:
+        with self.__lock:
+            found = {}
+            for i in finding_ids:
+                if i in self.__cache:
+                    self.__cache.move_to_end(i)
+                    found[i] = self.__cache[i]
+            return found
+
+    def __remember(self, fingerprints: dict):
+        with self.__lock:
+            for i, f in fingerprints.items():
+                self.__cache[i] = f
+                self.__cache.move_to_end(i)
+            while len(self.__cache) > self.__cache_size:
+                self.__cache.popitem(last=False)
+
+    def suppressed(self, findings: list) -> tuple:
+        """Returns whether each finding is an unchanged re-import, and the fingerprints to `commit` once the changed
+        findings are written"""
+        finding_ids = [f.get('Id') for f in findings if f.get('Id') is not None]
+        previous = self.__cached(finding_ids)
+        missing = [i for i in finding_ids if i not in previous]
+        if len(missing) > 0:
+            stored = self.__store.get_many(missing)
+            self.__remember(stored)
+            previous.update(stored)
+
+        flags, pending = [], {}
+        for finding in findings:
+            finding_id = finding.get('Id')
+            current = fingerprint(finding)
+            unchanged = finding_id is not None and (pending.get(finding_id) or previous.get(finding_id)) == current
+            flags.append(unchanged)
+            if finding_id is not None and not unchanged:
+                pending[finding_id] = current
+        return flags, pending
+
+    def commit(self, pending: dict):
+        if len(pending) > 0:
+            self.__store.put_many(pending)
+            self.__remember(pending)
@@ -0,0 +1,79 @@
+from typing import List, Optional
+
+SEVERITY_LABELS = ['INFORMATIONAL', 'LOW', 'MEDIUM', 'HIGH', 'CRITICAL']
+
+
+class FindingFilter:
+    """Which imported findings are worth streaming, compiled into the `detail` of an EventBridge event pattern.
+
+    Every condition given has to hold: a severity label of at least `severity_floor`, a record state in
+    `record_states`, a compliance status in `compliance_statuses` (findings without one, such as GuardDuty's, pass)
+    and a product name in `products`, or not in `excluded_products`.  `complement()` matches exactly the findings
+    this filter drops, so they can be routed elsewhere instead of being lost.
+
+    Security Hub puts one finding in every event, EventBridge would otherwise match the conditions against any of
+    the findings in the event.
+    """
+
+    def __init__(self, severity_floor: Optional[str] = None, record_states: Optional[List[str]] = None,
+                 compliance_statuses: Optional[List[str]] = None, products: Optional[List[str]] = None,
+                 excluded_products: Optional[List[str]] = None):
+        if severity_floor is not None and severity_floor not in SEVERITY_LABELS:
+            raise ValueError(f'severity_floor must be one of {SEVERITY_LABELS}, not {severity_floor}')
+        if products and excluded_products:
+            raise ValueError('Either products or excluded_products can be given, not both')
+        self.__severity_floor = severity_floor
+        self.__record_states = record_states
+        self.__compliance_statuses = compliance_statuses
+        self.__products = products
+        self.__excluded_products = excluded_products
+
+    @property
+    def is_empty(self) -> bool:
+        return len(self.__conditions()) == 0
+
+    def __conditions(self) -> list:
+        """Returns (path, matching values, values matching everything else) for every condition given"""
+        conditions = []
+        if self.__severity_floor is not None:
+            floor = SEVERITY_LABELS.index(self.__severity_floor)
+            if floor > 0:
+                conditions.append((['Severity', 'Label'], SEVERITY_LABELS[floor:], SEVERITY_LABELS[:floor]))
+        if self.__record_states:
+            conditions.append((['RecordState'], self.__record_states, [{'anything-but': self.__record_states}]))
+        if self.__compliance_statuses:
+            conditions.append((['Compliance', 'Status'], self.__compliance_statuses + [{'exists': False}],
+                               [{'anything-but': self.__compliance_statuses}]))
+        if self.__products:
+            conditions.append((['ProductName'], self.__products, [{'anything-but': self.__products}]))
+        if self.__excluded_products:
+            conditions.append((['ProductName'], [{'anything-but': self.__excluded_products}],
+                               self.__excluded_products))
+        return conditions
+
+    @staticmethod
+    def __finding_pattern(patterns: list) -> dict:
+        finding = {}
+        for path, values in patterns:
+            node = finding
+            for name in path[:-1]:
+                node = node.setdefault(name, {})
+            node[path[-1]] = values
+        return {'findings': finding}
+
+    def detail(self) -> Optional[dict]:
+        """The detail pattern of the findings to keep, None when every finding is kept"""
+        conditions = self.__conditions()
+        if len(conditions) == 0:
+            return None
+        return FindingFilter.__finding_pattern([(path, keep) for path, keep, _ in conditions])
+
+    def complement(self) -> Optional[dict]:
+        """The detail pattern of the findings `detail()` drops, those failing any one of the conditions"""
+        conditions = self.__conditions()
+        if len(conditions) == 0:
+            return None
+        alternatives = [FindingFilter.__finding_pattern([(path, drop)]) for path, _, drop in conditions]
+        if len(alternatives) == 1:
+            return alternatives[0]
+        return {'$or': alternatives}
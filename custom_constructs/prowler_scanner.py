@@ -1,3 +1,4 @@
+import json
 from os import path
 from aws_cdk import (
     core as cdk,
@@ -6,11 +7,13 @@ from aws_cdk import (
     aws_iam as iam,
     aws_lambda as lmb,
     aws_logs as logs,
+    aws_s3 as s3,
     aws_sns as sns,
     aws_sns_subscriptions as sns_subscriptions,
     aws_sqs as sqs,
     custom_resources
 )
+from typing import Dict, List, Optional
 from .security_hub import SecurityHub
 
 MAXIMUM_LAMBDA_TIME = cdk.Duration.minutes(15)
@@ -20,21 +23,70 @@ class ProwlerScanner(cdk.Construct):
     """This is a Scanner"""
 
     def __init__(self, scope: cdk.Construct, identifier: str,
-                 schedule: events.Schedule = events.Schedule.rate(cdk.Duration.hours(1))
+                 schedule: events.Schedule = events.Schedule.rate(cdk.Duration.hours(1)),
+                 publish_rate: float = 50.0,
+                 publish_burst: int = 20,
+                 max_concurrent_checks: int = 4,
+                 check_timeout: cdk.Duration = cdk.Duration.minutes(10),
+                 scanner_memory_size: int = 2048,
+                 invocation_budget: cdk.Duration = cdk.Duration.minutes(10),
+                 incremental: bool = False,
+                 cache_ttls: Optional[Dict[str, cdk.Duration]] = None,
+                 default_cache_ttl: cdk.Duration = cdk.Duration.hours(6),
+                 scan_accounts: Optional[List[str]] = None,
+                 scan_regions: Optional[List[str]] = None,
+                 scan_role_name: str = 'ProwlerScanRole',
+                 account_concurrency: int = 4,
+                 service_concurrency: int = 2,
+                 max_scanner_invocations: Optional[int] = None
                  ):
         super().__init__(scope, identifier)
         self.__this_dir = path.dirname(__file__)
 
         fanout_topic = sns.Topic(self, 'ProwlerFanoutTopic')
 
-        list_checks = self.__create_list_function(fanout_topic)
+        # Durations of past checks, used to pack checks into scan invocations
+        self.__state_bucket = s3.Bucket(self, 'ProwlerStateBucket',
+                                        auto_delete_objects=True,
+                                        removal_policy=cdk.RemovalPolicy.DESTROY,
+                                        encryption=s3.BucketEncryption.S3_MANAGED)
+
+        # Every check runs in every account and region scanned, the list function packs for all of them
+        targets = len(scan_accounts or [None]) * len(scan_regions or [None])
+        list_checks = self.__create_list_function(fanout_topic, publish_rate, publish_burst, invocation_budget,
+                                                  max_concurrent_checks, targets)
 
         events.Rule(self, 'ProwlerScannerSchedule',
                     description='This Rule triggers Prowler to scan at the rate specified in the schedule',
                     schedule=schedule,
                     targets=[events_targets.LambdaFunction(handler=list_checks)])
 
-        scanner = self.__create_scanner_function(fanout_topic)
+        environment = {
+            # Checks are skipped within their TTL, keyed by check prefix
+            'incremental': str(incremental).lower(),
+            'cache_ttls': json.dumps({k: v.to_seconds() for k, v in (cache_ttls or {}).items()}),
+            'default_cache_ttl': str(default_cache_ttl.to_seconds()),
+            # Throttling in one account only slows the checks of that account.  Both caps hold per scanner invocation,
+            # max_scanner_invocations bounds how many apply them at once
+            'account_concurrency': str(account_concurrency),
+            'service_concurrency': str(service_concurrency)
+        }
+        if scan_accounts or scan_regions:
+            # Other accounts are scanned by assuming scan_role_name in them, this account with the scanner's own role.
+            # Findings are imported with the same credentials, the role also needs securityhub:BatchImportFindings
+            environment['accounts'] = json.dumps(scan_accounts or [cdk.Aws.ACCOUNT_ID])
+            environment['regions'] = json.dumps(scan_regions or [cdk.Aws.REGION])
+            if scan_accounts:
+                environment['role_name'] = scan_role_name
+
+        scanner = self.__create_scanner_function(fanout_topic, max_concurrent_checks, check_timeout,
+                                                 scanner_memory_size, environment, max_scanner_invocations)
+        if scan_accounts:
+            scanner.add_to_role_policy(iam.PolicyStatement(
+                actions=['sts:AssumeRole'],
+                resources=[f'arn:aws:iam::{a}:role/{scan_role_name}' for a in scan_accounts],
+                effect=iam.Effect.ALLOW
+            ))
 
         queue = sqs.Queue(self, 'ProwlerDeadLetter')
 
@@ -47,33 +99,57 @@ class ProwlerScanner(cdk.Construct):
 
 
 
+    @property
+    def state_bucket(self) -> s3.Bucket:
+        return self.__state_bucket
+
     @property
     def security_hub_product_arn(self):
         return f'arn:aws:securityhub:{cdk.Aws.REGION}::product/prowler/prowler'
 
-    def __create_list_function(self, fanout_topic: sns.Topic):
+    def __create_list_function(self, fanout_topic: sns.Topic, publish_rate: float, publish_burst: int,
+                               invocation_budget: cdk.Duration, lanes: int, targets: int):
         ret = lmb.DockerImageFunction(self, 'ProwlerListChecks',
                                       code=lmb.DockerImageCode.from_image_asset(
                                           path.join(self.__this_dir, '../assets/containers/prowler_list_check')),
                                       environment={
-                                          'topic_arn': fanout_topic.topic_arn
+                                          'topic_arn': fanout_topic.topic_arn,
+                                          # Messages per second published to the fanout topic, and the burst allowed
+                                          'publish_rate': str(publish_rate),
+                                          'publish_burst': str(publish_burst),
+                                          'state_bucket': self.__state_bucket.bucket_name,
+                                          'budget_seconds': str(invocation_budget.to_seconds()),
+                                          'lanes': str(lanes),
+                                          'targets': str(targets)
                                       },
                                       timeout=MAXIMUM_LAMBDA_TIME)
 
         fanout_topic.grant_publish(ret)
+        self.__state_bucket.grant_read(ret)
         return ret
 
-    def __create_scanner_function(self, fanout_topic: sns.Topic):
+    def __create_scanner_function(self, fanout_topic: sns.Topic, max_concurrent_checks: int,
+                                  check_timeout: cdk.Duration, memory_size: int, scan_environment: dict,
+                                  reserved_concurrency: Optional[int]):
+        # Checks run as concurrent subprocesses, memory also buys the vCPUs they run on
         ret = lmb.DockerImageFunction(self, 'ProwlerScan',
                                       code=lmb.DockerImageCode.from_image_asset(
                                           path.join(self.__this_dir, '../assets/containers/prowler_scan_check')
                                       ),
                                       environment={
-                                          'topic_arn': fanout_topic.topic_arn
+                                          'topic_arn': fanout_topic.topic_arn,
+                                          'max_concurrency': str(max_concurrent_checks),
+                                          'check_timeout': str(check_timeout.to_seconds()),
+                                          'state_bucket': self.__state_bucket.bucket_name,
+                                          **scan_environment
                                       },
+                                      memory_size=memory_size,
+                                      # Messages over the limit wait in Lambda's asynchronous retry
+                                      reserved_concurrent_executions=reserved_concurrency,
                                       timeout=MAXIMUM_LAMBDA_TIME)
 
         fanout_topic.grant_publish(ret)
+        self.__state_bucket.grant_read_write(ret)
 
         ret.add_to_role_policy(iam.PolicyStatement(
             actions=[
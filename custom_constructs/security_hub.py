@@ -13,6 +13,24 @@ from aws_cdk import (
 )
 from typing import Optional, List
 from os import path
+from .finding_filter import FindingFilter
+
+# Buffering hints, how long and how much Firehose buffers before writing an object
+MAXIMUM_BUFFERING = (900, 128)
+LOW_LATENCY = 'low-latency'
+BULK = 'bulk'
+BUFFERING_PROFILES = {
+    # Findings reach the transform within a minute, in many small objects
+    LOW_LATENCY: (60, 5),
+    # Few large objects, the cheapest to store, list and transform
+    BULK: MAXIMUM_BUFFERING
+}
+# Firehose rejects smaller buffers once dynamic partitioning is enabled
+MINIMUM_PARTITIONED_BUFFER_MIB = 64
+
+# Partition keys extracted from every EventBridge envelope.  Aggregated findings arrive in the aggregation region, so
+# the region comes from the finding itself
+PARTITION_QUERY = '{account: .detail.findings[0].AwsAccountId, region: (.detail.findings[0].Region // .region)}'
 
 
 class SecurityHub(cdk.Construct):
@@ -53,7 +71,26 @@ class SecurityHub(cdk.Construct):
                                   bucket_name: str,
                                   bucket_arn: str,
                                   bucket_region=None,
-                                  raw_prefix='raw/firehose'):
+                                  raw_prefix='raw/firehose',
+                                  error_prefix='errors/firehose',
+                                  buffering_profile: str = BULK,
+                                  compression_format: str = 'GZIP',
+                                  dynamic_partitioning: bool = False,
+                                  finding_filter: Optional[FindingFilter] = None,
+                                  low_value_prefix: Optional[str] = None):
+        """Delivers every imported finding to `raw_prefix` in the bucket through a Firehose delivery stream.
+
+        Records are newline delimited and, by default, GZIP compressed.  With `dynamic_partitioning` objects are
+        written under `account=<id>/region=<region>/` below the prefix, followed by the usual yyyy/MM/dd/HH.
+
+        Only the findings passing `finding_filter` are streamed, the filter is part of the EventBridge rule so the
+        others are never transferred.  Given a `low_value_prefix`, the findings it drops go there instead, through a
+        second stream buffering as much as Firehose allows.  The transform does not read that prefix.
+        """
+        if buffering_profile not in BUFFERING_PROFILES:
+            raise ValueError(f'buffering_profile must be one of {list(BUFFERING_PROFILES)}, not {buffering_profile}')
+        if low_value_prefix is not None and (finding_filter is None or finding_filter.is_empty):
+            raise ValueError('low_value_prefix needs a finding_filter deciding which findings are low value')
         if bucket_region is None:
             bucket_region = cdk.Aws.REGION
 
@@ -68,29 +105,77 @@ class SecurityHub(cdk.Construct):
 
         target_bucket.grant_read_write(role)
 
-        delivery_stream = kinesisfirehose.CfnDeliveryStream(self, 'SHDeliveryStream',
-                                                            delivery_stream_type='DirectPut',
-                                                            extended_s3_destination_configuration=kinesisfirehose.CfnDeliveryStream.ExtendedS3DestinationConfigurationProperty(
-                                                                role_arn=role.role_arn,
-                                                                bucket_arn=target_bucket.bucket_arn,
-                                                                buffering_hints=kinesisfirehose.CfnDeliveryStream.BufferingHintsProperty(
-                                                                    interval_in_seconds=900,
-                                                                    size_in_m_bs=128
-                                                                ),
-                                                                compression_format='UNCOMPRESSED',
-                                                                prefix=raw_prefix
-                                                            ))
-
-        stream_rule = events.Rule(self, 'StreamFromKinesisToS3',
+        interval, size = BUFFERING_PROFILES[buffering_profile]
+        delivery_stream = self.__create_delivery_stream('SHDeliveryStream', target_bucket, role, raw_prefix,
+                                                        error_prefix, interval, size, compression_format,
+                                                        dynamic_partitioning)
+        self.__stream_rule('StreamFromKinesisToS3', delivery_stream,
+                           finding_filter.detail() if finding_filter is not None else None)
+
+        if low_value_prefix is not None:
+            interval, size = MAXIMUM_BUFFERING
+            low_value_stream = self.__create_delivery_stream('SHLowValueDeliveryStream', target_bucket, role,
+                                                             low_value_prefix, error_prefix, interval, size,
+                                                             'GZIP', False)
+            self.__stream_rule('StreamLowValueToS3', low_value_stream, finding_filter.complement())
+
+    def __stream_rule(self, identifier: str, delivery_stream: kinesisfirehose.CfnDeliveryStream,
+                      detail: Optional[dict]):
+        stream_rule = events.Rule(self, identifier,
                                   event_pattern=events.EventPattern(
                                       source=['aws.securityhub'],
                                       detail_type=['Security Hub Findings - Imported'],
+                                      detail=detail
                                   ))
         target = events_targets.KinesisFirehoseStream(
             stream=delivery_stream,
         )
         stream_rule.add_target(target)
 
+    def __create_delivery_stream(self, identifier: str, target_bucket: s3.IBucket, role: iam.Role, prefix: str,
+                                 error_prefix: str, interval: int, size: int, compression_format: str,
+                                 dynamic_partitioning: bool) -> kinesisfirehose.CfnDeliveryStream:
+        # Newline delimited records can be read line by line, instead of splitting them on }{
+        processors = [kinesisfirehose.CfnDeliveryStream.ProcessorProperty(type='AppendDelimiterToRecord')]
+        if dynamic_partitioning:
+            size = max(size, MINIMUM_PARTITIONED_BUFFER_MIB)
+            processors.insert(0, kinesisfirehose.CfnDeliveryStream.ProcessorProperty(
+                type='MetadataExtraction',
+                parameters=[
+                    kinesisfirehose.CfnDeliveryStream.ProcessorParameterProperty(
+                        parameter_name='MetadataExtractionQuery', parameter_value=PARTITION_QUERY),
+                    kinesisfirehose.CfnDeliveryStream.ProcessorParameterProperty(
+                        parameter_name='JsonParsingEngine', parameter_value='JQ-1.6')
+                ]))
+            # Firehose only adds the time prefix itself without dynamic partitioning
+            prefix = (f'{prefix}/account=!{{partitionKeyFromQuery:account}}/'
+                      f'region=!{{partitionKeyFromQuery:region}}/!{{timestamp:yyyy/MM/dd/HH}}/')
+
+        delivery_stream = kinesisfirehose.CfnDeliveryStream(self, identifier,
+                                                            delivery_stream_type='DirectPut',
+                                                            extended_s3_destination_configuration=kinesisfirehose.CfnDeliveryStream.ExtendedS3DestinationConfigurationProperty(
+                                                                role_arn=role.role_arn,
+                                                                bucket_arn=target_bucket.bucket_arn,
+                                                                buffering_hints=kinesisfirehose.CfnDeliveryStream.BufferingHintsProperty(
+                                                                    interval_in_seconds=interval,
+                                                                    size_in_m_bs=size
+                                                                ),
+                                                                compression_format=compression_format,
+                                                                prefix=prefix,
+                                                                # Outside raw_prefix, so failed records do not trigger the transform
+                                                                error_output_prefix=f'{error_prefix}/!{{firehose:error-output-type}}/!{{timestamp:yyyy/MM/dd/HH}}/',
+                                                                processing_configuration=kinesisfirehose.CfnDeliveryStream.ProcessingConfigurationProperty(
+                                                                    enabled=True,
+                                                                    processors=processors
+                                                                )
+                                                            ))
+        if dynamic_partitioning:
+            # Not modelled by this version of the CloudFormation resource specification
+            delivery_stream.add_property_override(
+                'ExtendedS3DestinationConfiguration.DynamicPartitioningConfiguration',
+                {'Enabled': True, 'RetryOptions': {'DurationInSeconds': 300}})
+        return delivery_stream
+
     def enable_import_findings_for_product(self, product_arn):
         this_dir = path.dirname(__file__)
 
@@ -1,19 +1,119 @@
+import json
 from os import path
 from aws_cdk import (
     core as cdk,
+    aws_dynamodb as dynamodb,
+    aws_events as events,
+    aws_events_targets as events_targets,
     aws_iam as iam,
     aws_glue as glue,
     aws_lambda as lmb,
     aws_lambda_python as lambda_python,
     aws_ssm as ssm,
+    aws_sqs as sqs,
     aws_s3 as s3,
     aws_s3_notifications as s3_notifications
 )
+from typing import List, Optional
+
+# Flattened ASFF columns common to every product, extra columns in the data are ignored by the SerDe
+FINDING_COLUMNS = [
+    'Id', 'SchemaVersion', 'ProductArn', 'GeneratorId', 'AwsAccountId', 'Title', 'Description',
+    'CreatedAt', 'UpdatedAt', 'FirstObservedAt', 'LastObservedAt',
+    'Severity_Label', 'Severity_Normalized', 'Severity_Original', 'Severity_Product',
+    'Compliance_Status', 'RecordState', 'WorkflowState', 'Workflow_Status',
+    'Remediation_Recommendation_Text', 'Remediation_Recommendation_Url', 'Types_0',
+    'Resources_0_Type', 'Resources_0_Id', 'Resources_0_Region', 'Resources_0_Partition',
+    'ProductFields_aws_securityhub_ProductName', 'ProductFields_aws_securityhub_CompanyName',
+    'ProductFields_StandardsControlArn', 'ProductFields_RuleId'
+]
+
+# Joined in from the CMDB snapshot when enrichment is enabled
+CMDB_COLUMNS = ['Cmdb_Owner', 'Cmdb_BusinessUnit', 'Cmdb_Environment']
+
+# Tables of normalized output, written next to the findings and keyed by finding Id, with the prefix each is
+# written under and its columns
+CHILD_TABLES = {
+    'finding_resources': ('FindingResources', ['Type', 'Id', 'Partition', 'Region', 'ResourceRole', 'Tags', 'Details']),
+    'finding_types': ('FindingTypes', ['Type']),
+    'finding_related_findings': ('FindingRelatedFindings', ['ProductArn', 'Id'])
+}
+CHILD_KEY_COLUMNS = ['FindingId', 'FindingUpdatedAt', 'Position']
+
+# Columns of the heartbeats written for unchanged re-imports, always as JSON lines
+HEARTBEAT_COLUMNS = ['Id', 'AwsAccountId', 'ProductArn', 'UpdatedAt', 'LastObservedAt']
+
+# Column types of typed output, columns not listed stay strings
+TYPED_COLUMNS = {
+    'CreatedAt': 'timestamp', 'UpdatedAt': 'timestamp', 'FirstObservedAt': 'timestamp', 'LastObservedAt': 'timestamp',
+    'Severity_Normalized': 'bigint', 'Severity_Product': 'double'
+}
+
+SERDES = {
+    'json': glue.CfnTable.StorageDescriptorProperty(
+        input_format='org.apache.hadoop.mapred.TextInputFormat',
+        output_format='org.apache.hadoop.hive.ql.io.HiveIgnoreKeyTextOutputFormat',
+        serde_info=glue.CfnTable.SerdeInfoProperty(
+            serialization_library='org.openx.data.jsonserde.JsonSerDe',
+            parameters={'ignore.malformed.json': 'true'}
+        )),
+    'parquet': glue.CfnTable.StorageDescriptorProperty(
+        input_format='org.apache.hadoop.hive.ql.io.parquet.MapredParquetInputFormat',
+        output_format='org.apache.hadoop.hive.ql.io.parquet.MapredParquetOutputFormat',
+        serde_info=glue.CfnTable.SerdeInfoProperty(
+            serialization_library='org.apache.hadoop.hive.ql.io.parquet.serde.ParquetHiveSerDe'
+        ))
+}
+
 
 class AnalyticSinkStack(cdk.Stack):
-    def __init__(self, scope: cdk.Construct, construct_id: str, **kwargs):
+    def __init__(self, scope: cdk.Construct, construct_id: str,
+                 output_format: str = 'json',
+                 parquet_compression: str = 'snappy',
+                 output_compression: str = 'none',
+                 log_sample_rate: float = 0.0,
+                 compaction_schedule: events.Schedule = events.Schedule.rate(cdk.Duration.hours(1)),
+                 compaction_target_size: int = 128 * 1024 * 1024,
+                 current_state_prefix: Optional[str] = 'Current',
+                 current_state_buckets: int = 4,
+                 partition_layout: str = 'legacy',
+                 projected_accounts: Optional[List[str]] = None,
+                 projected_products: Optional[List[str]] = None,
+                 projected_regions: Optional[List[str]] = None,
+                 partition_registration: bool = False,
+                 crawler_schedule: Optional[str] = 'cron(0 0/1 * * ? *)',
+                 typed_output: bool = False,
+                 keep_arrays: bool = False,
+                 queue_ingestion: bool = True,
+                 ingestion_batch_size: int = 100,
+                 ingestion_batching_window: cdk.Duration = cdk.Duration.seconds(30),
+                 write_suppression: bool = False,
+                 heartbeat_prefix: Optional[str] = 'Heartbeats',
+                 cmdb_key: Optional[str] = None,
+                 cmdb_ttl: cdk.Duration = cdk.Duration.minutes(5),
+                 normalized_output: bool = False,
+                 transform_memory_size: int = 1024,
+                 transform_max_workers: int = 8,
+                 **kwargs):
         super().__init__(scope, construct_id, **kwargs)
+        if partition_registration and partition_layout != 'hive':
+            raise ValueError('partition_registration requires the hive partition layout')
+        if partition_layout == 'hive' and not partition_registration and not (
+                projected_accounts and projected_products and projected_regions):
+            # Injected projection makes every query name one account, product and region, queries across accounts
+            # fail.  Without the values to enumerate, the partitions have to be registered
+            raise ValueError('the hive partition layout requires projected_accounts, projected_products and '
+                             'projected_regions, or partition_registration')
+        if partition_layout == 'hive' and compaction_schedule is not None and not partition_registration:
+            # Projected partitions always read their fixed location, compaction could only merge them in place
+            # where queries see both copies between the write and the delete
+            raise ValueError('compaction of the hive partition layout requires partition_registration, '
+                             'or disable it with compaction_schedule=None')
+        if normalized_output and keep_arrays:
+            raise ValueError('normalized_output writes lists as child tables, keep_arrays does not apply')
+        raw_prefix = 'raw/firehose'
         destination_prefix = 'Findings'
+        findings_table_name = destination_prefix.lower()
         this_dir = path.dirname(__file__)
 
         self.__bucket = s3.Bucket(self, 'Bucket',
@@ -34,20 +134,82 @@ class AnalyticSinkStack(cdk.Stack):
                             parameter_name='/AnalyticSinkStack/BucketArn',
                             string_value=self.__bucket.bucket_arn)
 
+        database = glue.Database(self, 'SecurityHubDatabase',
+                                 database_name='security_hub_database')
+
+        environment = {
+            'bucket_name': self.__bucket.bucket_name,
+            'destination_prefix': destination_prefix,
+            'output_format': output_format,
+            'parquet_compression': parquet_compression,
+            'output_compression': output_compression,
+            'log_sample_rate': str(log_sample_rate),
+            'partition_layout': partition_layout,
+            'typed_output': str(typed_output).lower(),
+            'keep_arrays': str(keep_arrays).lower(),
+            'normalized_output': str(normalized_output).lower(),
+            'max_workers': str(transform_max_workers)
+        }
+        if current_state_prefix is not None:
+            # The latest version of every finding, current_state_buckets objects per account, product and region
+            environment['current_state_prefix'] = current_state_prefix
+            environment['current_state_buckets'] = str(current_state_buckets)
+        if typed_output:
+            # Typed values are converted to the column types the tables declare, not inferred per object
+            environment['column_types'] = json.dumps(self.__columns(typed_output, keep_arrays, cmdb_key is not None,
+                                                                    normalized_output))
+        if cmdb_key is not None:
+            # A CSV, JSON or Parquet snapshot in the bucket, reloaded by the transform when it changes
+            environment['cmdb_key'] = cmdb_key
+            environment['cmdb_ttl_seconds'] = str(cmdb_ttl.to_seconds())
+        # Heartbeats get a table like the child tables, without one they are written where nothing reads them
+        heartbeat_table_name = heartbeat_prefix.lower() if write_suppression and heartbeat_prefix is not None else None
+        if partition_registration:
+            environment['database_name'] = database.database_name
+            environment['table_name'] = findings_table_name
+            if heartbeat_table_name is not None:
+                environment['heartbeat_table'] = heartbeat_table_name
+
         # Transforms Findings so that keys are consumable by Athena
         transform_findings = lambda_python.PythonFunction(self, 'TransformFindings',
                                                           entry=path.join(this_dir,
                                                                           '../assets/lambdas/transform_findings'),
                                                           handler='handler',
                                                           runtime=lmb.Runtime.PYTHON_3_8,
-                                                          environment={
-                                                              'bucket_name': self.__bucket.bucket_name,
-                                                              'destination_prefix': destination_prefix
-                                                          })
+                                                          timeout=cdk.Duration.minutes(5),
+                                                          # Every object in flight keeps a part buffer per output
+                                                          # key, see Sizing the transform in the README
+                                                          memory_size=transform_memory_size,
+                                                          environment=environment)
 
         self.__bucket.grant_read_write(transform_findings)
+        if write_suppression:
+            self.__create_fingerprint_table(transform_findings, heartbeat_prefix)
+        table_names = [findings_table_name] + (list(CHILD_TABLES) if normalized_output else []) + (
+            [heartbeat_table_name] if heartbeat_table_name is not None else [])
+        if partition_registration:
+            # Registers the partitions it writes, they are queryable without waiting for the crawler
+            transform_findings.add_to_role_policy(iam.PolicyStatement(
+                effect=iam.Effect.ALLOW,
+                actions=[
+                    'glue:GetTable',
+                    'glue:BatchCreatePartition'
+                ],
+                resources=[
+                    f'arn:aws:glue:{cdk.Aws.REGION}:{cdk.Aws.ACCOUNT_ID}:catalog',
+                    database.database_arn
+                ] + [f'arn:aws:glue:{cdk.Aws.REGION}:{cdk.Aws.ACCOUNT_ID}:table/{database.database_name}/{t}'
+                     for t in table_names]
+            ))
 
-        self.__bucket.add_object_created_notification(s3_notifications.LambdaDestination(transform_findings))
+        # Only raw objects trigger the transform, never its own output
+        raw_objects = s3.NotificationKeyFilter(prefix=raw_prefix)
+        if queue_ingestion:
+            self.__create_ingestion_queue(transform_findings, raw_objects, ingestion_batch_size,
+                                          ingestion_batching_window)
+        else:
+            self.__bucket.add_object_created_notification(s3_notifications.LambdaDestination(transform_findings),
+                                                          raw_objects)
 
         role = iam.Role(self, 'CrawlerRole',
                         assumed_by=iam.ServicePrincipal('glue.amazonaws.com'))
@@ -94,22 +256,213 @@ class AnalyticSinkStack(cdk.Stack):
             resources=['arn:aws:logs:*:*:/aws-glue/*']
         ))
 
-        database = glue.Database(self, 'SecurityHubDatabase',
-                                 database_name='security_hub_database')
+        crawled_table_name = f'security-hub-crawled-{destination_prefix.lower()}'
+        crawler_paths = []
+        if current_state_prefix is not None:
+            crawler_paths.append(f's3://{self.__bucket.bucket_name}/{current_state_prefix}')
+        enumerations = None if partition_registration else {
+            'account': projected_accounts,
+            'product': projected_products,
+            'region': projected_regions
+        }
+        if partition_layout == 'hive':
+            self.__create_findings_table(database, findings_table_name, destination_prefix, output_format,
+                                         self.__columns(typed_output, keep_arrays, cmdb_key is not None,
+                                                        normalized_output),
+                                         enumerations)
+            if normalized_output:
+                for table_name, (prefix, columns) in CHILD_TABLES.items():
+                    key_columns = {c: 'string' for c in CHILD_KEY_COLUMNS}
+                    if typed_output:
+                        key_columns['Position'] = 'bigint'
+                    self.__create_findings_table(database, table_name, prefix, output_format,
+                                                 dict(key_columns, **{c: 'string' for c in columns}),
+                                                 enumerations, identifier=f'{prefix}Table')
+            if heartbeat_table_name is not None:
+                self.__create_findings_table(database, heartbeat_table_name, heartbeat_prefix, 'json',
+                                             {c: 'string' for c in HEARTBEAT_COLUMNS}, enumerations,
+                                             identifier='HeartbeatsTable')
+        else:
+            crawler_paths.insert(0, f's3://{self.__bucket.bucket_name}/{destination_prefix}')
+            if normalized_output:
+                crawler_paths[1:1] = [f's3://{self.__bucket.bucket_name}/{prefix}'
+                                      for prefix, _ in CHILD_TABLES.values()]
+            if heartbeat_table_name is not None:
+                crawler_paths.append(f's3://{self.__bucket.bucket_name}/{heartbeat_prefix}')
+
+        # With partitions registered by the transform the crawler is only needed to repair schemas, it can be
+        # scheduled rarely or left out.  Hive tables without a current state leave it nothing to crawl
+        if crawler_schedule is not None and len(crawler_paths) > 0:
+            glue.CfnCrawler(self, 'SecurityHubCrawler',
+                            role=role.role_arn,
+                            database_name=database.database_name,
+                            schedule=glue.CfnCrawler.ScheduleProperty(
+                                schedule_expression=crawler_schedule
+                            ),
+                            targets=glue.CfnCrawler.TargetsProperty(
+                                s3_targets=[glue.CfnCrawler.S3TargetProperty(path=p) for p in crawler_paths]
+                            ),
+                            table_prefix='security-hub-crawled-',
+                            # Compaction repoints partitions at merged objects, the crawler must not drop them when
+                            # it finds the original prefix empty
+                            schema_change_policy=glue.CfnCrawler.SchemaChangePolicyProperty(
+                                delete_behavior='LOG'
+                            ),
+                            name='SecurityHubCrawler')
+
+        if compaction_schedule is not None:
+            # Child tables are registered like the findings table, or crawled into a table named after their prefix
+            child_tables = {prefix: table_name if partition_registration else f'security-hub-crawled-{prefix.lower()}'
+                            for table_name, (prefix, _) in CHILD_TABLES.items()} if normalized_output else {}
+            if heartbeat_table_name is not None:
+                child_tables[heartbeat_prefix] = heartbeat_table_name if partition_registration \
+                    else f'security-hub-crawled-{heartbeat_prefix.lower()}'
+            self.__create_compaction(this_dir, destination_prefix, database,
+                                     findings_table_name if partition_registration else crawled_table_name,
+                                     child_tables, compaction_schedule, compaction_target_size)
+
+    def __create_ingestion_queue(self, transform_findings: lmb.IFunction, raw_objects: s3.NotificationKeyFilter,
+                                 batch_size: int, batching_window: cdk.Duration):
+        # Buffers object notifications so one invocation transforms a batch of objects, objects that keep failing
+        # end up in the dead letter queue
+        dead_letter_queue = sqs.Queue(self, 'IngestionDeadLetterQueue',
+                                      retention_period=cdk.Duration.days(14))
+        queue = sqs.Queue(self, 'IngestionQueue',
+                          visibility_timeout=cdk.Duration.minutes(30),
+                          dead_letter_queue=sqs.DeadLetterQueue(max_receive_count=5, queue=dead_letter_queue))
+        self.__bucket.add_object_created_notification(s3_notifications.SqsDestination(queue), raw_objects)
+
+        queue.grant_consume_messages(transform_findings)
+        mapping = transform_findings.add_event_source_mapping('IngestionQueueMapping',
+                                                              event_source_arn=queue.queue_arn,
+                                                              batch_size=batch_size,
+                                                              max_batching_window=batching_window)
+        # Only the messages named in batchItemFailures are retried, the rest of the batch is deleted
+        mapping.node.default_child.add_property_override('FunctionResponseTypes', ['ReportBatchItemFailures'])
+
+    def __create_fingerprint_table(self, transform_findings: lmb.Function, heartbeat_prefix: Optional[str]):
+        # Last stored fingerprint of every finding, re-imports that only changed timestamps are not stored again.
+        # Without a heartbeat prefix they are dropped altogether
+        table = dynamodb.Table(self, 'FingerprintTable',
+                               partition_key=dynamodb.Attribute(name='Id', type=dynamodb.AttributeType.STRING),
+                               billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+                               time_to_live_attribute='ExpiresAt',
+                               removal_policy=cdk.RemovalPolicy.DESTROY)
+        table.grant_read_write_data(transform_findings)
+        transform_findings.add_environment('fingerprint_table', table.table_name)
+        if heartbeat_prefix is not None:
+            transform_findings.add_environment('heartbeat_prefix', heartbeat_prefix)
+        return table
+
+    def __create_findings_table(self, database: glue.Database, table_name: str, destination_prefix: str,
+                                output_format: str, columns: dict, enumerations: Optional[dict],
+                                identifier: str = 'FindingsTable'):
+        # Partition projection computes partitions from the query, no crawler run or catalog lookup is needed.
+        # Account, product and region are enumerated from the projected values.  Without enumerations the table is
+        # left unprojected and the transform registers its partitions.
+        location = f's3://{self.__bucket.bucket_name}/{destination_prefix}'
+        parameters = {'classification': output_format}
+        if enumerations is not None:
+            parameters.update(self.__projection_parameters(location, enumerations))
+
+        serde = SERDES[output_format]
+        return glue.CfnTable(self, identifier,
+                             catalog_id=cdk.Aws.ACCOUNT_ID,
+                             database_name=database.database_name,
+                             table_input=glue.CfnTable.TableInputProperty(
+                                 name=table_name,
+                                 table_type='EXTERNAL_TABLE',
+                                 parameters=parameters,
+                                 partition_keys=[glue.CfnTable.ColumnProperty(name=k, type='string')
+                                                 for k in ['account', 'product', 'region',
+                                                           'year', 'month', 'day', 'hour']],
+                                 storage_descriptor=glue.CfnTable.StorageDescriptorProperty(
+                                     location=f'{location}/',
+                                     columns=[glue.CfnTable.ColumnProperty(name=c.lower(), type=t)
+                                              for c, t in columns.items()],
+                                     input_format=serde.input_format,
+                                     output_format=serde.output_format,
+                                     serde_info=serde.serde_info
+                                 )
+                             ))
+
+    @staticmethod
+    def __columns(typed_output: bool, keep_arrays: bool, enriched: bool, normalized: bool) -> dict:
+        names = FINDING_COLUMNS + (CMDB_COLUMNS if enriched else [])
+        if normalized:
+            # Types and Resources are child tables of normalized output
+            names = [c for c in names if not c.startswith(('Types_', 'Resources_'))]
+        if not typed_output:
+            return {c: 'string' for c in names}
+        columns = {c: TYPED_COLUMNS.get(c, 'string') for c in names}
+        if keep_arrays:
+            del columns['Types_0']
+            columns['Types'] = 'array<string>'
+        return columns
+
+    @staticmethod
+    def __projection_parameters(location: str, enumerations: dict) -> dict:
+        parameters = {
+            'projection.enabled': 'true',
+            'projection.year.type': 'integer',
+            'projection.year.range': '2020,2099',
+            'projection.month.type': 'integer',
+            'projection.month.range': '1,12',
+            'projection.month.digits': '2',
+            'projection.day.type': 'integer',
+            'projection.day.range': '1,31',
+            'projection.day.digits': '2',
+            'projection.hour.type': 'integer',
+            'projection.hour.range': '0,23',
+            'projection.hour.digits': '2',
+            'storage.location.template': f'{location}/account=${{account}}/product=${{product}}/region=${{region}}/'
+                                         'year=${year}/month=${month}/day=${day}/hour=${hour}/'
+        }
+        for key, values in enumerations.items():
+            parameters[f'projection.{key}.type'] = 'enum'
+            parameters[f'projection.{key}.values'] = ','.join(values)
+        return parameters
+
+    def __create_compaction(self, this_dir: str, destination_prefix: str, database: glue.Database, table_name: str,
+                            child_tables: dict, schedule: events.Schedule, target_size: int):
+        # Merges the small objects of closed partitions into a few large ones
+        compact_findings = lambda_python.PythonFunction(self, 'CompactFindings',
+                                                        entry=path.join(this_dir,
+                                                                        '../assets/lambdas/transform_findings'),
+                                                        index='compact_findings.py',
+                                                        handler='handler',
+                                                        runtime=lmb.Runtime.PYTHON_3_8,
+                                                        timeout=cdk.Duration.minutes(15),
+                                                        memory_size=1024,
+                                                        environment={
+                                                            'bucket_name': self.__bucket.bucket_name,
+                                                            'destination_prefix': destination_prefix,
+                                                            'compacted_prefix': 'Compacted',
+                                                            'target_size': str(target_size),
+                                                            'database_name': database.database_name,
+                                                            'table_name': table_name,
+                                                            'child_tables': json.dumps(child_tables)
+                                                        })
+
+        self.__bucket.grant_read_write(compact_findings)
+        compact_findings.add_to_role_policy(iam.PolicyStatement(
+            effect=iam.Effect.ALLOW,
+            actions=[
+                'glue:GetTable',
+                'glue:GetPartition',
+                'glue:UpdatePartition'
+            ],
+            resources=[
+                f'arn:aws:glue:{cdk.Aws.REGION}:{cdk.Aws.ACCOUNT_ID}:catalog',
+                database.database_arn,
+                f'arn:aws:glue:{cdk.Aws.REGION}:{cdk.Aws.ACCOUNT_ID}:table/{database.database_name}/*'
+            ]
+        ))
 
-        glue.CfnCrawler(self, 'SecurityHubCrawler',
-                        role=role.role_arn,
-                        database_name=database.database_name,
-                        schedule=glue.CfnCrawler.ScheduleProperty(
-                            schedule_expression='cron(0 0/1 * * ? *)'
-                        ),
-                        targets=glue.CfnCrawler.TargetsProperty(
-                            s3_targets=[glue.CfnCrawler.S3TargetProperty(
-                                path=f's3://{self.__bucket.bucket_name}/{destination_prefix}'
-                            )]
-                        ),
-                        table_prefix='security-hub-crawled-',
-                        name='SecurityHubCrawler')
+        events.Rule(self, 'CompactFindingsSchedule',
+                    description='Merges the small objects of closed Findings and child table partitions',
+                    schedule=schedule,
+                    targets=[events_targets.LambdaFunction(handler=compact_findings)])
     @property
     def target_bucket(self) -> s3.Bucket:
         return self.__bucket
@@ -0,0 +1,73 @@
+FINDING = {
+    'first/level/test': 'test',
+    'ProductArn': 'arn:aws:securityhub:us-east-1::product/aws/securityhub',
+    'Types': ['Software and Configuration Checks/Industry and Regulatory Standards/CIS AWS Foundations Benchmark'],
+    'Description': 'Security groups provide stateful filtering of ingress/egress network traffic to AWS resources. It is recommended that no security group allows unrestricted ingress access to port 22.',
+    'SchemaVersion': '2018-10-08',
+    'Compliance': {'Status': 'PASSED'},
+    'GeneratorId': 'arn:aws:securityhub:::ruleset/cis-aws-foundations-benchmark/v/1.2.0/rule/4.1',
+    'FirstObservedAt': '2021-01-31T04:52:30.123Z',
+    'CreatedAt': '2021-01-31T04:52:30.123Z',
+    'RecordState': 'ACTIVE',
+    'Title': '4.1 Ensure no security groups allow ingress from 0.0.0.0/0 to port 22',
+    'Workflow': {'Status': 'RESOLVED'},
+    'LastObservedAt': '2021-05-07T11:05:27.353Z',
+    'Severity': {'Normalized': 0, 'Label': 'INFORMATIONAL', 'Product': 0, 'Original': 'INFORMATIONAL'},
+    'UpdatedAt': '2021-05-07T11:05:25.775Z',
+    'FindingProviderFields': {
+        'Types': [
+            'Software and Configuration Checks/Industry and Regulatory Standards/CIS AWS Foundations Benchmark'],
+        'Severity': {'Normalized': 0, 'Label': 'INFORMATIONAL', 'Product': 0, 'Original': 'INFORMATIONAL'}
+    },
+    'WorkflowState': 'NEW',
+    'ProductFields': {
+        'StandardsGuideArn': 'arn:aws:securityhub:::ruleset/cis-aws-foundations-benchmark/v/1.2.0',
+        'StandardsGuideSubscriptionArn': 'arn:aws:securityhub:us-east-1:0123456789:subscription/cis-aws-foundations-benchmark/v/1.2.0',
+        'RuleId': '4.1',
+        'RecommendationUrl': 'https://docs.aws.amazon.com/console/securityhub/standards-cis-4.1/remediation',
+        'RelatedAWSResources:0/name': 'securityhub-restricted-ssh-38a80c22',
+        'RelatedAWSResources:0/type': 'AWS::Config::ConfigRule',
+        'StandardsControlArn': 'arn:aws:securityhub:us-east-1:0123456789:control/cis-aws-foundations-benchmark/v/1.2.0/4.1',
+        'aws/securityhub/ProductName': 'Security Hub',
+        'aws/securityhub/CompanyName': 'AWS',
+        'aws/securityhub/FindingId': 'arn:aws:securityhub:us-east-1::product/aws/securityhub/arn:aws:securityhub:us-east-1:0123456789:subscription/cis-aws-foundations-benchmark/v/1.2.0/4.1/finding/2a55570b-74e9-4aa3-9f4e-66f515c7ff03'
+    },
+    'AwsAccountId': '0123456789',
+    'Id': 'arn:aws:securityhub:us-east-1:0123456789:subscription/cis-aws-foundations-benchmark/v/1.2.0/4.1/finding/2a55570b-74e9-4aa3-9f4e-66f515c7ff03',
+    'Remediation': {
+        'Recommendation': {
+            'Text': 'For directions on how to fix this issue, please consult the AWS Security Hub CIS documentation.',
+            'Url': 'https://docs.aws.amazon.com/console/securityhub/standards-cis-4.1/remediation'}
+    },
+    'Resources': [{
+        'Partition': 'aws',
+        'Type': 'AwsEc2SecurityGroup',
+        'Details': {
+            'AwsEc2SecurityGroup': {
+                'GroupName': 'default',
+                'OwnerId': '0123456789',
+                'VpcId': 'vpc-0123456789',
+                'IpPermissions': [{'IpProtocol': '-1', 'UserIdGroupPairs': [
+                    {'UserId': '0123456789', 'GroupId': 'sg-0123456789'}]}],
+                'IpPermissionsEgress': [{'IpProtocol': '-1', 'IpRanges': [{'CidrIp': '0.0.0.0/0'}]}],
+                'GroupId': 'sg-0123456789'}
+        },
+        'Region': 'us-east-1', 'Id': 'arn:aws:ec2:us-east-1:0123456789:security-group/sg-0123456789'
+    }]
+}
+
+
+def envelope(*findings):
+    """Wraps findings in the EventBridge event Security Hub emits for imported findings"""
+    findings = findings or (FINDING,)
+    return {
+        'version': '0',
+        'id': 'c8c2c9e3-8d7a-4b0e-9a43-0d6c1e4b1f7a',
+        'detail-type': 'Security Hub Findings - Imported',
+        'source': 'aws.securityhub',
+        'account': findings[0]['AwsAccountId'],
+        'time': '2021-05-07T11:05:27Z',
+        'region': 'us-east-1',
+        'resources': [findings[0]['ProductFields']['aws/securityhub/FindingId']],
+        'detail': {'findings': list(findings)}
+    }
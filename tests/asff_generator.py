@@ -0,0 +1,137 @@
+"""Generates realistic Firehose objects of concatenated "Security Hub Findings - Imported" envelopes.
+
+Findings are built deterministically from `seed`, so the same arguments always produce the same bytes.
+"""
+import json
+import random
+import uuid
+
+PRODUCTS = [
+    ('aws', 'securityhub'),
+    ('aws', 'guardduty'),
+    ('aws', 'inspector'),
+    ('aws', 'access-analyzer'),
+    ('prowler', 'prowler'),
+    ('aws', 'macie'),
+]
+
+REGIONS = ['us-east-1', 'us-east-2', 'us-west-1', 'us-west-2', 'eu-west-1', 'eu-central-1', 'ap-southeast-2']
+
+SEVERITIES = [(0, 'INFORMATIONAL'), (1, 'LOW'), (40, 'MEDIUM'), (70, 'HIGH'), (90, 'CRITICAL')]
+
+RESOURCE_TYPES = ['AwsEc2SecurityGroup', 'AwsS3Bucket', 'AwsIamRole', 'AwsEc2Instance', 'AwsLambdaFunction']
+
+TITLES = [
+    '4.1 Ensure no security groups allow ingress from 0.0.0.0/0 to port 22',
+    '2.9 Ensure VPC flow logging is enabled in all VPCs',
+    'S3.1 S3 Block Public Access setting should be enabled',
+    'IAM.6 Hardware MFA should be enabled for the root user',
+    'EC2.19 Security groups should not allow unrestricted access to ports with high risk',
+]
+
+
+def __details(rng: random.Random, depth: int) -> dict:
+    if depth <= 1:
+        return {'Value': rng.choice(['enabled', 'disabled', '0.0.0.0/0', 'sg-0123456789']), 'Count': rng.randint(0, 9)}
+    return {
+        'Name': f'level-{depth}',
+        'Settings': [__details(rng, depth - 1) for _ in range(2)],
+        'Nested': __details(rng, depth - 1)
+    }
+
+
+def __resources(rng: random.Random, account_id: str, region: str, count: int, depth: int) -> list:
+    resources = []
+    for _ in range(count):
+        resource_type = rng.choice(RESOURCE_TYPES)
+        resources.append({
+            'Partition': 'aws',
+            'Type': resource_type,
+            'Region': region,
+            'Id': f'arn:aws:ec2:{region}:{account_id}:{resource_type.lower()}/{rng.getrandbits(48):012x}',
+            'Tags': {'Environment': rng.choice(['prod', 'dev', 'test'])},
+            'Details': {resource_type: __details(rng, depth)}
+        })
+    return resources
+
+
+def generate_finding(rng: random.Random, account_id: str, product: tuple, region: str,
+                     resources_per_finding: int = 1, nesting_depth: int = 3) -> dict:
+    company, product_name = product
+    finding_uuid = uuid.UUID(int=rng.getrandbits(128))
+    title = rng.choice(TITLES)
+    normalized, label = rng.choice(SEVERITIES)
+    if product == ('aws', 'securityhub'):
+        finding_id = (f'arn:aws:securityhub:{region}:{account_id}:subscription/cis-aws-foundations-benchmark/v/1.2.0/'
+                      f'{title.split(" ")[0]}/finding/{finding_uuid}')
+    else:
+        finding_id = f'arn:aws:securityhub:{region}::product/{company}/{product_name}/{finding_uuid}'
+
+    return {
+        'SchemaVersion': '2018-10-08',
+        'Id': finding_id,
+        'ProductArn': f'arn:aws:securityhub:{region}::product/{company}/{product_name}',
+        'GeneratorId': f'arn:aws:securityhub:::ruleset/cis-aws-foundations-benchmark/v/1.2.0/rule/{title.split(" ")[0]}',
+        'AwsAccountId': account_id,
+        'Types': ['Software and Configuration Checks/Industry and Regulatory Standards/CIS AWS Foundations Benchmark'],
+        'FirstObservedAt': '2021-01-31T04:52:30.123Z',
+        'LastObservedAt': '2021-05-07T11:05:27.353Z',
+        'CreatedAt': '2021-01-31T04:52:30.123Z',
+        'UpdatedAt': '2021-05-07T11:05:25.775Z',
+        'Severity': {'Normalized': normalized, 'Label': label, 'Product': normalized, 'Original': label},
+        'Title': title,
+        'Description': f'{title}. Findings like this one repeat in nearly every batch Security Hub delivers.',
+        'Remediation': {
+            'Recommendation': {
+                'Text': 'For directions on how to fix this issue, please consult the AWS Security Hub documentation.',
+                'Url': 'https://docs.aws.amazon.com/console/securityhub/remediation'}
+        },
+        'ProductFields': {
+            'aws/securityhub/ProductName': product_name,
+            'aws/securityhub/CompanyName': company,
+            'aws/securityhub/FindingId': f'arn:aws:securityhub:{region}::product/{company}/{product_name}/{finding_id}'
+            if product == ('aws', 'securityhub') else finding_id,
+            'RelatedAWSResources:0/name': f'securityhub-rule-{finding_uuid.hex[:8]}'
+        },
+        'Resources': __resources(rng, account_id, region, resources_per_finding, nesting_depth),
+        'Compliance': {'Status': rng.choice(['PASSED', 'FAILED', 'WARNING'])},
+        'WorkflowState': 'NEW',
+        'Workflow': {'Status': rng.choice(['NEW', 'NOTIFIED', 'RESOLVED'])},
+        'RecordState': rng.choice(['ACTIVE', 'ARCHIVED'])
+    }
+
+
+def generate_envelopes(findings: int = 1000, accounts: int = 5, products: int = 3, regions: int = 2,
+                       resources_per_finding: int = 1, nesting_depth: int = 3, findings_per_envelope: int = 1,
+                       seed: int = 0):
+    rng = random.Random(seed)
+    account_ids = [f'{100000000000 + i * 7919:012d}' for i in range(accounts)]
+    product_choices = PRODUCTS[:products]
+    region_choices = REGIONS[:regions]
+
+    remaining = findings
+    while remaining > 0:
+        account_id = rng.choice(account_ids)
+        product = rng.choice(product_choices)
+        region = rng.choice(region_choices)
+        batch = [generate_finding(rng, account_id, product, region, resources_per_finding, nesting_depth)
+                 for _ in range(min(findings_per_envelope, remaining))]
+        remaining -= len(batch)
+        resource = batch[0]['ProductFields']['aws/securityhub/FindingId'] if product == ('aws', 'securityhub') \
+            else batch[0]['Id']
+        yield {
+            'version': '0',
+            'id': str(uuid.UUID(int=rng.getrandbits(128))),
+            'detail-type': 'Security Hub Findings - Imported',
+            'source': 'aws.securityhub',
+            'account': account_id,
+            'time': '2021-05-07T11:05:27Z',
+            'region': region,
+            'resources': [resource],
+            'detail': {'findings': batch}
+        }
+
+
+def generate_firehose_object(delimiter: str = '', **kwargs) -> bytes:
+    """Concatenates generated envelopes the way Firehose writes them, back to back unless a delimiter is given"""
+    return ''.join(json.dumps(e) + delimiter for e in generate_envelopes(**kwargs)).encode('utf-8')
@@ -0,0 +1,110 @@
+from assets.lambdas.transform_findings.backfill import Backfill, BackfillManifest, main
+from asff_fixture import envelope
+import boto3
+import gzip
+import json
+from moto import mock_glue, mock_s3
+
+RAW = 'raw/firehose2021/05/07/11'
+
+
+def __make_bucket(bucket_name: str, objects: int):
+    bucket = boto3.resource('s3').Bucket(bucket_name)
+    bucket.create()
+    for i in range(objects):
+        bucket.put_object(Key=f'{RAW}/stream-{i}', Body=json.dumps(envelope()))
+    return bucket
+
+
+@mock_s3
+def test_backfill_resumes_from_manifest(tmp_path):
+    bucket = __make_bucket('tester', 5)
+    manifest = tmp_path / 'manifest.jsonl'
+    BackfillManifest(str(manifest)).record([f'{RAW}/stream-0', f'{RAW}/stream-1'])
+    # An interrupted write leaves a partial line behind
+    with open(manifest, 'a') as f:
+        f.write('{"keys": ["raw/fire')
+
+    result = Backfill(bucket.name, manifest_path=str(manifest), processes=1, batch_size=2,
+                      destination_prefix='Findings').run()
+
+    assert result == {'transformed': 3, 'failed': {}}
+    written = sorted(o.key.split('/')[-1] for o in bucket.objects.filter(Prefix='Findings/'))
+    assert written == ['stream-2.json', 'stream-3.json', 'stream-4.json']
+    assert BackfillManifest(str(manifest)).completed() == {f'{RAW}/stream-{i}' for i in range(5)}
+    assert Backfill(bucket.name, manifest_path=str(manifest), processes=1).run() == {'transformed': 0, 'failed': {}}
+
+
+@mock_s3
+def test_failed_objects_are_retried(tmp_path):
+    bucket = __make_bucket('tester', 2)
+    bucket.put_object(Key=f'{RAW}/corrupt', Body='{"detail": ')
+    manifest = str(tmp_path / 'manifest.jsonl')
+
+    result = Backfill(bucket.name, manifest_path=manifest, processes=1, destination_prefix='Findings').run()
+
+    assert result['transformed'] == 2
+    assert list(result['failed']) == [f'{RAW}/corrupt']
+    assert [o['Key'] for o in Backfill(bucket.name, manifest_path=manifest).pending_objects()] == [f'{RAW}/corrupt']
+
+
+@mock_s3
+def test_dry_run_writes_nothing(tmp_path, capsys):
+    bucket = __make_bucket('tester', 4)
+
+    assert main(['--bucket-name', bucket.name, '--manifest', str(tmp_path / 'manifest.jsonl'),
+                 '--processes', '2', '--dry-run', '--sample-size', '2']) == 0
+
+    estimate = json.loads(capsys.readouterr().out)
+    assert estimate['pending_objects'] == 4
+    assert estimate['sample_objects'] == 2
+    assert estimate['sample_findings'] == 2
+    assert estimate['processes'] == 2
+    assert list(bucket.objects.filter(Prefix='Findings/')) == []
+    assert not (tmp_path / 'manifest.jsonl').exists()
+
+
+@mock_s3
+def test_dry_run_reads_gzip_objects(tmp_path):
+    bucket = __make_bucket('tester', 0)
+    body = ''.join(json.dumps(envelope()) + '\n' for _ in range(3))
+    bucket.put_object(Key='raw/firehose/account=0123456789/region=us-east-1/2021/05/07/11/stream-0.gz',
+                      Body=gzip.compress(body.encode('utf-8')))
+
+    estimate = Backfill(bucket.name, manifest_path=str(tmp_path / 'manifest.jsonl'), processes=1).estimate()
+
+    assert estimate['sample_findings'] == 3
+
+
+@mock_s3
+@mock_glue
+def test_batches_are_not_recorded_when_partitions_fail(tmp_path):
+    bucket = __make_bucket('tester', 2)
+    manifest = str(tmp_path / 'manifest.jsonl')
+
+    # There is no Glue table to register the partitions in
+    result = Backfill(bucket.name, manifest_path=manifest, processes=1, destination_prefix='Findings',
+                      partition_layout='hive', database_name='missing', table_name='findings').run()
+
+
+    assert result['transformed'] == 0 and list(result['failed']) == ['partitions']
+    assert len(Backfill(bucket.name, manifest_path=manifest).pending_objects()) == 2
+
+
+@mock_s3
+def test_cli_takes_the_transform_options(tmp_path, capsys):
+    bucket = __make_bucket('tester', 1)
+    bucket.put_object(Key='cmdb.csv',
+                      Body='account_id,owner,business_unit,environment\n0123456789,platform,retail,prod\n')
+
+    assert main(['--bucket-name', bucket.name, '--manifest', str(tmp_path / 'manifest.jsonl'), '--processes', '1',
+                 '--partition-layout', 'hive', '--normalized-output', '--cmdb-key', 'cmdb.csv',
+                 '--current-state-prefix', 'Current']) == 0
+
+    # Metrics go to standard error, standard output is only the result
+    assert json.loads(capsys.readouterr().out) == {'transformed': 1, 'failed': {}}
+    prefixes = sorted({o.key.split('/')[0] for o in bucket.objects.all()})
+    assert prefixes == ['Current', 'FindingResources', 'FindingTypes', 'Findings', 'cmdb.csv', 'raw']
+    rows = [json.loads(line) for o in bucket.objects.filter(Prefix='Findings/')
+            for line in o.get()['Body'].read().decode('utf-8').splitlines()]
+    assert [r['Cmdb_Owner'] for r in rows] == ['platform']
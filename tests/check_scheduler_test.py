@@ -0,0 +1,57 @@
+from assets.containers.prowler_list_check.app import ProwlerListGroups
+from assets.containers.prowler_list_check.check_scheduler import DurationEstimates, pack
+from assets.containers.prowler_scan_check.duration_history import DurationHistory
+import boto3
+import json
+import pytest
+from moto import mock_s3
+
+WEEK = 7 * 24 * 3600
+
+
+def test_longest_checks_are_placed_first():
+    bins = pack({'a': 400, 'b': 300, 'c': 300, 'd': 200, 'e': 100, 'f': 100}, budget=700)
+
+    assert bins == [['a', 'b'], ['c', 'd', 'e', 'f']]
+    assert pack({'a': 400, 'b': 300, 'c': 300, 'd': 200, 'e': 100, 'f': 100}, budget=700, lanes=2) == [
+        ['a', 'b', 'c', 'd', 'e', 'f']]
+
+
+def test_checks_over_budget_run_alone():
+    assert pack({'huge': 2000, 'small': 10, 'tiny': 5}, budget=600, lanes=4) == [['huge'], ['small', 'tiny']]
+
+
+def test_checks_take_room_for_every_target():
+    assert pack({'a': 100, 'b': 100, 'c': 100}, budget=600) == [['a', 'b', 'c']]
+    assert pack({'a': 100, 'b': 100, 'c': 100}, budget=600, targets=4) == [['a'], ['b'], ['c']]
+    assert pack({'a': 100, 'b': 100, 'c': 100}, budget=600, lanes=2, targets=4) == [['a', 'b', 'c']]
+    assert pack({'a': 100, 'b': 100, 'c': 100}, budget=600, lanes=2, targets=8) == [['a'], ['b'], ['c']]
+
+
+@mock_s3
+def test_recorded_durations_decay_towards_default():
+    s3 = boto3.client('s3')
+    s3.create_bucket(Bucket='state')
+    now = [1000000.0]
+    history = DurationHistory(s3, 'state', clock=lambda: now[0])
+    history.record('check/11', 100)
+    assert history.record('check/11', 200)['seconds'] == pytest.approx(130)
+
+    estimates = DurationEstimates(s3, 'state', default_seconds=60, clock=lambda: now[0])
+    assert estimates.estimates(['check/11', 'check12']) == {'check/11': pytest.approx(130), 'check12': 60}
+    now[0] += WEEK
+    assert estimates.estimates(['check/11'])['check/11'] == pytest.approx(95)
+
+
+@mock_s3
+def test_groups_are_published_packed():
+    s3 = boto3.client('s3')
+    s3.create_bucket(Bucket='state')
+    history = DurationHistory(s3, 'state')
+    for check, seconds in [('group1', 500), ('group2', 400), ('group3', 100)]:
+        history.record(check, seconds)
+
+    messages = ProwlerListGroups('arn:aws:sns:us-east-1:123456789012:fanout', state_bucket='state',
+                                 budget_seconds=600).messages(['group1', 'group2', 'group3', 'group4'])
+
+    assert [json.loads(m) for m in messages] == [['group1', 'group4'], ['group2', 'group3']]
@@ -0,0 +1,84 @@
+from assets.lambdas.transform_findings.cmdb_enrichment import CmdbIndex, CmdbSnapshot, read_rows
+from assets.lambdas.transform_findings.index import TransformFindings
+from assets.lambdas.transform_findings.output_formats import ParquetFormat
+from asff_fixture import FINDING, envelope
+import boto3
+import io
+import json
+import pyarrow
+import pyarrow.parquet
+import pytest
+from moto import mock_s3
+
+ROWS = [
+    {'account_id': '0123456789', 'resource_arn': '', 'owner': 'platform', 'business_unit': 'retail',
+     'environment': 'production'},
+    {'account_id': '0123456789', 'resource_arn': 'arn:aws:ec2:us-east-1:0123456789:security-group/sg-1',
+     'owner': 'payments', 'business_unit': 'retail', 'environment': 'production'}
+]
+CSV = ('account_id,resource_arn,owner,business_unit,environment\n'
+       '0123456789,,platform,retail,production\n'
+       '0123456789,arn:aws:ec2:us-east-1:0123456789:security-group/sg-1,payments,retail,production\n')
+
+
+def __parquet(rows: list) -> bytes:
+    buffer = io.BytesIO()
+    pyarrow.parquet.write_table(pyarrow.Table.from_pylist(rows), buffer)
+    return buffer.getvalue()
+
+
+@pytest.mark.parametrize('key, data', [
+    ('cmdb.csv', CSV.encode('utf-8')),
+    ('cmdb.json', json.dumps(ROWS).encode('utf-8')),
+    ('cmdb.jsonl', ''.join(json.dumps(r) + '\n' for r in ROWS).encode('utf-8')),
+    ('cmdb.parquet', __parquet(ROWS))
+])
+def test_snapshot_formats(key, data):
+    assert read_rows(key, data) == ROWS
+
+
+def test_resources_take_precedence_over_accounts():
+    index = CmdbIndex(ROWS)
+    resource = {'Type': 'AwsEc2SecurityGroup', 'Id': 'arn:aws:ec2:us-east-1:0123456789:security-group/sg-1'}
+
+    assert index.lookup(dict(FINDING, Resources=[resource]))['Cmdb_Owner'] == 'payments'
+    assert index.lookup(dict(FINDING, Resources=[{'Id': 'arn:aws:s3:::other'}])) == {
+        'Cmdb_Owner': 'platform', 'Cmdb_BusinessUnit': 'retail', 'Cmdb_Environment': 'production'}
+    assert index.lookup(dict(FINDING, AwsAccountId='999999999999'))['Cmdb_Owner'] is None
+
+
+@mock_s3
+def test_snapshot_is_reloaded_when_its_etag_changes():
+    s3 = boto3.client('s3')
+    s3.create_bucket(Bucket='tester')
+    s3.put_object(Bucket='tester', Key='cmdb/snapshot.csv', Body=CSV)
+    now = [0]
+    snapshot = CmdbSnapshot(s3, 'tester', 'cmdb/snapshot.csv', ttl_seconds=60, clock=lambda: now[0])
+    first = snapshot.index()
+
+    s3.put_object(Bucket='tester', Key='cmdb/snapshot.csv', Body=CSV.replace('platform', 'security'))
+    assert snapshot.index() is first
+    now[0] += 60
+    assert snapshot.index().lookup(FINDING)['Cmdb_Owner'] == 'security'
+
+    s3.delete_object(Bucket='tester', Key='cmdb/snapshot.csv')
+    now[0] += 60
+    assert snapshot.index().lookup(FINDING)['Cmdb_Owner'] == 'security'
+
+
+@mock_s3
+def test_findings_are_written_enriched():
+    bucket = boto3.resource('s3').Bucket('tester')
+    bucket.create()
+    bucket.put_object(Key='cmdb/snapshot.csv', Body=CSV)
+    bucket.put_object(Key='raw/firehose2021/05/07/11/stream-1', Body=json.dumps(envelope()))
+
+    TransformFindings(bucket.name, destination_prefix='Findings', output_format='parquet', typed_output=True,
+                      cmdb_key='cmdb/snapshot.csv').handle({
+                          'Records': [{'s3': {'object': {'key': 'raw/firehose2021/05/07/11/stream-1'}}}]
+                      }, None)
+
+    written = [o for o in bucket.objects.filter(Prefix='Findings/')]
+    rows = ParquetFormat().read(written[0].get()['Body'].read())
+    assert [(r['Cmdb_Owner'], r['Cmdb_BusinessUnit'], r['Cmdb_Environment']) for r in rows] == [
+        ('platform', 'retail', 'production')]
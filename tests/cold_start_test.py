@@ -0,0 +1,84 @@
+"""Cold start regression gates for the transform Lambda.
+
+Budgets are generous multiples of what the Lambda measures today, so they only trip when a change adds an eager
+heavy import or rebuilds clients per invocation.  The import is timed against importing boto3 in the same
+interpreter, so a slow or busy machine slows both.  Run with -s to see the measurements.
+"""
+from assets.lambdas.transform_findings import index
+from asff_fixture import envelope
+import boto3
+import json
+import os
+import subprocess
+import sys
+import time
+from moto import mock_s3
+
+LAMBDA_DIR = os.path.join(os.path.dirname(__file__), '../assets/lambdas/transform_findings')
+HEAVY_MODULES = ['boto3', 'botocore', 'pyarrow', 'zstandard']
+
+# Importing index takes a fraction of what the boto3 import it defers takes, about a sixth today
+IMPORT_BUDGET_RATIO = 0.5
+IMPORT_RUNS = 3
+FIRST_INVOCATION_BUDGET_SECONDS = 1.0
+WARM_INVOCATION_BUDGET_SECONDS = 0.5
+
+IMPORT_SCRIPT = f'''
+import json, sys, time
+start = time.perf_counter()
+import index
+elapsed = time.perf_counter() - start
+modules = [m for m in {HEAVY_MODULES} if m in sys.modules]
+start = time.perf_counter()
+import boto3
+baseline = time.perf_counter() - start
+print(json.dumps({{"seconds": elapsed, "baseline_seconds": baseline, "modules": modules}}))
+'''
+
+
+def test_import_defers_heavy_modules():
+    runs = [json.loads(subprocess.run([sys.executable, '-c', IMPORT_SCRIPT], cwd=LAMBDA_DIR, check=True,
+                                      capture_output=True, text=True).stdout) for _ in range(IMPORT_RUNS)]
+    # The fastest run is the one least disturbed by whatever else the machine is doing
+    seconds = min(r['seconds'] for r in runs)
+    baseline = min(r['baseline_seconds'] for r in runs)
+    print(f'import index: {seconds * 1000:.1f} ms, import boto3: {baseline * 1000:.1f} ms')
+
+    assert all(r['modules'] == [] for r in runs)
+    assert seconds < baseline * IMPORT_BUDGET_RATIO
+
+
+@mock_s3
+def test_warm_invocations_reuse_instance_and_clients(monkeypatch):
+    bucket = boto3.resource('s3').Bucket('tester')
+    bucket.create()
+    for i in range(2):
+        bucket.put_object(Key=f'raw/firehose2021/05/07/11/stream-{i}', Body=json.dumps(envelope()))
+    monkeypatch.setenv('bucket_name', bucket.name)
+    monkeypatch.setenv('destination_prefix', 'Findings')
+    monkeypatch.setattr(index, '_transform_findings', None)
+
+    def invoke(i):
+        start = time.perf_counter()
+        index.handler({'Records': [{'s3': {'object': {'key': f'raw/firehose2021/05/07/11/stream-{i}'}}}]}, None)
+        return time.perf_counter() - start
+
+    first = invoke(0)
+    instance = index._transform_findings
+    s3_client = index.client('s3', 16)
+    warm = invoke(1)
+    print(f'first invocation: {first * 1000:.1f} ms, warm invocation: {warm * 1000:.1f} ms')
+
+    assert index._transform_findings is instance
+    assert index.client('s3', 16) is s3_client
+    assert first < FIRST_INVOCATION_BUDGET_SECONDS
+    assert warm < WARM_INVOCATION_BUDGET_SECONDS
+
+
+def test_clients_are_built_once_under_concurrent_first_use():
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        clients = list(executor.map(lambda _: index.client('sqs', 11), range(16)))
+
+    assert all(c is clients[0] for c in clients)
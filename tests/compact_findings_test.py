@@ -0,0 +1,263 @@
+from assets.lambdas.transform_findings.compact_findings import CompactFindings
+from assets.lambdas.transform_findings.output_formats import create_output_format
+import boto3
+import gzip
+import io
+import json
+import pyarrow.parquet
+import pytest
+from datetime import datetime, timedelta, timezone
+from moto import mock_glue, mock_s3
+
+PARTITION = 'Findings/0123456789/securityhub/us-east-1/05/07'
+
+
+def __make_bucket(bucket_name: str):
+    bucket = boto3.resource('s3').Bucket(bucket_name)
+    bucket.create()
+    return bucket
+
+
+def __put_json(bucket, count: int, suffix: str = '', prefix: str = PARTITION):
+    for i in range(count):
+        body = json.dumps({'Id': f'finding-{i}'}) + '\n'
+        bucket.put_object(Key=f'{prefix}/stream-{i}.json{suffix}',
+                          Body=gzip.compress(body.encode('utf-8')) if suffix == '.gz' else body)
+
+
+def __objects(bucket, prefix: str) -> list:
+    # Compaction manifests start with an underscore, Athena skips them like these assertions do
+    return [o for o in bucket.objects.filter(Prefix=prefix) if not o.key.rsplit('/', 1)[-1].startswith('_')]
+
+
+def __rows(bucket, prefix: str) -> list:
+    rows = []
+    for o in __objects(bucket, prefix):
+        body = o.get()['Body'].read()
+        if o.key.endswith('.gz'):
+            body = gzip.decompress(body)
+        rows += [json.loads(line) for line in body.decode('utf-8').splitlines()]
+    return sorted(r['Id'] for r in rows)
+
+
+@mock_s3
+def test_merges_partition_in_place():
+    bucket = __make_bucket('tester')
+    __put_json(bucket, 5)
+    __put_json(bucket, 3, suffix='.gz', prefix='Findings/0123456789/guardduty/us-east-1/05/07')
+
+    result = CompactFindings(bucket.name, quiet_minutes=0).handle({}, None)
+
+    assert result == {'compacted_partitions': 2}
+    keys = [o.key for o in __objects(bucket, PARTITION)]
+    assert len(keys) == 1 and keys[0].split('/')[-1].startswith('compacted-')
+    assert __rows(bucket, PARTITION) == [f'finding-{i}' for i in range(5)]
+    gzipped = [o.key for o in __objects(bucket, 'Findings/0123456789/guardduty')]
+    assert len(gzipped) == 1 and gzipped[0].endswith('.json.gz')
+    assert __rows(bucket, 'Findings/0123456789/guardduty') == [f'finding-{i}' for i in range(3)]
+
+    assert CompactFindings(bucket.name, quiet_minutes=0).handle({}, None) == {'compacted_partitions': 0}
+
+
+@mock_s3
+def test_later_runs_only_list_days_since_the_watermark():
+    bucket = __make_bucket('tester')
+    __put_json(bucket, 2)
+    assert CompactFindings(bucket.name, quiet_minutes=0).handle({}, None) == {'compacted_partitions': 1}
+
+    today = datetime.now(timezone.utc)
+    old = today - timedelta(days=40)
+    recent = f'Findings/0123456789/securityhub/us-east-1/{today:%m}/{today:%d}'
+    __put_json(bucket, 2, prefix=recent)
+    __put_json(bucket, 2, prefix=f'Findings/0123456789/securityhub/us-east-1/{old:%m}/{old:%d}')
+
+    assert CompactFindings(bucket.name, quiet_minutes=0).handle({}, None) == {'compacted_partitions': 1}
+    assert len(__objects(bucket, recent)) == 1
+    assert len(__objects(bucket, f'Findings/0123456789/securityhub/us-east-1/{old:%m}/{old:%d}')) == 2
+
+
+@mock_s3
+def test_hive_runs_list_the_hours_closed_since_the_watermark():
+    bucket = __make_bucket('tester')
+    hour = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    bucket.put_object(Key='Findings/_compaction_watermark.json',
+                      Body=json.dumps({'until': (hour - timedelta(hours=3)).isoformat()}))
+
+    def partition(at: datetime) -> str:
+        return (f'Findings/account=0123456789/product=securityhub/region=us-east-1/'
+                f'year={at:%Y}/month={at:%m}/day={at:%d}/hour={at:%H}')
+
+    for hours_ago in [1, 2, 5]:
+        __put_json(bucket, 2, prefix=partition(hour - timedelta(hours=hours_ago)))
+    __put_json(bucket, 2, prefix=partition(hour))
+
+    assert CompactFindings(bucket.name, quiet_minutes=0).handle({}, None) == {'compacted_partitions': 2}
+    assert [len(__objects(bucket, partition(hour - timedelta(hours=h)))) for h in [0, 1, 2, 5]] == [2, 1, 1, 2]
+
+
+@mock_s3
+def test_target_size_splits_output():
+    bucket = __make_bucket('tester')
+    __put_json(bucket, 6)
+    size = bucket.Object(f'{PARTITION}/stream-0.json').content_length
+
+    CompactFindings(bucket.name, target_size=size * 2, quiet_minutes=0).handle({}, None)
+
+    assert len(__objects(bucket, PARTITION)) == 3
+    assert __rows(bucket, PARTITION) == [f'finding-{i}' for i in range(6)]
+
+
+@mock_s3
+def test_open_partitions_are_left_alone():
+    bucket = __make_bucket('tester')
+    __put_json(bucket, 3)
+
+    assert CompactFindings(bucket.name, quiet_minutes=60).handle({}, None) == {'compacted_partitions': 0}
+    assert len(list(bucket.objects.filter(Prefix=PARTITION))) == 3
+
+
+@mock_s3
+def test_merges_parquet():
+    bucket = __make_bucket('tester')
+    for i in range(3):
+        stream = io.BytesIO()
+        create_output_format('parquet', 'zstd').write([{'Id': f'finding-{i}', f'Column{i}': 'x'}], stream)
+        bucket.put_object(Key=f'{PARTITION}/stream-{i}.parquet', Body=stream.getvalue())
+
+    CompactFindings(bucket.name, quiet_minutes=0).handle({}, None)
+
+    objects = __objects(bucket, PARTITION)
+    assert len(objects) == 1
+    table = pyarrow.parquet.read_table(io.BytesIO(objects[0].get()['Body'].read()))
+    assert sorted(table.column('Id').to_pylist()) == ['finding-0', 'finding-1', 'finding-2']
+    assert set(table.column_names) == {'Id', 'Column0', 'Column1', 'Column2'}
+
+
+@mock_s3
+def test_merges_widened_parquet_columns():
+    bucket = __make_bucket('tester')
+    for i, score in enumerate([1, 1.5, 'high']):
+        stream = io.BytesIO()
+        pyarrow.parquet.write_table(pyarrow.table({'Id': [f'finding-{i}'], 'Score': [score]}), stream)
+        bucket.put_object(Key=f'{PARTITION}/stream-{i}.parquet', Body=stream.getvalue())
+
+    CompactFindings(bucket.name, quiet_minutes=0).handle({}, None)
+
+    objects = __objects(bucket, PARTITION)
+    table = pyarrow.parquet.read_table(io.BytesIO(objects[0].get()['Body'].read()))
+    assert str(table.schema.field('Score').type) == 'string'
+    assert sorted(table.column('Score').to_pylist()) == ['1', '1.5', 'high']
+
+
+def __crash_once(monkeypatch, method: str, call: int):
+    original = getattr(CompactFindings, f'_CompactFindings__{method}')
+    calls = []
+
+    def crashing(self, *args):
+        calls.append(args)
+        if len(calls) == call:
+            raise RuntimeError('crashed')
+        return original(self, *args)
+
+    monkeypatch.setattr(CompactFindings, f'_CompactFindings__{method}', crashing)
+
+
+@pytest.mark.parametrize('method, call', [
+    # Before the merged objects were committed, and after, before the objects they replace were deleted
+    ('write_manifest', 2),
+    ('delete', 1)
+])
+@mock_s3
+def test_crashed_run_is_recovered_without_duplicates(monkeypatch, method, call):
+    bucket = __make_bucket('tester')
+    __put_json(bucket, 4)
+    __crash_once(monkeypatch, method, call)
+
+    with pytest.raises(RuntimeError):
+        CompactFindings(bucket.name, quiet_minutes=0).handle({}, None)
+    CompactFindings(bucket.name, quiet_minutes=0).handle({}, None)
+
+    keys = [o.key for o in __objects(bucket, PARTITION)]
+    assert len(keys) == 1 and keys[0].split('/')[-1].startswith('compacted-')
+    assert __rows(bucket, keys[0]) == [f'finding-{i}' for i in range(4)]
+
+
+def __register_partition(bucket_name: str):
+    glue = boto3.client('glue')
+    glue.create_database(DatabaseInput={'Name': 'security_hub_database'})
+    storage_descriptor = {'Columns': [{'Name': 'Id', 'Type': 'string'}], 'Location': 's3://tester/Findings/'}
+    glue.create_table(DatabaseName='security_hub_database', TableInput={
+        'Name': 'security-hub-crawled-findings',
+        'StorageDescriptor': storage_descriptor,
+        'PartitionKeys': [{'Name': f'partition_{i}', 'Type': 'string'} for i in range(5)]
+    })
+    values = PARTITION.split('/')[1:]
+    glue.create_partition(DatabaseName='security_hub_database', TableName='security-hub-crawled-findings',
+                          PartitionInput={'Values': values,
+                                          'StorageDescriptor': dict(storage_descriptor,
+                                                                    Location=f's3://{bucket_name}/{PARTITION}/')})
+
+    def location() -> str:
+        return glue.get_partition(DatabaseName='security_hub_database', TableName='security-hub-crawled-findings',
+                                  PartitionValues=values)['Partition']['StorageDescriptor']['Location']
+    return location
+
+
+def __compact_registered(bucket_name: str, event: dict = None):
+    CompactFindings(bucket_name, quiet_minutes=0, database_name='security_hub_database',
+                    table_name='security-hub-crawled-findings').handle(event or {}, None)
+
+
+@mock_s3
+@mock_glue
+def test_registered_partition_is_swapped_atomically():
+    bucket = __make_bucket('tester')
+    __put_json(bucket, 4)
+    location = __register_partition(bucket.name)
+
+    __compact_registered(bucket.name)
+
+    assert __objects(bucket, 'Findings/') == []
+    assert location().startswith(f's3://tester/Compacted/{PARTITION[len("Findings/"):]}/')
+    prefix = location()[len('s3://tester/'):]
+    assert __rows(bucket, prefix) == [f'finding-{i}' for i in range(4)]
+
+
+@mock_s3
+@mock_glue
+def test_late_findings_are_merged_with_the_registered_generation():
+    bucket = __make_bucket('tester')
+    __put_json(bucket, 4)
+    location = __register_partition(bucket.name)
+    __compact_registered(bucket.name)
+    first = location()[len('s3://tester/'):]
+
+    # A backfill writing to an old partition is followed by a full scan
+    bucket.put_object(Key=f'{PARTITION}/late-0.json', Body=json.dumps({'Id': 'late-0'}) + '\n')
+    __compact_registered(bucket.name, {'full_scan': True})
+
+    second = location()[len('s3://tester/'):]
+    assert second != first and __objects(bucket, first) == []
+    assert __rows(bucket, second) == ['finding-0', 'finding-1', 'finding-2', 'finding-3', 'late-0']
+
+
+@pytest.mark.parametrize('method, call', [
+    # Before the partition was repointed at the new generation, and after, before the old objects were deleted
+    ('swap_location', 1),
+    ('write_manifest', 2)
+])
+@mock_s3
+@mock_glue
+def test_crashed_swap_is_recovered_without_duplicates(monkeypatch, method, call):
+    bucket = __make_bucket('tester')
+    __put_json(bucket, 4)
+    location = __register_partition(bucket.name)
+    __crash_once(monkeypatch, method, call)
+
+    with pytest.raises(RuntimeError):
+        __compact_registered(bucket.name)
+    __compact_registered(bucket.name)
+
+    assert __objects(bucket, 'Findings/') == []
+    assert __rows(bucket, 'Compacted/') == __rows(bucket, location()[len('s3://tester/'):]) == [
+        f'finding-{i}' for i in range(4)]
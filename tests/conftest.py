@@ -0,0 +1,16 @@
+import os
+import sys
+
+# Lambda assets import their sibling modules as top level modules, the same way the Lambda runtime loads them
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../assets/lambdas/transform_findings'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../assets/containers/prowler_list_check'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../assets/containers/prowler_scan_check'))
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+# moto's S3 stand-in does not decode the aws-chunked bodies newer botocore sends for checksummed uploads
+os.environ.setdefault('AWS_REQUEST_CHECKSUM_CALCULATION', 'when_required')
+
+# jsii warns on every import when the local node is past its end of life
+os.environ.setdefault('JSII_SILENCE_WARNING_DEPRECATED_NODE_VERSION', '1')
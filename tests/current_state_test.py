@@ -0,0 +1,150 @@
+from assets.lambdas.transform_findings.current_state import CurrentStateSnapshot, newest, id_bucket
+from assets.lambdas.transform_findings.index import TransformFindings
+from assets.lambdas.transform_findings.output_formats import create_output_format
+from asff_fixture import FINDING, envelope
+import boto3
+from botocore.exceptions import ClientError
+import copy
+import json
+from moto import mock_s3
+
+
+def __make_bucket(bucket_name: str):
+    bucket = boto3.resource('s3').Bucket(bucket_name)
+    bucket.create()
+    return bucket
+
+
+def __version(finding_id: str, updated_at: str, status: str = 'FAILED') -> dict:
+    finding = copy.deepcopy(FINDING)
+    finding['Id'] = finding_id
+    finding['UpdatedAt'] = updated_at
+    finding['Compliance']['Status'] = status
+    return finding
+
+
+def __snapshot(bucket) -> dict:
+    rows = []
+    for o in bucket.objects.filter(Prefix='Current/'):
+        rows += [json.loads(line) for line in o.get()['Body'].read().decode('utf-8').splitlines()]
+    return {r['Id']: r for r in rows}
+
+
+def __transform(bucket, name: str, *findings):
+    bucket.put_object(Key=f'raw/firehose2021/05/07/11/{name}', Body=''.join(json.dumps(envelope(f)) for f in findings))
+    TransformFindings(bucket.name, destination_prefix='Findings', current_state_prefix='Current',
+                      current_state_buckets=4).handle({
+        'Records': [{'s3': {'object': {'key': f'raw/firehose2021/05/07/11/{name}'}}}]
+    }, None)
+
+
+def test_newest_orders_by_updated_at():
+    rows = [{'Id': 'a', 'UpdatedAt': '2021-05-07T11:00:00Z', 'v': 1},
+            {'Id': 'a', 'UpdatedAt': '2021-05-07T10:00:00Z', 'v': 2},
+            {'Id': 'b', 'UpdatedAt': '2021-05-07T10:00:00Z', 'v': 3},
+            {'Id': 'b', 'UpdatedAt': '2021-05-07T10:00:00Z', 'v': 4}]
+
+    assert {k: v['v'] for k, v in newest(rows).items()} == {'a': 1, 'b': 4}
+
+
+def test_newest_compares_instants_not_text():
+    rows = [{'Id': 'a', 'UpdatedAt': '2021-05-07T11:05:25.100Z', 'v': 1},
+            {'Id': 'a', 'UpdatedAt': '2021-05-07T11:05:25Z', 'v': 2},
+            {'Id': 'b', 'UpdatedAt': '2021-05-07T12:00:00+02:00', 'v': 3},
+            {'Id': 'b', 'UpdatedAt': '2021-05-07T11:00:00Z', 'v': 4}]
+
+    assert {k: v['v'] for k, v in newest(rows).items()} == {'a': 1, 'b': 4}
+
+
+@mock_s3
+def test_snapshot_keeps_latest_version_per_id():
+    bucket = __make_bucket('tester')
+
+    __transform(bucket, 'batch-1',
+                __version('finding-1', '2021-05-07T10:00:00Z'),
+                __version('finding-2', '2021-05-07T10:00:00Z'))
+    __transform(bucket, 'batch-2',
+                __version('finding-1', '2021-05-07T12:00:00Z', 'PASSED'),
+                __version('finding-2', '2021-05-07T09:00:00Z', 'PASSED'))
+
+    snapshot = __snapshot(bucket)
+    assert sorted(snapshot) == ['finding-1', 'finding-2']
+    assert snapshot['finding-1']['Compliance_Status'] == 'PASSED'
+    assert snapshot['finding-2']['Compliance_Status'] == 'FAILED'
+    assert len(list(bucket.objects.filter(Prefix='Findings/'))) == 2
+
+
+@mock_s3
+def test_only_touched_buckets_are_rewritten():
+    bucket = __make_bucket('tester')
+    ids = [f'finding-{i}' for i in range(20)]
+    __transform(bucket, 'batch-1', *[__version(i, '2021-05-07T10:00:00Z') for i in ids])
+    before = {o.key: o.last_modified for o in bucket.objects.filter(Prefix='Current/')}
+    etags = {o.key: o.e_tag for o in bucket.objects.filter(Prefix='Current/')}
+    assert len(before) == 4
+
+    __transform(bucket, 'batch-2', __version('finding-0', '2021-05-07T12:00:00Z', 'PASSED'))
+
+    after = {o.key: o.e_tag for o in bucket.objects.filter(Prefix='Current/')}
+    changed = [k for k in after if after[k] != etags[k]]
+    assert changed == [f'Current/account=0123456789/product=securityhub/region=us-east-1/'
+                       f'id_bucket={id_bucket("finding-0", 4):04d}/current.json']
+    assert len(__snapshot(bucket)) == 20
+
+
+@mock_s3
+def test_parquet_snapshot():
+    bucket = __make_bucket('tester')
+    snapshot = CurrentStateSnapshot(boto3.client('s3'), bucket.name, create_output_format('parquet'), buckets=1)
+
+    snapshot.merge_bucket('0123456789/securityhub/us-east-1', 0, [{'Id': 'a', 'UpdatedAt': '1'}])
+    snapshot.merge_bucket('0123456789/securityhub/us-east-1', 0,
+                          [{'Id': 'a', 'UpdatedAt': '2'}, {'Id': 'b', 'UpdatedAt': '1'}])
+
+    data = bucket.Object('Current/account=0123456789/product=securityhub/region=us-east-1/id_bucket=0000/'
+                         'current.parquet').get()['Body'].read()
+    assert sorted(create_output_format('parquet').read(data), key=lambda r: r['Id']) == [
+        {'Id': 'a', 'UpdatedAt': '2'}, {'Id': 'b', 'UpdatedAt': '1'}]
+
+
+@mock_s3
+def test_merge_retries_when_bucket_changed_concurrently():
+    bucket = __make_bucket('tester')
+    s3_client = boto3.client('s3')
+
+    class ConcurrentWriter:
+        def __init__(self):
+            self.conflicts = 0
+
+        def get_object(self, **kwargs):
+            return s3_client.get_object(**kwargs)
+
+        def put_object(self, **kwargs):
+            if self.conflicts == 0:
+                self.conflicts += 1
+                s3_client.put_object(Bucket=kwargs['Bucket'], Key=kwargs['Key'],
+                                     Body=b'{"Id": "other", "UpdatedAt": "1"}\n')
+                raise ClientError({'Error': {'Code': 'PreconditionFailed'}}, 'PutObject')
+            return s3_client.put_object(**kwargs)
+
+    writer = ConcurrentWriter()
+    waits = []
+    CurrentStateSnapshot(writer, bucket.name, create_output_format(), buckets=1, sleep=waits.append).merge_bucket(
+        '0123456789/securityhub/us-east-1', 0, [{'Id': 'a', 'UpdatedAt': '1'}])
+
+    assert writer.conflicts == 1 and len(waits) == 1
+    assert sorted(__snapshot(bucket)) == ['a', 'other']
+
+
+@mock_s3
+def test_batches_only_touch_their_own_partitions():
+    bucket = __make_bucket('tester')
+    __transform(bucket, 'batch-1', *[__version(f'finding-{i}', '2021-05-07T10:00:00Z') for i in range(20)])
+    etags = {o.key: o.e_tag for o in bucket.objects.filter(Prefix='Current/')}
+
+    other = dict(__version('other-1', '2021-05-07T12:00:00Z'), AwsAccountId='111122223333')
+    __transform(bucket, 'batch-2', *[dict(other, Id=f'other-{i}') for i in range(20)])
+
+    after = {o.key: o.e_tag for o in bucket.objects.filter(Prefix='Current/')}
+    assert all(after[k] == etag for k, etag in etags.items())
+    assert len([k for k in after if k.startswith('Current/account=111122223333/')]) == 4
@@ -0,0 +1,70 @@
+"""A stand-in prowler executable and Security Hub client for the scanner tests.
+
+The fake prowler prints `FINDINGS_<check>` findings for a check, or 2 by default, as json-asff lines between some
+banner output.  Their compliance status is `STATUS_<check>`, FAILED by default, and UpdatedAt is the current time.  A check named `slow...` prints one finding and then hangs, a check named `fail...` exits with 1.
+A check named `throttled...` also prints an AWS CLI throttling error to stderr, the first time it runs with the
+same arguments.
+Every invocation appends its arguments to `calls.jsonl` next to the executable.
+"""
+import os
+import stat
+import sys
+
+SCRIPT = '''#!{python}
+import json, os, sys, time
+argv = sys.argv[1:]
+check = argv[argv.index('-c') + 1]
+region = argv[argv.index('-r') + 1]
+account = argv[argv.index('-A') + 1] if '-A' in argv else '123456789012'
+calls_path = os.path.join(os.path.dirname(__file__), 'calls.jsonl')
+retried = os.path.exists(calls_path) and json.dumps(argv) in open(calls_path).read().splitlines()
+with open(calls_path, 'a') as calls:
+    calls.write(json.dumps(argv) + '\\n')
+print('Prowler fake banner', flush=True)
+count = int(os.environ.get('FINDINGS_' + check, 1 if check.startswith('slow') else 2))
+for i in range(count):
+    print(json.dumps({{'SchemaVersion': '2018-10-08', 'Id': f'prowler-{{check}}-{{account}}-{{region}}-{{i}}',
+                      'GeneratorId': f'prowler-{{check}}', 'Title': check, 'AwsAccountId': account,
+                      'ProductArn': f'arn:aws:securityhub:{{region}}::product/prowler/prowler',
+                      'Compliance': {{'Status': os.environ.get('STATUS_' + check, 'FAILED')}},
+                      'UpdatedAt': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(time.time()))}}), flush=True)
+if check.startswith('throttled') and not retried:
+    print('An error occurred (Throttling) when calling the DescribeTrails operation: Rate exceeded',
+          file=sys.stderr, flush=True)
+if check.startswith('slow'):
+    time.sleep(60)
+sys.exit(1 if check.startswith('fail') else 0)
+'''
+
+
+def install_fake_prowler(directory) -> str:
+    path = os.path.join(str(directory), 'prowler')
+    with open(path, 'w') as f:
+        f.write(SCRIPT.format(python=sys.executable))
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    return path
+
+
+def read_calls(prowler_path: str) -> list:
+    import json
+
+    calls = os.path.join(os.path.dirname(prowler_path), 'calls.jsonl')
+    if not os.path.exists(calls):
+        return []
+    with open(calls) as f:
+        return [json.loads(line) for line in f]
+
+
+class FakeSecurityHub:
+    """Records BatchImportFindings calls, moto has no Security Hub backend"""
+
+    def __init__(self):
+        self.batches = []
+
+    def batch_import_findings(self, Findings):
+        self.batches.append(list(Findings))
+        return {'SuccessCount': len(Findings), 'FailedCount': 0, 'FailedFindings': []}
+
+    @property
+    def findings(self) -> list:
+        return [f for batch in self.batches for f in batch]
@@ -0,0 +1,91 @@
+from assets.lambdas.transform_findings.finding_flattener import FindingFlattener
+from assets.lambdas.transform_findings.index import TransformFindings
+from asff_fixture import FINDING
+from flatten_json import flatten
+import pytest
+from moto import mock_s3
+
+
+@mock_s3
+def test_matches_flatten_json_and_fix_dictionary():
+    transform_findings = TransformFindings('tester')
+    finding = dict(FINDING, Note={}, Tags=[], Count=0, Flag=False, Missing=None,
+                   Odd={'': {'a/b': 1, 'a_b': 2}, 'x:y': [{'z': None}, 'w']})
+
+    expected = transform_findings.fix_dictionary(flatten(finding))
+    flattener = FindingFlattener()
+
+    for _ in range(2):
+        result = flattener.flatten(finding)
+        assert result == expected
+        assert list(result) == list(expected)
+
+
+def test_sanitized_columns():
+    result = FindingFlattener().flatten(FINDING)
+
+    assert result['first_level_test'] == 'test'
+    assert result['ProductFields_aws_securityhub_ProductName'] == 'Security Hub'
+    assert result['ProductFields_RelatedAWSResources_0_name'] == 'securityhub-restricted-ssh-38a80c22'
+    assert result['Severity_Normalized'] == '0'
+    assert result['Resources_0_Details_AwsEc2SecurityGroup_IpPermissions_0_IpProtocol'] == '-1'
+
+
+def test_empty_finding():
+    assert FindingFlattener().flatten({}) == {}
+
+
+def test_typed_values():
+    flattener = FindingFlattener(typed=True)
+    result = flattener.flatten(dict(FINDING, Note={}, Flag=False, Confidence=87.5,
+                                    ProcessedAt='2021-05-07T13:05:25.77512+02:00'))
+
+    assert result['Severity_Normalized'] == 0
+    assert result['Flag'] is False
+    assert result['Note'] is None
+    assert result['Confidence'] == 87.5
+    assert result['UpdatedAt'] == '2021-05-07T11:05:25.775Z'
+    assert result['ProcessedAt'] == '2021-05-07T11:05:25.775Z'
+    assert result['Types_0'].startswith('Software and Configuration Checks')
+    assert flattener.column_types['Severity_Normalized'] == 'bigint'
+    assert flattener.column_types['UpdatedAt'] == 'timestamp'
+
+
+def test_typed_columns_widen_across_batches():
+    flattener = FindingFlattener(typed=True)
+    flattener.flatten({'Score': 1, 'When': '2021-05-07T11:05:25Z', 'Flag': True})
+    flattener.flatten({'Score': 1.5, 'When': 'yesterday', 'Flag': 'no'})
+
+    assert flattener.column_types == {'Score': 'double', 'When': 'string', 'Flag': 'string'}
+    # Once widened a column keeps the wider type, timestamps keep their original text
+    assert flattener.flatten({'Score': 2, 'When': '2021-05-07T11:05:25Z'}) == {'Score': 2,
+                                                                               'When': '2021-05-07T11:05:25Z'}
+
+
+def test_declared_columns_keep_their_type():
+    flattener = FindingFlattener(typed=True, declared_types={'Product': 'double', 'Normalized': 'bigint',
+                                                             'When': 'timestamp', 'Name': 'string'})
+
+    rows = [flattener.flatten({'Product': 0, 'Normalized': 40, 'When': '2021-05-07T13:05:25+02:00', 'Name': 7}),
+            flattener.flatten({'Product': 1.5, 'Normalized': 'high', 'When': 'yesterday', 'Name': 'seven'})]
+
+    assert rows == [{'Product': 0.0, 'Normalized': 40, 'When': '2021-05-07T11:05:25.000Z', 'Name': '7'},
+                    {'Product': 1.5, 'Normalized': None, 'When': None, 'Name': 'seven'}]
+    assert isinstance(rows[0]['Product'], float)
+    assert flattener.column_types == {'Product': 'double', 'Normalized': 'bigint', 'When': 'timestamp',
+                                      'Name': 'string'}
+
+
+def test_keep_arrays():
+    flattener = FindingFlattener(typed=True, keep_arrays=True)
+    result = flattener.flatten(FINDING)
+
+    assert result['Types'] == FINDING['Types']
+    assert 'Types_0' not in result
+    assert 'Resources_0_Id' in result
+    assert flattener.column_types['Types'] == 'array<string>'
+
+
+def test_keep_arrays_requires_typed():
+    with pytest.raises(ValueError):
+        FindingFlattener(keep_arrays=True)
@@ -0,0 +1,69 @@
+from assets.lambdas.transform_findings.finding_flattener import FindingFlattener
+from assets.lambdas.transform_findings.finding_normalizer import FindingNormalizer
+from assets.lambdas.transform_findings.index import TransformFindings
+from assets.lambdas.transform_findings.output_formats import ParquetFormat
+from asff_fixture import FINDING, envelope
+import boto3
+import json
+import pytest
+from moto import mock_s3
+
+RESOURCES = [
+    {'Type': 'AwsEc2SecurityGroup', 'Id': 'arn:aws:ec2:us-east-1:0123456789:security-group/sg-1',
+     'Partition': 'aws', 'Region': 'us-east-1',
+     'Details': {'AwsEc2SecurityGroup': {'IpPermissions': [{'IpProtocol': 'tcp', 'FromPort': 22}]}}},
+    {'Type': 'AwsAccount', 'Id': 'AWS::::Account:0123456789', 'Partition': 'aws', 'Region': 'us-east-1'}
+]
+RELATED = [{'ProductArn': 'arn:aws:securityhub:us-east-1::product/aws/guardduty', 'Id': 'related-1'}]
+
+
+def test_lists_become_child_rows():
+    finding = dict(FINDING, Resources=RESOURCES, RelatedFindings=RELATED)
+
+    row, children = FindingNormalizer(FindingFlattener()).normalize(finding)
+
+    assert not any(c.startswith(('Resources_', 'Types_', 'RelatedFindings_')) for c in row)
+    assert json.loads(row['FindingProviderFields_Types']) == FINDING['FindingProviderFields']['Types']
+    assert [(r['Position'], r['Type']) for r in children['finding_resources']] == [
+        (0, 'AwsEc2SecurityGroup'), (1, 'AwsAccount')]
+    assert json.loads(children['finding_resources'][0]['Details']) == RESOURCES[0]['Details']
+    assert children['finding_types'] == [{'FindingId': FINDING['Id'], 'FindingUpdatedAt': FINDING['UpdatedAt'],
+                                          'Position': 0, 'Type': FINDING['Types'][0]}]
+    assert children['finding_related_findings'][0]['Id'] == 'related-1'
+
+
+def test_column_count_is_bounded():
+    flattener = FindingFlattener()
+    wide = dict(FINDING, Resources=[dict(RESOURCES[0], Details={'Other': {'Ports': list(range(50))}})] * 20)
+
+    normalized, _ = FindingNormalizer(flattener).normalize(wide)
+    narrow, _ = FindingNormalizer(flattener).normalize(FINDING)
+
+    assert set(normalized) == set(narrow)
+    assert len(flattener.flatten(wide)) > len(normalized) + 1000
+
+
+def test_keep_arrays_does_not_apply():
+    with pytest.raises(ValueError):
+        TransformFindings('tester', typed_output=True, keep_arrays=True, normalized_output=True)
+
+
+@mock_s3
+def test_normalized_output_writes_child_tables():
+    bucket = boto3.resource('s3').Bucket('tester')
+    bucket.create()
+    key = 'raw/firehose2021/05/07/11/stream-1'
+    bucket.put_object(Key=key, Body=json.dumps(envelope(dict(FINDING, Resources=RESOURCES))))
+
+    TransformFindings(bucket.name, destination_prefix='Findings', partition_layout='hive', output_format='parquet',
+                      typed_output=True, normalized_output=True).handle({
+                          'Records': [{'s3': {'object': {'key': key}}}]
+                      }, None)
+
+    partition = 'account=0123456789/product=securityhub/region=us-east-1/year=2021/month=05/day=07/hour=11'
+    written = sorted(o.key for o in bucket.objects.all() if not o.key.startswith('raw/'))
+    assert written == [f'{prefix}/{partition}/stream-1.parquet'
+                       for prefix in ['FindingResources', 'FindingTypes', 'Findings']]
+    resources = ParquetFormat().read(bucket.Object(written[0]).get()['Body'].read())
+    assert [(r['FindingId'], r['Position'], r['Type']) for r in resources] == [
+        (FINDING['Id'], 0, 'AwsEc2SecurityGroup'), (FINDING['Id'], 1, 'AwsAccount')]
@@ -0,0 +1,66 @@
+from assets.lambdas.transform_findings.firehose_decoder import iter_envelopes
+from assets.lambdas.transform_findings.index import TransformFindings
+from asff_fixture import FINDING, envelope
+import boto3
+import copy
+import io
+import json
+from moto import mock_s3
+
+
+def __legacy_decode(raw: bytes):
+    return json.loads('[' + raw.decode('utf-8').replace('}{', '},\n{') + ']')
+
+
+def __firehose_object(envelopes):
+    return ''.join(json.dumps(e) for e in envelopes).encode('utf-8')
+
+
+def test_matches_legacy_decoder():
+    findings = []
+    for i in range(5):
+        finding = copy.deepcopy(FINDING)
+        finding['Id'] = f'{finding["Id"]}-{i}'
+        finding['Title'] = f'Ünïcödé title {i} ✓'
+        findings.append(finding)
+    raw = __firehose_object([envelope(f) for f in findings])
+
+    for chunk_size in [1, 7, 64, 1024 * 1024]:
+        assert list(iter_envelopes(io.BytesIO(raw), chunk_size)) == __legacy_decode(raw)
+
+
+def test_brace_inside_string_value():
+    finding = copy.deepcopy(FINDING)
+    finding['Description'] = 'A policy of {"a": 1}{"b": 2} breaks naive splitting'
+    raw = __firehose_object([envelope(finding), envelope()])
+
+    decoded = list(iter_envelopes(io.BytesIO(raw), 16))
+
+    assert len(decoded) == 2
+    assert decoded[0]['detail']['findings'][0]['Description'] == finding['Description']
+
+
+def test_newline_delimited_records():
+    raw = (json.dumps(envelope()) + '\n' + json.dumps(envelope()) + '\n').encode('utf-8')
+    assert len(list(iter_envelopes(io.BytesIO(raw), 10))) == 2
+
+
+def test_empty_object():
+    assert list(iter_envelopes(io.BytesIO(b''))) == []
+
+
+@mock_s3
+def test_handle_streams_firehose_object():
+    bucket = boto3.resource('s3').Bucket('tester')
+    bucket.create()
+    bucket.put_object(Key='raw/firehose2021/05/07/11/stream-1', Body=__firehose_object([envelope(), envelope()]))
+
+    TransformFindings(bucket.name, destination_prefix='Findings', chunk_size=100).handle({
+        'Records': [{'s3': {'object': {'key': 'raw/firehose2021/05/07/11/stream-1'}}}]
+    }, None)
+
+    written = [o.key for o in bucket.objects.filter(Prefix='Findings/')]
+    assert written == ['Findings/0123456789/securityhub/us-east-1/05/07/stream-1.json']
+    lines = bucket.Object(written[0]).get()['Body'].read().decode('utf-8').splitlines()
+    assert len(lines) == 2
+    assert json.loads(lines[0])['Id'] == FINDING['Id']
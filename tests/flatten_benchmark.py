@@ -0,0 +1,34 @@
+"""Compares findings per second of flatten_json + fix_dictionary against FindingFlattener.
+
+Run from the repository root: python tests/flatten_benchmark.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../assets/lambdas/transform_findings'))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+from asff_fixture import FINDING
+from flatten_json import flatten
+from finding_flattener import FindingFlattener
+from index import TransformFindings
+
+ITERATIONS = 20000
+
+
+def main():
+    transform_findings = TransformFindings('benchmark')
+    flattener = FindingFlattener()
+
+    before = timeit.timeit(lambda: transform_findings.fix_dictionary(flatten(FINDING)), number=ITERATIONS)
+    after = timeit.timeit(lambda: flattener.flatten(FINDING), number=ITERATIONS)
+
+    print(f'flatten_json + fix_dictionary: {ITERATIONS / before:,.0f} findings/s')
+    print(f'FindingFlattener:              {ITERATIONS / after:,.0f} findings/s')
+    print(f'speedup:                       {before / after:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
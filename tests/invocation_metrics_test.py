@@ -0,0 +1,68 @@
+from assets.lambdas.transform_findings.index import TransformFindings
+from assets.lambdas.transform_findings.invocation_metrics import InvocationMetrics
+from asff_fixture import envelope
+import boto3
+import json
+import logging
+from moto import mock_s3
+
+
+class __Context:
+    function_name = 'TransformFindings'
+
+
+def test_emf_document(capsys):
+    metrics = InvocationMetrics(function_name='TransformFindings')
+    metrics.increment('Findings', 3)
+    with metrics.timed('Flatten'):
+        pass
+
+    metrics.emit()
+
+    document = json.loads(capsys.readouterr().out)
+    directive = document['_aws']['CloudWatchMetrics'][0]
+    assert directive['Dimensions'] == [['FunctionName']]
+    assert {'Name': 'Findings', 'Unit': 'Count'} in directive['Metrics']
+    assert {'Name': 'FlattenMilliseconds', 'Unit': 'Milliseconds'} in directive['Metrics']
+    assert document['FunctionName'] == 'TransformFindings'
+    assert document['Findings'] == 3
+    assert document['FlattenMilliseconds'] >= 0
+
+
+@mock_s3
+def test_handle_emits_one_metrics_line(capsys, caplog):
+    bucket = boto3.resource('s3').Bucket('tester')
+    bucket.create()
+    body = json.dumps(envelope()) + json.dumps(envelope())
+    bucket.put_object(Key='raw/firehose2021/05/07/11/stream-1', Body=body)
+
+    with caplog.at_level(logging.INFO):
+        TransformFindings(bucket.name, destination_prefix='Findings').handle({
+            'Records': [{'s3': {'object': {'key': 'raw/firehose2021/05/07/11/stream-1'}}}]
+        }, __Context())
+
+    lines = capsys.readouterr().out.splitlines()
+    assert len(lines) == 1
+    document = json.loads(lines[0])
+    assert document['Objects'] == 1
+    assert document['Envelopes'] == 2
+    assert document['Findings'] == 2
+    assert document['OutputKeys'] == 1
+    assert document['BytesIn'] == len(body)
+    assert document['BytesOut'] > 0
+    assert not any('raw_finding' in r.message for r in caplog.records)
+
+
+@mock_s3
+def test_log_sample_rate(caplog):
+    bucket = boto3.resource('s3').Bucket('tester')
+    bucket.create()
+    bucket.put_object(Key='raw/firehose2021/05/07/11/stream-1', Body=json.dumps(envelope()))
+
+    with caplog.at_level(logging.INFO):
+        TransformFindings(bucket.name, destination_prefix='Findings', log_sample_rate=1.0).handle({
+            'Records': [{'s3': {'object': {'key': 'raw/firehose2021/05/07/11/stream-1'}}}]
+        }, None)
+
+    assert len([r for r in caplog.records if r.message.startswith('raw_finding=')]) == 1
+    assert len([r for r in caplog.records if r.message.startswith('fixed_finding=')]) == 1
@@ -0,0 +1,108 @@
+from assets.lambdas.transform_findings.finding_flattener import FindingFlattener
+from assets.lambdas.transform_findings.index import TransformFindings
+from assets.lambdas.transform_findings.output_formats import create_output_format, ParquetFormat
+from asff_fixture import FINDING, envelope
+import boto3
+import io
+import json
+import pyarrow.parquet
+import pytest
+from moto import mock_s3
+
+
+def test_json_lines():
+    rows = [{'Id': '1'}, {'Id': '2', 'Title': 't'}]
+    stream = io.BytesIO()
+
+    create_output_format('json').write(rows, stream)
+
+    assert stream.getvalue() == b'{"Id": "1"}\n{"Id": "2", "Title": "t"}\n'
+
+
+@pytest.mark.parametrize('compression', ['snappy', 'zstd'])
+def test_parquet_round_trip(compression):
+    row = FindingFlattener().flatten(FINDING)
+    rows = [row, {'Id': 'other', 'Extra': 'x'}]
+    stream = io.BytesIO()
+
+    create_output_format('parquet', compression).write(rows, stream)
+
+    parquet_file = pyarrow.parquet.ParquetFile(io.BytesIO(stream.getvalue()))
+    column = parquet_file.metadata.row_group(0).column(parquet_file.schema_arrow.get_field_index('Title'))
+    assert column.compression.lower() == compression
+    assert any('DICT' in encoding for encoding in column.encodings)
+
+    table = parquet_file.read()
+    assert table.column_names == list(row) + ['Extra']
+    assert table.to_pylist()[0] == dict(row, Extra=None)
+    assert table.to_pylist()[1]['Extra'] == 'x'
+    assert table.to_pylist()[1]['Title'] is None
+
+
+def test_parquet_writer_widens_columns_between_batches():
+    column_types = {'Count': 'bigint'}
+    output_format = create_output_format('parquet', column_types=lambda: column_types)
+    stream = io.BytesIO()
+
+    writer = output_format.open(stream)
+    writer.write([{'Id': '1', 'Count': 1}])
+    column_types['Count'] = 'double'
+    writer.write([{'Id': '2', 'Count': 2.5, 'Extra': 'x'}])
+    writer.close()
+
+    parquet_file = pyarrow.parquet.ParquetFile(io.BytesIO(stream.getvalue()))
+    assert parquet_file.metadata.num_row_groups == 2
+    assert str(parquet_file.schema_arrow.field('Count').type) == 'double'
+    assert parquet_file.read().to_pylist() == [{'Id': '1', 'Count': 1.0, 'Extra': None},
+                                               {'Id': '2', 'Count': 2.5, 'Extra': 'x'}]
+
+
+def test_unsupported_format():
+    with pytest.raises(ValueError):
+        create_output_format('csv')
+    with pytest.raises(ValueError):
+        ParquetFormat('lz4')
+
+
+@mock_s3
+def test_handle_writes_parquet():
+    bucket = boto3.resource('s3').Bucket('tester')
+    bucket.create()
+    bucket.put_object(Key='raw/firehose2021/05/07/11/stream-1', Body=json.dumps(envelope()))
+
+    TransformFindings(bucket.name, destination_prefix='Findings', output_format='parquet').handle({
+        'Records': [{'s3': {'object': {'key': 'raw/firehose2021/05/07/11/stream-1'}}}]
+    }, None)
+
+    body = bucket.Object('Findings/0123456789/securityhub/us-east-1/05/07/stream-1.parquet').get()['Body'].read()
+    assert pyarrow.parquet.read_table(io.BytesIO(body)).to_pylist()[0]['Id'] == FINDING['Id']
+
+
+def test_typed_parquet_round_trip():
+    flattener = FindingFlattener(typed=True, keep_arrays=True)
+    rows = [flattener.flatten(FINDING), flattener.flatten(dict(FINDING, Id='other', Severity={'Normalized': 40.5}))]
+    output_format = create_output_format('parquet', column_types=lambda: flattener.column_types)
+    stream = io.BytesIO()
+
+    output_format.write(rows, stream)
+
+    schema = pyarrow.parquet.read_schema(io.BytesIO(stream.getvalue()))
+    assert str(schema.field('UpdatedAt').type) == 'timestamp[ms, tz=UTC]'
+    assert str(schema.field('Severity_Normalized').type) == 'double'
+    assert pyarrow.types.is_list(schema.field('Types').type)
+    read = output_format.read(stream.getvalue())
+    assert read[0]['UpdatedAt'] == '2021-05-07T11:05:25.775Z'
+    assert [r['Severity_Normalized'] for r in read] == [0.0, 40.5]
+    assert read[0]['Types'] == FINDING['Types']
+
+
+def test_declared_types_agree_across_objects():
+    schemas = []
+    for product in [0, 1.5]:
+        flattener = FindingFlattener(typed=True, declared_types={'Severity_Product': 'double'})
+        row = flattener.flatten(dict(FINDING, Severity=dict(FINDING['Severity'], Product=product)))
+        stream = io.BytesIO()
+        create_output_format('parquet', column_types=lambda: flattener.column_types).write([row], stream)
+        schemas.append(pyarrow.parquet.read_schema(io.BytesIO(stream.getvalue())))
+
+    assert [str(s.field('Severity_Product').type) for s in schemas] == ['double', 'double']
@@ -0,0 +1,90 @@
+from assets.lambdas.transform_findings.index import TransformFindings
+from assets.lambdas.transform_findings.partition_registrar import PartitionRegistrar, partition_values
+from asff_fixture import envelope
+import boto3
+import json
+from moto import mock_glue, mock_s3
+
+PARTITION = 'account=0123456789/product=securityhub/region=us-east-1/year=2021/month=05/day=07/hour=11'
+
+
+class CountingGlue:
+    def __init__(self, glue_client):
+        self.__glue_client = glue_client
+        self.batches = 0
+
+    def get_table(self, **kwargs):
+        return self.__glue_client.get_table(**kwargs)
+
+    def batch_create_partition(self, **kwargs):
+        self.batches += 1
+        return self.__glue_client.batch_create_partition(**kwargs)
+
+
+def __make_table(bucket_name: str):
+    bucket = boto3.resource('s3').Bucket(bucket_name)
+    bucket.create()
+    glue = boto3.client('glue')
+    glue.create_database(DatabaseInput={'Name': 'security_hub_database'})
+    glue.create_table(DatabaseName='security_hub_database', TableInput={
+        'Name': 'findings',
+        'StorageDescriptor': {'Columns': [{'Name': 'id', 'Type': 'string'}],
+                              'Location': f's3://{bucket_name}/Findings/'},
+        'PartitionKeys': [{'Name': k, 'Type': 'string'}
+                          for k in ['account', 'product', 'region', 'year', 'month', 'day', 'hour']]
+    })
+    return bucket, glue
+
+
+def test_partition_values():
+    assert partition_values(PARTITION) == ['0123456789', 'securityhub', 'us-east-1', '2021', '05', '07', '11']
+
+
+@mock_s3
+@mock_glue
+def test_transform_registers_written_partitions():
+    bucket, glue = __make_table('tester')
+    bucket.put_object(Key='raw/firehose2021/05/07/11/stream-1', Body=json.dumps(envelope()))
+
+    TransformFindings(bucket.name, destination_prefix='Findings', partition_layout='hive',
+                      database_name='security_hub_database', table_name='findings').handle({
+        'Records': [{'s3': {'object': {'key': 'raw/firehose2021/05/07/11/stream-1'}}}]
+    }, None)
+
+    partitions = glue.get_partitions(DatabaseName='security_hub_database', TableName='findings')['Partitions']
+    assert [p['Values'] for p in partitions] == [partition_values(PARTITION)]
+    assert partitions[0]['StorageDescriptor']['Location'] == f's3://tester/Findings/{PARTITION}/'
+    assert [o.key for o in bucket.objects.filter(Prefix='Markers/')] == [f'Markers/partitions/findings/{PARTITION}']
+
+
+@mock_s3
+@mock_glue
+def test_partitions_are_registered_once():
+    bucket, glue = __make_table('tester')
+    counting = CountingGlue(glue)
+    s3_client = boto3.client('s3')
+    registrar = PartitionRegistrar(counting, s3_client, bucket.name, 'security_hub_database', 'findings', 'Findings')
+
+    assert registrar.register({PARTITION}) == [PARTITION]
+    assert registrar.register({PARTITION}) == []
+    # A new container finds the marker instead of calling Glue
+    assert PartitionRegistrar(counting, s3_client, bucket.name, 'security_hub_database', 'findings',
+                              'Findings').register({PARTITION}) == []
+    assert counting.batches == 1
+
+
+@mock_s3
+@mock_glue
+def test_existing_partitions_are_tolerated():
+    bucket, glue = __make_table('tester')
+    registrar = PartitionRegistrar(glue, boto3.client('s3'), bucket.name, 'security_hub_database', 'findings',
+                                   'Findings')
+    glue.create_partition(DatabaseName='security_hub_database', TableName='findings', PartitionInput={
+        'Values': partition_values(PARTITION),
+        'StorageDescriptor': {'Location': f's3://tester/Findings/{PARTITION}/'}
+    })
+    other = PARTITION.replace('hour=11', 'hour=12')
+
+    assert registrar.register([PARTITION, other]) == [PARTITION, other]
+    partitions = glue.get_partitions(DatabaseName='security_hub_database', TableName='findings')['Partitions']
+    assert sorted(p['Values'][-1] for p in partitions) == ['11', '12']
@@ -0,0 +1,110 @@
+from assets.containers.prowler_list_check.app import ProwlerListGroups, PublishError
+from assets.containers.prowler_list_check.token_bucket import AdaptiveTokenBucket
+from botocore.exceptions import ClientError
+import boto3
+import json
+import pytest
+from moto import mock_sns, mock_sqs
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class ScriptedSns:
+    """Answers PublishBatch from a script of exceptions or failed entry codes, then succeeds"""
+
+    def __init__(self, *script):
+        self.script = list(script)
+        self.published = []
+        self.calls = 0
+
+    def publish_batch(self, TopicArn, PublishBatchRequestEntries):
+        self.calls += 1
+        step = self.script.pop(0) if self.script else None
+        if isinstance(step, Exception):
+            raise step
+        failed = [dict(step, Id=PublishBatchRequestEntries[0]['Id'])] if step else []
+        failed_ids = {f['Id'] for f in failed}
+        self.published += [e['Message'] for e in PublishBatchRequestEntries if e['Id'] not in failed_ids]
+        return {'Successful': [], 'Failed': failed}
+
+
+def __throttling() -> ClientError:
+    return ClientError({'Error': {'Code': 'Throttling', 'Message': 'Rate exceeded'}}, 'PublishBatch')
+
+
+def test_token_bucket_allows_burst_then_paces():
+    clock = FakeClock()
+    bucket = AdaptiveTokenBucket(10, 5, clock=clock, sleep=clock.sleep)
+
+    for _ in range(5):
+        bucket.acquire()
+    assert clock.now == 0
+    bucket.acquire(2)
+    assert clock.now == pytest.approx(0.2)
+
+
+def test_token_bucket_adapts_to_throttling():
+    clock = FakeClock()
+    bucket = AdaptiveTokenBucket(40, 10, clock=clock, sleep=clock.sleep)
+
+    bucket.throttled()
+    bucket.throttled()
+    assert bucket.rate == 10
+    for _ in range(10):
+        bucket.succeeded()
+    assert bucket.rate == 40
+
+
+@mock_sns
+@mock_sqs
+def test_groups_are_published_in_batches():
+    sns = boto3.client('sns')
+    sqs = boto3.client('sqs')
+    topic_arn = sns.create_topic(Name='fanout')['TopicArn']
+    queue_url = sqs.create_queue(QueueName='scans')['QueueUrl']
+    queue_arn = sqs.get_queue_attributes(QueueUrl=queue_url, AttributeNames=['QueueArn'])['Attributes']['QueueArn']
+    sns.subscribe(TopicArn=topic_arn, Protocol='sqs', Endpoint=queue_arn)
+    groups = [f'group{i}' for i in range(25)]
+
+    ProwlerListGroups(topic_arn, publish_rate=1000, publish_burst=10).publish(groups)
+
+    received = []
+    while True:
+        messages = sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10).get('Messages', [])
+        if len(messages) == 0:
+            break
+        received += [json.loads(m['Body'])['Message'] for m in messages]
+    assert sorted(received) == sorted(groups)
+
+
+def test_throttled_entries_are_retried():
+    sns = ScriptedSns(__throttling(), {'Code': 'Throttling', 'SenderFault': False})
+    clock = FakeClock()
+
+    ProwlerListGroups('arn:aws:sns:us-east-1:123456789012:fanout', sns_client=sns,
+                      sleep=clock.sleep).publish([f'group{i}' for i in range(12)])
+
+    assert sorted(sns.published) == sorted(f'group{i}' for i in range(12))
+    assert sns.calls == 4
+    assert len(clock.sleeps) >= 2
+
+
+def test_rejected_entries_are_reported():
+    sns = ScriptedSns({'Code': 'InvalidParameter', 'SenderFault': True})
+
+    with pytest.raises(PublishError) as e:
+        ProwlerListGroups('arn:aws:sns:us-east-1:123456789012:fanout', sns_client=sns).publish(['group0', 'group1'])
+
+    assert e.value.failed == ['group0']
+    assert sns.published == ['group1']
@@ -0,0 +1,73 @@
+from assets.containers.prowler_scan_check.app import ProwlerScanGroup
+from assets.containers.prowler_scan_check.prowler_runner import ProwlerRunner, FindingImporter
+from fake_prowler import install_fake_prowler, read_calls, FakeSecurityHub
+import boto3
+import json
+import pytest
+import time
+from moto import mock_s3
+
+
+@pytest.fixture
+def prowler(tmp_path, monkeypatch):
+    monkeypatch.setenv('AWS_REGION', 'us-east-1')
+    return install_fake_prowler(tmp_path)
+
+
+def __event(*checks) -> dict:
+    return {'Records': [{'Sns': {'Message': c}} for c in checks]}
+
+
+def test_findings_are_imported_in_batches(prowler, monkeypatch):
+    monkeypatch.setenv('FINDINGS_check11', '150')
+    securityhub = FakeSecurityHub()
+
+    summary = ProwlerScanGroup('arn:aws:sns:us-east-1:123456789012:fanout', prowler_path=prowler,
+                               securityhub_client=securityhub).handle(__event('check11', 'check12', 'fail13'), None)
+
+    assert [len(b) for b in securityhub.batches] == [100, 54]
+    assert summary['imported'] == 154
+    assert {c['check']: (c['findings'], c['returncode']) for c in summary['checks']} == {
+        'check11': (150, 0), 'check12': (2, 0), 'fail13': (2, 1)}
+    calls = read_calls(prowler)
+    assert sorted(c[c.index('-c') + 1] for c in calls) == ['check11', 'check12', 'fail13']
+    assert all('-S' not in c and c[c.index('-M') + 1] == 'json-asff' for c in calls)
+
+
+def test_checks_run_concurrently_with_timeouts(prowler):
+    securityhub = FakeSecurityHub()
+    importer = FindingImporter(securityhub)
+    runner = ProwlerRunner('us-east-1', lambda check, finding: importer.add(finding), prowler_path=prowler,
+                           max_concurrency=3)
+
+    start = time.monotonic()
+    results = runner.run(['slow1', 'slow2', 'slow3'], timeout=2)
+    importer.flush()
+
+    assert time.monotonic() - start < 10
+    assert all(r.timed_out and r.findings == 1 for r in results)
+    assert len(securityhub.findings) == 3
+
+
+def test_checks_past_the_deadline_are_skipped(prowler):
+    runner = ProwlerRunner('us-east-1', lambda check, finding: None, prowler_path=prowler, max_concurrency=1)
+
+    results = runner.run(['slow1', 'check2'], timeout=60, deadline=time.monotonic() + 1)
+
+    assert results[0].timed_out
+    assert results[1].skipped
+    assert len(read_calls(prowler)) == 1
+
+
+@mock_s3
+def test_packed_checks_record_their_durations(prowler):
+    boto3.client('s3').create_bucket(Bucket='state')
+    securityhub = FakeSecurityHub()
+
+    summary = ProwlerScanGroup('arn:aws:sns:us-east-1:123456789012:fanout', prowler_path=prowler,
+                               securityhub_client=securityhub, state_bucket='state').handle(
+        __event(json.dumps(['check11', 'check12'])), None)
+
+    assert sorted(c['check'] for c in summary['checks']) == ['check11', 'check12']
+    keys = sorted(o['Key'] for o in boto3.client('s3').list_objects_v2(Bucket='state')['Contents'])
+    assert keys == ['durations/check11.json', 'durations/check12.json']
@@ -0,0 +1,75 @@
+from assets.containers.prowler_scan_check.app import ProwlerScanGroup
+from assets.containers.prowler_scan_check.result_cache import ResultCache, fingerprint
+from fake_prowler import install_fake_prowler, read_calls, FakeSecurityHub
+import boto3
+import pytest
+from moto import mock_s3
+
+HOUR = 3600
+
+
+@pytest.fixture
+def prowler(tmp_path, monkeypatch):
+    monkeypatch.setenv('AWS_REGION', 'us-east-1')
+    return install_fake_prowler(tmp_path)
+
+
+def __event(*checks) -> dict:
+    return {'Records': [{'Sns': {'Message': c}} for c in checks]}
+
+
+def test_fingerprint_ignores_volatile_fields():
+    finding = {'Id': '1', 'Compliance': {'Status': 'FAILED'}, 'UpdatedAt': '2021-05-07T11:00:00Z'}
+
+    assert fingerprint(finding) == fingerprint(dict(finding, UpdatedAt='2021-05-08T11:00:00Z'))
+    assert fingerprint(finding) != fingerprint(dict(finding, Compliance={'Status': 'PASSED'}))
+
+
+@mock_s3
+def test_ttl_per_check_class():
+    s3 = boto3.client('s3')
+    s3.create_bucket(Bucket='state')
+    now = [100 * HOUR]
+    cache = ResultCache(s3, 'state', ttls={'extra': 24 * HOUR, 'extra7': 2 * HOUR}, default_ttl=HOUR,
+                        clock=lambda: now[0])
+    for check in ['check11', 'extra71', 'extra81']:
+        assert cache.is_due(check)
+        cache.save(check, now[0])
+
+    now[0] += 3 * HOUR
+    assert [cache.is_due(c) for c in ['check11', 'extra71', 'extra81']] == [True, True, False]
+    # Checks of a scan target are keyed by account and region, their class still sets the TTL
+    assert cache.ttl('111111111111/eu-west-1/extra71') == 2 * HOUR
+
+
+@mock_s3
+def test_incremental_scan_imports_only_changes(prowler, monkeypatch):
+    boto3.client('s3').create_bucket(Bucket='state')
+
+    def scan(*checks) -> tuple:
+        securityhub = FakeSecurityHub()
+        summary = ProwlerScanGroup('arn:aws:sns:us-east-1:123456789012:fanout', prowler_path=prowler,
+                                   securityhub_client=securityhub, state_bucket='state', incremental=True,
+                                   cache_ttls={'check': 0}).handle(__event(*checks), None)
+        return summary, securityhub
+
+    summary, securityhub = scan('check11', 'extra71')
+    assert len(securityhub.findings) == 4
+
+    # check11 has no TTL and reruns, extra71 is within the default TTL
+    summary, securityhub = scan('check11', 'extra71')
+    assert summary['cached'] == ['extra71']
+    assert securityhub.findings == [] and summary['unchanged'] == 2
+    assert len(read_calls(prowler)) == 3
+
+    monkeypatch.setenv('STATUS_check11', 'PASSED')
+    summary, securityhub = scan('check11')
+    assert [f['Compliance']['Status'] for f in securityhub.findings] == ['PASSED', 'PASSED']
+
+
+def test_incremental_needs_state_bucket(monkeypatch):
+    monkeypatch.setenv('AWS_REGION', 'us-east-1')
+
+    with pytest.raises(ValueError):
+        ProwlerScanGroup('arn:aws:sns:us-east-1:123456789012:fanout', securityhub_client=FakeSecurityHub(),
+                         incremental=True)
@@ -0,0 +1,115 @@
+from assets.lambdas.transform_findings.index import TransformFindings
+from assets.lambdas.transform_findings.s3_object_writer import S3ObjectWriter, MINIMUM_PART_SIZE
+from asff_fixture import FINDING, envelope
+import boto3
+import gzip
+import json
+import os
+import pytest
+import zstandard
+from concurrent.futures import ThreadPoolExecutor
+from moto import mock_s3
+
+
+def __make_bucket(bucket_name: str):
+    bucket = boto3.resource('s3').Bucket(bucket_name)
+    bucket.create()
+    return bucket
+
+
+def __read(bucket, key) -> bytes:
+    return bucket.Object(key).get()['Body'].read()
+
+
+@mock_s3
+def test_small_object_single_put():
+    bucket = __make_bucket('tester')
+    client = boto3.client('s3')
+
+    with S3ObjectWriter(client, bucket.name, 'small.json') as writer:
+        writer.write(b'{"a": 1}\n')
+        writer.write(b'{"a": 2}\n')
+
+    assert __read(bucket, 'small.json') == b'{"a": 1}\n{"a": 2}\n'
+    assert writer.bytes_in == writer.bytes_out == 18
+    assert client.list_multipart_uploads(Bucket=bucket.name).get('Uploads') is None
+
+
+@mock_s3
+@pytest.mark.parametrize('compression', ['none', 'gzip'])
+def test_large_object_switches_to_multipart(compression):
+    bucket = __make_bucket('tester')
+    payload = os.urandom(MINIMUM_PART_SIZE * 2 + 1024)
+
+    with S3ObjectWriter(boto3.client('s3'), bucket.name, 'large', compression=compression,
+                        multipart_threshold=MINIMUM_PART_SIZE) as writer:
+        for offset in range(0, len(payload), 1024 * 1024):
+            writer.write(payload[offset:offset + 1024 * 1024])
+
+    body = __read(bucket, 'large')
+    assert (gzip.decompress(body) if compression == 'gzip' else body) == payload
+    assert '-' in bucket.Object('large').e_tag
+
+
+@mock_s3
+def test_parts_upload_on_executor():
+    bucket = __make_bucket('tester')
+    payload = os.urandom(MINIMUM_PART_SIZE * 3 + 1024)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        with S3ObjectWriter(boto3.client('s3'), bucket.name, 'large', multipart_threshold=MINIMUM_PART_SIZE,
+                            executor=executor) as writer:
+            for offset in range(0, len(payload), 1024 * 1024):
+                writer.write(payload[offset:offset + 1024 * 1024])
+
+    assert __read(bucket, 'large') == payload
+    assert bucket.Object('large').e_tag.endswith('-4"')
+
+
+@mock_s3
+def test_zstd():
+    bucket = __make_bucket('tester')
+
+    with S3ObjectWriter(boto3.client('s3'), bucket.name, 'object.zst', compression='zstd') as writer:
+        writer.write(b'x' * 10000)
+
+    body = __read(bucket, 'object.zst')
+    assert len(body) < 100
+    assert zstandard.ZstdDecompressor().decompressobj().decompress(body) == b'x' * 10000
+
+
+@mock_s3
+def test_failure_aborts_multipart_upload():
+    bucket = __make_bucket('tester')
+    client = boto3.client('s3')
+
+    with pytest.raises(RuntimeError):
+        with S3ObjectWriter(client, bucket.name, 'aborted', multipart_threshold=MINIMUM_PART_SIZE) as writer:
+            writer.write(os.urandom(MINIMUM_PART_SIZE))
+            raise RuntimeError('serializer failed')
+
+    assert client.list_multipart_uploads(Bucket=bucket.name).get('Uploads') is None
+    assert list(bucket.objects.all()) == []
+
+
+def test_threshold_below_minimum_part_size():
+    with pytest.raises(ValueError):
+        S3ObjectWriter(None, 'tester', 'key', multipart_threshold=1024)
+
+
+@mock_s3
+def test_handle_writes_gzip_json_lines():
+    bucket = __make_bucket('tester')
+    bucket.put_object(Key='raw/firehose2021/05/07/11/stream-1', Body=json.dumps(envelope()))
+
+    TransformFindings(bucket.name, destination_prefix='Findings', output_compression='gzip').handle({
+        'Records': [{'s3': {'object': {'key': 'raw/firehose2021/05/07/11/stream-1'}}}]
+    }, None)
+
+    body = __read(bucket, 'Findings/0123456789/securityhub/us-east-1/05/07/stream-1.json.gz')
+    assert json.loads(gzip.decompress(body))['Id'] == FINDING['Id']
+
+
+def test_parquet_rejects_stream_compression():
+    with pytest.raises(ValueError):
+        TransformFindings('tester', output_format='parquet', output_compression='gzip')
@@ -0,0 +1,158 @@
+from assets.containers.prowler_scan_check.app import ProwlerScanGroup
+from assets.containers.prowler_scan_check.scan_orchestrator import ScanOrchestrator, load_check_services, service_of
+from fake_prowler import install_fake_prowler, read_calls, FakeSecurityHub
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+
+class SimulatedAccounts:
+    """Runs jobs in-process, recording the concurrency reached per account and per service"""
+
+    def __init__(self, throttles: dict = None, seconds: float = 0.01):
+        self.__throttles = dict(throttles or {})
+        self.__seconds = seconds
+        self.__lock = threading.Lock()
+        self.running = {}
+        self.peaks = {}
+        self.calls = []
+
+    def __enter(self, key):
+        self.running[key] = self.running.get(key, 0) + 1
+        self.peaks[key] = max(self.peaks.get(key, 0), self.running[key])
+
+    def run_job(self, target: dict, check: str):
+        account, service = target['account'], service_of(check)
+        with self.__lock:
+            self.calls.append((account, check, time.monotonic()))
+            self.__enter(account)
+            self.__enter((account, service))
+            throttled = self.__throttles.get(account, 0) > 0
+            if throttled:
+                self.__throttles[account] -= 1
+        time.sleep(self.__seconds)
+        with self.__lock:
+            self.running[account] -= 1
+            self.running[(account, service)] -= 1
+        return SimpleNamespace(throttled=throttled)
+
+
+def test_checks_are_mapped_to_services():
+    assert [service_of(c) for c in ['check11', 'check21', 'check310', 'extra71']] == [
+        'iam', 'logging', 'cloudwatch', 'other']
+    assert service_of('extra71', {'extra7': 's3', 'extra71': 'ec2'}) == 'ec2'
+
+
+def test_check_services_come_from_prowler_metadata(tmp_path):
+    (tmp_path / 'check_extra71').write_text('CHECK_ID_extra71="7.1"\nCHECK_SERVICENAME_extra71="iam"\n')
+    (tmp_path / 'check_extra7100').write_text("CHECK_SERVICENAME_extra7100='s3'\n")
+    (tmp_path / 'check12').write_text('CHECK_ID_check12="1.2"\n')
+
+    services = load_check_services(str(tmp_path))
+
+    assert [service_of(c, services) for c in ['extra71', 'extra7100', 'check12', 'extra999']] == [
+        'iam', 's3', 'iam', 'other']
+    assert load_check_services(str(tmp_path / 'missing')) == {'check1': 'iam', 'check2': 'logging',
+                                                               'check3': 'cloudwatch', 'check4': 'ec2'}
+
+
+def test_concurrency_is_capped_per_account_and_service():
+    accounts = SimulatedAccounts()
+    checks = [f'check1{i}' for i in range(6)] + [f'check2{i}' for i in range(6)]
+
+    jobs = ScanOrchestrator(accounts.run_job, max_concurrency=8, account_concurrency=3, service_concurrency=2).run(
+        [{'account': a, 'region': 'us-east-1'} for a in ['111', '222']], checks)
+
+    assert len(jobs) == 24 and all(j.attempts == 1 and not j.skipped for j in jobs)
+    assert max(accounts.peaks[a] for a in ['111', '222']) <= 3
+    assert max(v for k, v in accounts.peaks.items() if isinstance(k, tuple)) <= 2
+    # Services are interleaved, so the first jobs of an account call different APIs
+    assert [c for a, c, _ in accounts.calls if a == '111'][:2] == ['check10', 'check20']
+
+
+def test_throttling_only_slows_that_account():
+    accounts = SimulatedAccounts(throttles={'111': 3})
+    checks = [f'check1{i}' for i in range(8)]
+
+    jobs = ScanOrchestrator(accounts.run_job, max_concurrency=8, account_concurrency=4, service_concurrency=4,
+                            backoff_base=0.2).run([{'account': a, 'region': 'eu-west-1'} for a in ['111', '222']],
+                                                  checks)
+
+    throttled = [j for j in jobs if j.throttles > 0]
+    assert len(throttled) > 0 and all(j.account == '111' for j in throttled)
+    assert all(not j.result.throttled for j in jobs)
+    finished = {a: max(t for c_a, _, t in accounts.calls if c_a == a) for a in ['111', '222']}
+    assert finished['222'] < finished['111']
+
+
+def test_jobs_are_not_started_past_the_deadline():
+    accounts = SimulatedAccounts(seconds=0.2)
+
+    jobs = ScanOrchestrator(accounts.run_job, max_concurrency=1).run(
+        [{'account': '111', 'region': 'us-east-1'}], ['check11', 'check12', 'check13'],
+        deadline=time.monotonic() + 0.1)
+
+    assert [j.skipped for j in jobs] == [False, True, True]
+
+
+def test_scan_group_scans_every_target(tmp_path, monkeypatch):
+    monkeypatch.setenv('AWS_REGION', 'us-east-1')
+    prowler = install_fake_prowler(tmp_path)
+    securityhub = FakeSecurityHub()
+    target_securityhub = {}
+
+    summary = ProwlerScanGroup('arn:aws:sns:us-east-1:123456789012:fanout', prowler_path=prowler,
+                               securityhub_client=securityhub,
+                               target_securityhub_client=lambda t: target_securityhub.setdefault(
+                                   (t['account'], t['region']), FakeSecurityHub()),
+                               targets=ProwlerScanGroup.targets(['111', '222'], ['us-east-1', 'eu-west-1'],
+                                                                'ProwlerScanRole')
+                               ).handle({'Records': [{'Sns': {'Message': '["check11", "throttled21"]'}}]}, None)
+
+    calls = read_calls(prowler)
+    assert sorted((c[c.index('-A') + 1], c[c.index('-r') + 1]) for c in calls if 'check11' in c) == [
+        ('111', 'eu-west-1'), ('111', 'us-east-1'), ('222', 'eu-west-1'), ('222', 'us-east-1')]
+    assert all(c[c.index('-R') + 1] == 'ProwlerScanRole' for c in calls)
+    # Findings are imported in the account and region they were found in
+    assert securityhub.findings == [] and len(target_securityhub) == 4
+    for (account, region), client in target_securityhub.items():
+        assert len({f['Id'] for f in client.findings}) == 4
+        assert all(f['AwsAccountId'] == account and f':{region}:' in f['ProductArn'] for f in client.findings)
+    # Throttled checks are retried after their account backed off
+    retried = [c for c in summary['checks'] if c['check'] == 'throttled21']
+    assert all(c['throttles'] == 1 and c['attempts'] == 2 and not c['throttled'] for c in retried)
+
+
+class __FakeSns:
+    def __init__(self):
+        self.messages = []
+
+    def publish(self, TopicArn: str, Message: str):
+        self.messages.append(Message)
+
+
+def test_skipped_jobs_are_rescheduled(tmp_path, monkeypatch):
+    monkeypatch.setenv('AWS_REGION', 'us-east-1')
+    prowler = install_fake_prowler(tmp_path)
+    sns = __FakeSns()
+    scan_group = ProwlerScanGroup('arn:aws:sns:us-east-1:123456789012:fanout', prowler_path=prowler,
+                                  securityhub_client=FakeSecurityHub(), sns_client=sns, max_concurrency=1,
+                                  target_securityhub_client=lambda t: FakeSecurityHub(),
+                                  targets=ProwlerScanGroup.targets(['111'], ['us-east-1']))
+    # The deadline passes while the slow check runs, the checks after it are skipped
+    context = SimpleNamespace(get_remaining_time_in_millis=lambda: 31000)
+
+    summary = scan_group.handle({'Records': [{'Sns': {'Message': '["slow1", "check11", "check12"]'}}]}, context)
+
+    assert summary['rescheduled'] == 2
+    assert [json.loads(m) for m in sns.messages] == [{'jobs': [
+        {'account': '111', 'region': 'us-east-1', 'role_name': None, 'check': 'check11'},
+        {'account': '111', 'region': 'us-east-1', 'role_name': None, 'check': 'check12'}]}]
+
+    summary = scan_group.handle({'Records': [{'Sns': {'Message': sns.messages[0]}}]}, None)
+
+    assert sorted(c['check'] for c in summary['checks']) == ['check11', 'check12']
+    assert summary['rescheduled'] == 0 and len(sns.messages) == 1
+    ran = [c[c.index('-c') + 1] for c in read_calls(prowler)]
+    assert sorted(ran) == ['check11', 'check12', 'slow1']
@@ -0,0 +1,103 @@
+from aws_cdk import core as cdk
+from custom_constructs.finding_filter import FindingFilter
+from custom_constructs.security_hub import SecurityHub, LOW_LATENCY
+import pytest
+
+
+def __delivery_configuration(**kwargs) -> dict:
+    app = cdk.App()
+    stack = cdk.Stack(app, 'Test', env=cdk.Environment(account='123456789012', region='us-east-1'))
+    SecurityHub(stack, 'SecurityHub').stream_raw_findings_to_s3(
+        bucket_name='sink', bucket_arn='arn:aws:s3:::sink', bucket_region='us-east-1', **kwargs)
+    resources = app.synth().get_stack_by_name('Test').template['Resources']
+    streams = [r for r in resources.values() if r['Type'] == 'AWS::KinesisFirehose::DeliveryStream']
+    assert len(streams) == 1
+    return streams[0]['Properties']['ExtendedS3DestinationConfiguration']
+
+
+def __processors(configuration: dict) -> list:
+    return [p['Type'] for p in configuration['ProcessingConfiguration']['Processors']]
+
+
+def test_bulk_gzip_newline_delimited_by_default():
+    configuration = __delivery_configuration()
+
+    assert configuration['BufferingHints'] == {'IntervalInSeconds': 900, 'SizeInMBs': 128}
+    assert configuration['CompressionFormat'] == 'GZIP'
+    assert configuration['Prefix'] == 'raw/firehose'
+    assert configuration['ErrorOutputPrefix'].startswith('errors/firehose/')
+    assert __processors(configuration) == ['AppendDelimiterToRecord']
+    assert 'DynamicPartitioningConfiguration' not in configuration
+
+
+def test_low_latency_profile():
+    configuration = __delivery_configuration(buffering_profile=LOW_LATENCY, compression_format='UNCOMPRESSED')
+
+    assert configuration['BufferingHints'] == {'IntervalInSeconds': 60, 'SizeInMBs': 5}
+    assert configuration['CompressionFormat'] == 'UNCOMPRESSED'
+
+
+def test_dynamic_partitioning_by_account_and_region():
+    configuration = __delivery_configuration(buffering_profile=LOW_LATENCY, dynamic_partitioning=True)
+
+    assert configuration['DynamicPartitioningConfiguration']['Enabled'] is True
+    assert configuration['Prefix'] == ('raw/firehose/account=!{partitionKeyFromQuery:account}/'
+                                       'region=!{partitionKeyFromQuery:region}/!{timestamp:yyyy/MM/dd/HH}/')
+    assert __processors(configuration) == ['MetadataExtraction', 'AppendDelimiterToRecord']
+    assert configuration['BufferingHints']['SizeInMBs'] == 64
+
+
+def test_unknown_buffering_profile():
+    with pytest.raises(ValueError):
+        __delivery_configuration(buffering_profile='eventually')
+
+
+def __rule_patterns(**kwargs) -> dict:
+    app = cdk.App()
+    stack = cdk.Stack(app, 'Test', env=cdk.Environment(account='123456789012', region='us-east-1'))
+    SecurityHub(stack, 'SecurityHub').stream_raw_findings_to_s3(
+        bucket_name='sink', bucket_arn='arn:aws:s3:::sink', bucket_region='us-east-1', **kwargs)
+    resources = app.synth().get_stack_by_name('Test').template['Resources']
+    return {k: r['Properties']['EventPattern'] for k, r in resources.items() if r['Type'] == 'AWS::Events::Rule'}
+
+
+def test_unfiltered_rule_matches_every_finding():
+    patterns = list(__rule_patterns().values())
+
+    assert patterns == [{'source': ['aws.securityhub'], 'detail-type': ['Security Hub Findings - Imported']}]
+
+
+def test_filters_are_compiled_into_the_pattern():
+    finding_filter = FindingFilter(severity_floor='MEDIUM', record_states=['ACTIVE'],
+                                   compliance_statuses=['FAILED', 'WARNING'], excluded_products=['Inspector'])
+
+    patterns = list(__rule_patterns(finding_filter=finding_filter).values())
+
+    assert patterns[0]['detail'] == {'findings': {
+        'Severity': {'Label': ['MEDIUM', 'HIGH', 'CRITICAL']},
+        'RecordState': ['ACTIVE'],
+        'Compliance': {'Status': ['FAILED', 'WARNING', {'exists': False}]},
+        'ProductName': [{'anything-but': ['Inspector']}]
+    }}
+
+
+def test_low_value_findings_are_routed_to_their_own_stream():
+    finding_filter = FindingFilter(severity_floor='LOW', products=['Security Hub', 'GuardDuty'])
+
+    patterns = __rule_patterns(finding_filter=finding_filter, low_value_prefix='archive/low-value')
+
+    low_value = [p for k, p in patterns.items() if 'LowValue' in k]
+    assert len(patterns) == 2 and len(low_value) == 1
+    assert low_value[0]['detail'] == {'$or': [
+        {'findings': {'Severity': {'Label': ['INFORMATIONAL']}}},
+        {'findings': {'ProductName': [{'anything-but': ['Security Hub', 'GuardDuty']}]}}
+    ]}
+
+
+def test_filter_validation():
+    with pytest.raises(ValueError):
+        FindingFilter(severity_floor='SEVERE')
+    with pytest.raises(ValueError):
+        FindingFilter(products=['GuardDuty'], excluded_products=['Inspector'])
+    with pytest.raises(ValueError):
+        __rule_patterns(low_value_prefix='archive/low-value')
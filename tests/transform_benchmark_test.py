@@ -0,0 +1,132 @@
+"""Benchmarks for the transform path on a synthetic ASFF corpus.
+
+Each phase (decode, flatten, partition, persist) is measured separately and end to end under moto.  Findings per
+second, peak traced memory, peak RSS and output bytes are attached to every result as extra_info.
+
+    pytest tests/transform_benchmark_test.py --benchmark-autosave
+    pytest tests/transform_benchmark_test.py --benchmark-compare
+
+Autosaved results land in .benchmarks/ named after the commit, --benchmark-compare reports against the latest.
+The corpus size defaults to a quick run and is scaled with BENCHMARK_FINDINGS.
+"""
+from assets.lambdas.transform_findings.finding_flattener import FindingFlattener
+from assets.lambdas.transform_findings.firehose_decoder import iter_envelopes
+from assets.lambdas.transform_findings.index import TransformFindings, output_key
+from assets.lambdas.transform_findings.output_formats import create_output_format
+from assets.lambdas.transform_findings.s3_object_writer import S3ObjectWriter
+from asff_generator import generate_firehose_object
+import boto3
+import io
+import json
+import os
+import pytest
+import resource
+import tracemalloc
+from moto import mock_s3
+
+FINDINGS = int(os.environ.get('BENCHMARK_FINDINGS', 500))
+
+CORPUS = dict(findings=FINDINGS, accounts=10, products=5, regions=3, resources_per_finding=2, nesting_depth=3)
+
+
+@pytest.fixture(scope='module')
+def raw_object() -> bytes:
+    return generate_firehose_object(**CORPUS)
+
+
+@pytest.fixture(scope='module')
+def envelopes(raw_object) -> list:
+    return list(iter_envelopes(io.BytesIO(raw_object)))
+
+
+@pytest.fixture(scope='module')
+def rows(envelopes) -> dict:
+    flattener = FindingFlattener()
+    output = {}
+    for item in envelopes:
+        output.setdefault(output_key(item), []).extend(flattener.flatten(f) for f in item['detail']['findings'])
+    return output
+
+
+@pytest.fixture
+def bucket():
+    with mock_s3():
+        bucket = boto3.resource('s3').Bucket('benchmark')
+        bucket.create()
+        yield bucket
+
+
+def __record(benchmark, function, output_bytes=None):
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    benchmark.extra_info['findings'] = FINDINGS
+    # With --benchmark-disable the function runs once and no stats are kept
+    if benchmark.stats is not None:
+        benchmark.extra_info['findings_per_second'] = round(FINDINGS / benchmark.stats.stats.mean)
+    benchmark.extra_info['peak_traced_bytes'] = peak
+    benchmark.extra_info['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if output_bytes is not None:
+        benchmark.extra_info['output_bytes'] = output_bytes()
+
+
+def test_decode(benchmark, raw_object):
+    def decode():
+        return sum(1 for _ in iter_envelopes(io.BytesIO(raw_object)))
+
+    assert benchmark(decode) > 0
+    __record(benchmark, decode)
+
+
+def test_flatten(benchmark, envelopes):
+    flattener = FindingFlattener()
+
+    def flatten():
+        return [flattener.flatten(f) for item in envelopes for f in item['detail']['findings']]
+
+    assert len(benchmark(flatten)) == FINDINGS
+    __record(benchmark, flatten)
+
+
+def test_partition(benchmark, envelopes):
+    def partition():
+        keys = {}
+        for item in envelopes:
+            keys.setdefault(output_key(item), []).append(item)
+        return keys
+
+    assert len(benchmark(partition)) > 1
+    __record(benchmark, partition)
+
+
+def test_persist(benchmark, bucket, rows):
+    output_format = create_output_format()
+    s3_client = boto3.client('s3')
+    written = []
+
+    def persist():
+        written.clear()
+        for key, key_rows in rows.items():
+            with S3ObjectWriter(s3_client, bucket.name, f'Findings/{key}/benchmark.json') as writer:
+                output_format.write(key_rows, writer)
+            written.append(writer.bytes_out)
+
+    benchmark(persist)
+    __record(benchmark, persist, lambda: sum(written))
+
+
+def test_end_to_end(benchmark, bucket, raw_object):
+    bucket.put_object(Key='raw/firehose2021/05/07/11/benchmark', Body=raw_object)
+    transform_findings = TransformFindings(bucket.name, destination_prefix='Findings')
+    event = {'Records': [{'s3': {'object': {'key': 'raw/firehose2021/05/07/11/benchmark'}}}]}
+
+    benchmark(transform_findings.handle, event, None)
+
+    def output_bytes():
+        return sum(o.size for o in bucket.objects.filter(Prefix='Findings/'))
+
+    __record(benchmark, lambda: transform_findings.handle(event, None), output_bytes)
+    first = next(iter(bucket.objects.filter(Prefix='Findings/')))
+    assert 'Id' in json.loads(first.get()['Body'].read().decode('utf-8').splitlines()[0])
@@ -1,5 +1,15 @@
-from assets.lambdas.transform_findings.index import TransformFindings
+from assets.lambdas.transform_findings import index
+from assets.lambdas.transform_findings.index import TransformFindings, TransformError
+from assets.lambdas.transform_findings.s3_object_writer import MINIMUM_PART_SIZE
+from asff_fixture import FINDING, envelope
+from asff_generator import generate_firehose_object
 import boto3
+import copy
+import gzip
+import io
+import json
+import pytest
+import tracemalloc
 from moto import mock_s3
 
 
@@ -14,63 +24,7 @@ def test_fix_dictionary():
     bucket = __make_bucket('tester')
     transform_findings = TransformFindings(bucket.name)
 
-    finding = {
-        'first/level/test': 'test',
-        'ProductArn': 'arn:aws:securityhub:us-east-1::product/aws/securityhub',
-        'Types': ['Software and Configuration Checks/Industry and Regulatory Standards/CIS AWS Foundations Benchmark'],
-        'Description': 'Security groups provide stateful filtering of ingress/egress network traffic to AWS resources. It is recommended that no security group allows unrestricted ingress access to port 22.',
-        'SchemaVersion': '2018-10-08',
-        'Compliance': {'Status': 'PASSED'},
-        'GeneratorId': 'arn:aws:securityhub:::ruleset/cis-aws-foundations-benchmark/v/1.2.0/rule/4.1',
-        'FirstObservedAt': '2021-01-31T04:52:30.123Z',
-        'CreatedAt': '2021-01-31T04:52:30.123Z',
-        'RecordState': 'ACTIVE',
-        'Title': '4.1 Ensure no security groups allow ingress from 0.0.0.0/0 to port 22',
-        'Workflow': {'Status': 'RESOLVED'},
-        'LastObservedAt': '2021-05-07T11:05:27.353Z',
-        'Severity': {'Normalized': 0, 'Label': 'INFORMATIONAL', 'Product': 0, 'Original': 'INFORMATIONAL'},
-        'UpdatedAt': '2021-05-07T11:05:25.775Z',
-        'FindingProviderFields': {
-            'Types': [
-                'Software and Configuration Checks/Industry and Regulatory Standards/CIS AWS Foundations Benchmark'],
-            'Severity': {'Normalized': 0, 'Label': 'INFORMATIONAL', 'Product': 0, 'Original': 'INFORMATIONAL'}
-        },
-        'WorkflowState': 'NEW',
-        'ProductFields': {
-            'StandardsGuideArn': 'arn:aws:securityhub:::ruleset/cis-aws-foundations-benchmark/v/1.2.0',
-            'StandardsGuideSubscriptionArn': 'arn:aws:securityhub:us-east-1:0123456789:subscription/cis-aws-foundations-benchmark/v/1.2.0',
-            'RuleId': '4.1',
-            'RecommendationUrl': 'https://docs.aws.amazon.com/console/securityhub/standards-cis-4.1/remediation',
-            'RelatedAWSResources:0/name': 'securityhub-restricted-ssh-38a80c22',
-            'RelatedAWSResources:0/type': 'AWS::Config::ConfigRule',
-            'StandardsControlArn': 'arn:aws:securityhub:us-east-1:0123456789:control/cis-aws-foundations-benchmark/v/1.2.0/4.1',
-            'aws/securityhub/ProductName': 'Security Hub',
-            'aws/securityhub/CompanyName': 'AWS',
-            'aws/securityhub/FindingId': 'arn:aws:securityhub:us-east-1::product/aws/securityhub/arn:aws:securityhub:us-east-1:0123456789:subscription/cis-aws-foundations-benchmark/v/1.2.0/4.1/finding/2a55570b-74e9-4aa3-9f4e-66f515c7ff03'
-        },
-        'AwsAccountId': '0123456789',
-        'Id': 'arn:aws:securityhub:us-east-1:0123456789:subscription/cis-aws-foundations-benchmark/v/1.2.0/4.1/finding/2a55570b-74e9-4aa3-9f4e-66f515c7ff03',
-        'Remediation': {
-            'Recommendation': {
-                'Text': 'For directions on how to fix this issue, please consult the AWS Security Hub CIS documentation.',
-                'Url': 'https://docs.aws.amazon.com/console/securityhub/standards-cis-4.1/remediation'}
-        },
-        'Resources': [{
-            'Partition': 'aws',
-            'Type': 'AwsEc2SecurityGroup',
-            'Details': {
-                'AwsEc2SecurityGroup': {
-                    'GroupName': 'default',
-                    'OwnerId': '0123456789',
-                    'VpcId': 'vpc-0123456789',
-                    'IpPermissions': [{'IpProtocol': '-1', 'UserIdGroupPairs': [
-                        {'UserId': '0123456789', 'GroupId': 'sg-0123456789'}]}],
-                    'IpPermissionsEgress': [{'IpProtocol': '-1', 'IpRanges': [{'CidrIp': '0.0.0.0/0'}]}],
-                    'GroupId': 'sg-0123456789'}
-            },
-            'Region': 'us-east-1', 'Id': 'arn:aws:ec2:us-east-1:0123456789:security-group/sg-0123456789'
-        }]
-    }
+    finding = copy.deepcopy(FINDING)
     result = transform_findings.fix_dictionary(finding)
 
     assert isinstance(result, dict)
@@ -84,4 +38,153 @@ def test_fix_dictionary():
     assert 'aws/securityhub/FindingId' not in result['ProductFields']
     assert 'aws_securityhub_FindingId' in result['ProductFields']
     assert 'RelatedAWSResources:0/name' not in result['ProductFields']
-    assert 'RelatedAWSResources_0_name' in result['ProductFields']
\ No newline at end of file
+    assert 'RelatedAWSResources_0_name' in result['ProductFields']
+
+@mock_s3
+def test_handle_isolates_failed_records():
+    bucket = __make_bucket('tester')
+    for i in range(6):
+        bucket.put_object(Key=f'raw/firehose2021/05/07/11/stream-{i}', Body=json.dumps(envelope()))
+    bucket.put_object(Key='raw/firehose2021/05/07/11/corrupt', Body='{"detail": ')
+    keys = [f'raw/firehose2021/05/07/11/stream-{i}' for i in range(6)]
+    keys[3:3] = ['raw/firehose2021/05/07/11/corrupt', 'raw/firehose2021/05/07/11/missing']
+
+    with pytest.raises(TransformError) as e:
+        TransformFindings(bucket.name, destination_prefix='Findings', max_workers=4).handle({
+            'Records': [{'s3': {'object': {'key': k}}} for k in keys]
+        }, None)
+
+    assert sorted(e.value.failures) == ['raw/firehose2021/05/07/11/corrupt', 'raw/firehose2021/05/07/11/missing']
+    written = sorted(o.key for o in bucket.objects.filter(Prefix='Findings/'))
+    assert written == [f'Findings/0123456789/securityhub/us-east-1/05/07/stream-{i}.json' for i in range(6)]
+
+
+@mock_s3
+def test_hive_partition_layout():
+    bucket = __make_bucket('tester')
+    bucket.put_object(Key='raw/firehose2021/05/07/11/stream-1', Body=json.dumps(envelope()))
+
+    TransformFindings(bucket.name, destination_prefix='Findings', partition_layout='hive').handle({
+        'Records': [{'s3': {'object': {'key': 'raw/firehose2021/05/07/11/stream-1'}}}]
+    }, None)
+
+    assert [o.key for o in bucket.objects.filter(Prefix='Findings/')] == [
+        'Findings/account=0123456789/product=securityhub/region=us-east-1/'
+        'year=2021/month=05/day=07/hour=11/stream-1.json']
+
+
+@mock_s3
+def test_gzip_newline_delimited_objects():
+    bucket = __make_bucket('tester')
+    key = 'raw/firehose/account=0123456789/region=us-east-1/2021/05/07/11/stream-1.gz'
+    body = ''.join(json.dumps(envelope()) + '\n' for _ in range(3))
+    bucket.put_object(Key=key, Body=gzip.compress(body.encode('utf-8')))
+
+    TransformFindings(bucket.name, destination_prefix='Findings', partition_layout='hive').handle({
+        'Records': [{'s3': {'object': {'key': key}}}]
+    }, None)
+
+    written = [o.key for o in bucket.objects.filter(Prefix='Findings/')]
+    assert written == ['Findings/account=0123456789/product=securityhub/region=us-east-1/'
+                       'year=2021/month=05/day=07/hour=11/stream-1.json']
+    assert len(bucket.Object(written[0]).get()['Body'].read().decode('utf-8').splitlines()) == 3
+
+
+@mock_s3
+def test_legacy_layout_of_dynamically_partitioned_objects():
+    bucket = __make_bucket('tester')
+    key = 'raw/firehose/account=0123456789/region=us-east-1/2021/05/07/11/stream-1.gz'
+    bucket.put_object(Key=key, Body=gzip.compress(json.dumps(envelope()).encode('utf-8')))
+
+    TransformFindings(bucket.name, destination_prefix='Findings').handle({
+        'Records': [{'s3': {'object': {'key': key}}}]
+    }, None)
+
+    assert [o.key for o in bucket.objects.filter(Prefix='Findings/')] == [
+        'Findings/0123456789/securityhub/us-east-1/05/07/stream-1.json']
+
+
+def test_unknown_partition_layout():
+    with pytest.raises(ValueError):
+        TransformFindings('tester', partition_layout='flat')
+
+
+def __sqs_record(message_id: str, *keys) -> dict:
+    return {'eventSource': 'aws:sqs', 'messageId': message_id,
+            'body': json.dumps({'Records': [{'s3': {'object': {'key': k}}} for k in keys]})}
+
+
+@mock_s3
+def test_sqs_batch_reports_failed_messages():
+    bucket = __make_bucket('tester')
+    for i in range(3):
+        bucket.put_object(Key=f'raw/firehose2021/05/07/11/stream-{i}', Body=json.dumps(envelope()))
+
+    result = TransformFindings(bucket.name, destination_prefix='Findings').handle({'Records': [
+        __sqs_record('m-0', 'raw/firehose2021/05/07/11/stream-0', 'raw/firehose2021/05/07/11/stream-1'),
+        __sqs_record('m-1', 'raw/firehose2021/05/07/11/missing'),
+        {'eventSource': 'aws:sqs', 'messageId': 'm-2', 'body': json.dumps({'Event': 's3:TestEvent'})},
+        {'eventSource': 'aws:sqs', 'messageId': 'm-3', 'body': 'not json'},
+        __sqs_record('m-4', 'raw/firehose2021/05/07/11/stream-2')
+    ]}, None)
+
+    assert result == {'batchItemFailures': [{'itemIdentifier': 'm-1'}, {'itemIdentifier': 'm-3'}]}
+    assert len(list(bucket.objects.filter(Prefix='Findings/'))) == 3
+
+
+@mock_s3
+def test_s3_event_keys_are_decoded():
+    bucket = __make_bucket('tester')
+    bucket.put_object(Key='raw/firehose2021/05/07/11/stream 1', Body=json.dumps(envelope()))
+
+    assert TransformFindings(bucket.name, destination_prefix='Findings').handle({
+        'Records': [{'s3': {'object': {'key': 'raw/firehose2021/05/07/11/stream+1'}}}]
+    }, None) is None
+    assert [o.key for o in bucket.objects.filter(Prefix='Findings/')] == [
+        'Findings/0123456789/securityhub/us-east-1/05/07/stream 1.json']
+
+
+class __DiscardingS3Client:
+    """Serves one raw object and throws away everything written, so traced memory is the transform's own"""
+
+    def __init__(self, raw_object: bytes):
+        self.__raw_object = raw_object
+        self.bytes_written = 0
+
+    def get_object(self, **kwargs):
+        return {'Body': io.BytesIO(self.__raw_object)}
+
+    def put_object(self, Body, **kwargs):
+        self.bytes_written += len(Body)
+
+    def create_multipart_upload(self, **kwargs):
+        return {'UploadId': 'upload'}
+
+    def upload_part(self, Body, **kwargs):
+        self.bytes_written += len(Body)
+        return {'ETag': 'etag'}
+
+    def complete_multipart_upload(self, **kwargs):
+        pass
+
+
+def __peak_memory(monkeypatch, findings: int):
+    s3_client = __DiscardingS3Client(generate_firehose_object(findings=findings, accounts=1, products=1, regions=1))
+    monkeypatch.setattr(index, 'client', lambda *args, **kwargs: s3_client)
+    transform_findings = TransformFindings('tester', destination_prefix='Findings', max_workers=1,
+                                           multipart_threshold=MINIMUM_PART_SIZE)
+
+    tracemalloc.start()
+    assert transform_findings.transform(['raw/firehose2021/05/07/11/stream-1']) == {}
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak, s3_client.bytes_written
+
+
+def test_peak_memory_does_not_grow_with_object_size(monkeypatch):
+    small_peak, small_output = __peak_memory(monkeypatch, 1500)
+    large_peak, large_output = __peak_memory(monkeypatch, 6000)
+
+    assert large_output > 3 * MINIMUM_PART_SIZE
+    # Four times the findings, written as they are flattened, only hold a batch and one part buffer at a time
+    assert large_peak < 2 * small_peak
@@ -0,0 +1,106 @@
+from assets.lambdas.transform_findings.index import TransformFindings
+from assets.lambdas.transform_findings.write_suppression import (WriteSuppressor, MemoryFingerprintStore,
+                                                                 DynamoDBFingerprintStore, fingerprint)
+from asff_fixture import FINDING, envelope
+import boto3
+import json
+from moto import mock_s3, mock_dynamodb
+
+
+def __reimport(finding: dict, updated_at: str) -> dict:
+    return dict(finding, UpdatedAt=updated_at, LastObservedAt=updated_at)
+
+
+def test_fingerprint_ignores_timestamps():
+    assert fingerprint(FINDING) == fingerprint(__reimport(FINDING, '2021-05-08T11:05:25.775Z'))
+    assert fingerprint(FINDING) != fingerprint(dict(FINDING, Compliance={'Status': 'FAILED'}))
+
+
+def test_fingerprints_are_stored_only_on_commit():
+    store = MemoryFingerprintStore()
+    suppressor = WriteSuppressor(store, cache_size=1)
+
+    flags, pending = suppressor.suppressed([FINDING, __reimport(FINDING, '2021-05-08T11:05:25.775Z')])
+    assert flags == [False, True]
+    assert suppressor.suppressed([FINDING])[0] == [False]
+
+    suppressor.commit(pending)
+    # A container without the fingerprint cached still finds it in the store
+    assert WriteSuppressor(store).suppressed([__reimport(FINDING, '2021-05-09T11:05:25.775Z')])[0] == [True]
+
+
+@mock_dynamodb
+def test_dynamodb_store():
+    dynamodb = boto3.client('dynamodb')
+    dynamodb.create_table(TableName='fingerprints', BillingMode='PAY_PER_REQUEST',
+                          KeySchema=[{'AttributeName': 'Id', 'KeyType': 'HASH'}],
+                          AttributeDefinitions=[{'AttributeName': 'Id', 'AttributeType': 'S'}])
+    store = DynamoDBFingerprintStore(dynamodb, 'fingerprints')
+
+    store.put_many({f'finding-{i}': f'{i:032x}' for i in range(60)})
+
+    found = store.get_many([f'finding-{i}' for i in range(0, 120, 2)] + ['finding-0'])
+    assert found == {f'finding-{i}': f'{i:032x}' for i in range(0, 60, 2)}
+
+
+class __ThrottledDynamoDB:
+    """Leaves the first request of each kind unprocessed, like a throttled table"""
+
+    def __init__(self):
+        self.calls = []
+
+    def batch_write_item(self, RequestItems):
+        self.calls.append(('write', len(RequestItems['fingerprints'])))
+        if len(self.calls) == 1:
+            return {'UnprocessedItems': {'fingerprints': RequestItems['fingerprints'][1:]}}
+        return {}
+
+    def batch_get_item(self, RequestItems):
+        keys = RequestItems['fingerprints']['Keys']
+        self.calls.append(('get', len(keys)))
+        if self.calls[-2][0] == 'write':
+            return {'Responses': {}, 'UnprocessedKeys': RequestItems}
+        return {'Responses': {'fingerprints': [{'Id': k['Id'], 'Fingerprint': {'S': '0' * 32}} for k in keys]}}
+
+
+def test_dynamodb_store_backs_off_before_retrying_unprocessed_requests():
+    dynamodb = __ThrottledDynamoDB()
+    waits = []
+    store = DynamoDBFingerprintStore(dynamodb, 'fingerprints', sleep=waits.append)
+
+    store.put_many({'finding-1': '0' * 32, 'finding-2': '0' * 32})
+    assert store.get_many(['finding-1']) == {'finding-1': '0' * 32}
+    assert dynamodb.calls == [('write', 2), ('write', 1), ('get', 1), ('get', 1)]
+    assert len(waits) == 2
+
+
+@mock_s3
+def test_unchanged_reimports_are_written_as_heartbeats(capsys):
+    bucket = boto3.resource('s3').Bucket('tester')
+    bucket.create()
+    transform = TransformFindings(bucket.name, destination_prefix='Findings', partition_layout='hive',
+                                  fingerprint_store=MemoryFingerprintStore(), heartbeat_prefix='Heartbeats')
+    changed = dict(FINDING, Compliance={'Status': 'FAILED'})
+    objects = {
+        'raw/firehose2021/05/07/11/stream-1': [FINDING],
+        'raw/firehose2021/05/07/12/stream-2': [__reimport(FINDING, '2021-05-07T12:05:25.775Z'), changed]
+    }
+    for key, findings in objects.items():
+        bucket.put_object(Key=key, Body=''.join(json.dumps(envelope(f)) + '\n' for f in findings))
+        capsys.readouterr()
+        transform.handle({'Records': [{'s3': {'object': {'key': key}}}]}, None)
+
+    assert json.loads(capsys.readouterr().out)['Suppressed'] == 1
+    written = sorted(o.key for o in bucket.objects.all() if not o.key.startswith('raw/'))
+    assert written == [
+        'Findings/account=0123456789/product=securityhub/region=us-east-1/year=2021/month=05/day=07/hour=11/'
+        'stream-1.json',
+        'Findings/account=0123456789/product=securityhub/region=us-east-1/year=2021/month=05/day=07/hour=12/'
+        'stream-2.json',
+        'Heartbeats/account=0123456789/product=securityhub/region=us-east-1/year=2021/month=05/day=07/hour=12/'
+        'stream-2.json'
+    ]
+    rows = bucket.Object(written[1]).get()['Body'].read().decode('utf-8').splitlines()
+    assert [json.loads(r)['Compliance_Status'] for r in rows] == ['FAILED']
+    heartbeat = json.loads(bucket.Object(written[2]).get()['Body'].read())
+    assert heartbeat['UpdatedAt'] == '2021-05-07T12:05:25.775Z'